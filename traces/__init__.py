@@ -4,6 +4,12 @@
 import sys
 import subprocess
 
+# Imports are timed from the very beginning when profiling the startup
+if "--profile-startup" in sys.argv:
+    from . import mod_imports
+
+    mod_imports.enable()
+
 
 def start():
     try:
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import mod_experiment as experiment
+
+## Simulated devices without latencies, only the configured waits remain
+SIMULATION = "latency=0;opc=0;noise=0.001"
+
+## Pump switching its RF output with the command latency and *OPC? of a synthesizer,
+## which is the cost the blocked digital DMDR saves
+PUMP_SIMULATION = "latency=0;latency_set_rfpower=0.001;opc=0.005;noise=0.001"
+
+
+def measurement_dict(**kwargs):
+    dict_ = {
+        "general_mode": "classic",
+        "general_user": "benchmark",
+        "static_probeaddress": SIMULATION,
+        "static_probedevice": "SimulatedDevice",
+        "static_probemultiplication": 1,
+        "static_lockinaddress": SIMULATION,
+        "static_lockindevice": "SimulatedDevice",
+        "static_skipreset": True,
+        "static_pressuregaugaaddress": "",
+        "static_pumpaddress": SIMULATION,
+        "static_pumpdevice": "SimulatedDevice",
+        "static_pumpmultiplication": 1,
+        "probe_frequency": {
+            "mode": "sweep",
+            "direction": "forth",
+            "center": 100000,
+            "span": 100,
+            "points": 1000,
+        },
+        "probe_power": 1,
+        "pump_frequency": {"mode": "fixed", "center": 200000},
+        "pump_power": 1,
+        "lockin_fmfrequency": 27613,
+        "lockin_fmdeviation": 180,
+        "lockin_timeconstant": "10μs",
+        "lockin_delaytime": 0.01,
+        "lockin_sensitivity": "100mV",
+        "lockin_acgain": "0dB",
+        "lockin_iterations": 1,
+    }
+    dict_.update(kwargs)
+    return dict_
+
+
+def sweep(points, center=100000, span=100):
+    return {
+        "mode": "sweep",
+        "direction": "forth",
+        "center": center,
+        "span": span,
+        "points": points,
+    }
+
+
+def peak_memory():
+    # Peak resident set size of the process so far in MB, every scenario runs in
+    # its own process
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def setup_experiment():
+    # The loop reports to the module level experiment and server
+    sink = lambda dict_: json.dumps(dict_)
+    experiment.experiment = experiment.Experiment()
+    experiment.experiment.send_all = sink
+    experiment.experiment._state = "running"
+    experiment.server = experiment.experiment
+    return experiment.experiment
+
+
+def run_loop(dict_):
+    setup_experiment()
+    measurement = experiment.Measurement(dict_)
+    measurement.probe = measurement.pump = measurement.lockin = None
+    try:
+        measurement.probe = measurement.connect_device("probe")
+        if measurement.mode not in experiment.devices.probeonly_modes:
+            measurement.pump = measurement.connect_device("pump")
+        measurement.lockin = measurement.connect_device("lockin")
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        measurement.spectrum_loop()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    finally:
+        for device in (measurement.lockin, measurement.probe, measurement.pump):
+            if device:
+                device.close()
+
+    # Waits configured by the delay and time constant
+    counts, defaults, analytic = measurement.runtime_components()
+    if counts:
+        waits = sum(counts[phase] * defaults[phase] for phase in counts)
+    else:
+        waits = analytic
+
+    points = len(measurement.result)
+    return {
+        "points": points,
+        "wall": wall,
+        "cpu": cpu,
+        "points_per_second": points / wall,
+        "overhead_per_point": (wall - waits) / points,
+    }
+
+
+def run_queue(n_measurements):
+    experiment_ = setup_experiment()
+    dicts = [measurement_dict() for _ in range(n_measurements)]
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    experiment_.add_measurements(dicts)
+    experiment_.del_measurements()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    return {
+        "points": n_measurements,
+        "wall": wall,
+        "cpu": cpu,
+        "points_per_second": n_measurements / wall,
+    }
+
+
+def run_save(n_probe, n_pump):
+    dict_ = measurement_dict(general_mode="dr")
+    measurement = experiment.Measurement(dict_)
+    measurement.lockin = experiment.devices.MockDevice("")
+    measurement.aborted = False
+    measurement["general_datestart"] = str(datetime.now())[:19]
+
+    probe, pump = np.meshgrid(
+        np.linspace(99950, 100050, n_probe), np.linspace(199000, 201000, n_pump)
+    )
+    rng = np.random.default_rng(0)
+    measurement.result = np.column_stack(
+        (probe.ravel(), pump.ravel(), rng.standard_normal((probe.size, 2)))
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        wall, cpu = time.perf_counter(), time.process_time()
+        measurement.save_spectrum(directory)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    points = len(measurement.result)
+    return {
+        "points": points,
+        "wall": wall,
+        "cpu": cpu,
+        "points_per_second": points / wall,
+    }
+
+
+scenarios = {
+    "classic_10k": lambda: run_loop(measurement_dict(probe_frequency=sweep(10000))),
+    "dr_grid": lambda: run_loop(
+        measurement_dict(
+            general_mode="dr",
+            probe_frequency=sweep(200),
+            pump_frequency=sweep(25, center=200000, span=1000),
+        )
+    ),
+    "digital_dmdr": lambda: run_loop(
+        measurement_dict(
+            general_mode="digital_dmdr",
+            static_pumpaddress=PUMP_SIMULATION,
+            probe_frequency=sweep(500),
+        )
+    ),
+    "digital_dmdr_blocked": lambda: run_loop(
+        measurement_dict(
+            general_mode="digital_dmdr",
+            general_dmblocksize=50,
+            static_pumpaddress=PUMP_SIMULATION,
+            probe_frequency=sweep(500),
+        )
+    ),
+    "iterations": lambda: run_loop(
+        measurement_dict(lockin_iterations=100, probe_frequency=sweep(100))
+    ),
+    "queue_1k": lambda: run_queue(1000),
+    "save_1m": lambda: run_save(2000, 500),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(name, repeat):
+    runs = []
+    for _ in range(repeat):
+        runs.append(scenarios[name]())
+    # Report the fastest run, the others are mostly disturbed by the system
+    best = max(runs, key=lambda x: x["points_per_second"])
+    best["peak_memory"] = peak_memory()
+    return best
+
+
+def run(names, repeat=1):
+    # The peak memory of a process never decreases, so that a fresh process per
+    # scenario keeps the large ones from hiding the following ones
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name in names:
+        with context.Pool(1) as pool:
+            best = pool.apply(run_scenario, (name, repeat))
+        results[name] = best
+        print(f"{name:>22}: {best['points_per_second']:12.1f} points/s")
+
+    return {
+        "commit": git_commit(),
+        "date": str(datetime.now())[:19],
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": results,
+    }
+
+
+def compare(results, filename):
+    with open(filename, "r", encoding="utf-8") as file:
+        reference = json.load(file)
+
+    print(f"Compared to {reference.get('commit')} from {reference.get('date')}:")
+    for name, values in results["scenarios"].items():
+        old_values = reference["scenarios"].get(name)
+        if not old_values:
+            continue
+        ratio = values["points_per_second"] / old_values["points_per_second"]
+        print(f"{name:>22}: {ratio:8.2f} x")
+
+
+def start():
+    parser = argparse.ArgumentParser(prog="trace_benchmark")
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        default=list(scenarios),
+        help=f"Scenarios to run, defaults to all of {list(scenarios)}",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON file of earlier results to compare to")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(scenarios)
+    if unknown:
+        parser.error(f"Unknown scenarios {unknown}.")
+
+    results = run(args.scenarios, args.repeat)
+
+    if args.output:
+        with open(args.output, "w+", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import os
+import re
+import ast
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import configparser
+from datetime import datetime
+
+## Database of the saved measurements, next to the data folder
+FILENAME = "catalogue.sqlite"
+
+## Seconds to wait for other processes writing to the database
+TIMEOUT = 30
+
+## Indexed values of every saved spectrum file, the frequencies are those of the sweeps
+columns = {
+    "path": "TEXT UNIQUE NOT NULL",
+    "ini": "TEXT",
+    "rawdata": "TEXT",
+    "measurement": "TEXT",
+    "mode": "TEXT COLLATE NOCASE",
+    "molecule": "TEXT COLLATE NOCASE",
+    "chemicalformula": "TEXT COLLATE NOCASE",
+    "user": "TEXT COLLATE NOCASE",
+    "project": "TEXT COLLATE NOCASE",
+    "setup": "TEXT COLLATE NOCASE",
+    "comment": "TEXT",
+    "probe_min": "REAL",
+    "probe_max": "REAL",
+    "pump_min": "REAL",
+    "pump_max": "REAL",
+    "pressure_start": "REAL",
+    "pressure_end": "REAL",
+    "date_start": "TEXT",
+    "date_end": "TEXT",
+    "duration": "REAL",
+    "aborted": "INTEGER",
+    "modified": "REAL",
+}
+
+indices = (
+    ("mode",),
+    ("molecule",),
+    ("user",),
+    ("project",),
+    ("measurement",),
+    ("date_start",),
+    ("probe_min", "probe_max"),
+    ("pump_min", "pump_max"),
+    ("pressure_start",),
+)
+
+pump_pattern = re.compile(r"_Pump@([0-9.]+)")
+
+
+class CatalogueError(Exception):
+    pass
+
+
+def default_filename():
+    return os.path.join(os.path.expanduser("~"), "TRACE", FILENAME)
+
+
+def parse_value(value):
+    # Sweeps are saved as JSON or as the representation of the dict
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            return parse(value)
+        except (ValueError, SyntaxError):
+            continue
+    return value
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def sweep_range(sweep):
+    if not isinstance(sweep, dict):
+        return None, None
+    if sweep.get("mode") == "fixed":
+        center = parse_float(sweep.get("center"))
+        return center, center
+    if "start" in sweep and "stop" in sweep:
+        start, stop = parse_float(sweep["start"]), parse_float(sweep["stop"])
+        if start is None or stop is None:
+            return None, None
+        return min(start, stop), max(start, stop)
+    center, span = parse_float(sweep.get("center")), parse_float(sweep.get("span"))
+    if center is None or span is None:
+        return None, None
+    return center - span / 2, center + span / 2
+
+
+def parse_date(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_record(path):
+    # Every .dat file has an .ini file with the same name
+    path = os.path.realpath(path)
+    ini = f"{os.path.splitext(path)[0]}.ini"
+    config_parser = configparser.ConfigParser(interpolation=None)
+    if not config_parser.read(ini, encoding="utf-8"):
+        raise CatalogueError(f"The file '{ini}' could not be read.")
+
+    def get(section, key):
+        return config_parser.get(section, key, fallback=None)
+
+    probe_min, probe_max = sweep_range(parse_value(get("Probe", "frequency") or ""))
+    pump_min, pump_max = sweep_range(parse_value(get("Pump", "frequency") or ""))
+    # Measurements with several pump frequencies are saved to one file per pump frequency
+    match = pump_pattern.search(os.path.basename(path))
+    if match:
+        pump_min = pump_max = float(match.group(1))
+
+    date_start = get("General", "datestart")
+    date_end = get("General", "dateend")
+    start, end = parse_date(date_start), parse_date(date_end)
+    rawdata = get("General", "rawdata")
+
+    return {
+        "path": path,
+        "ini": ini,
+        "rawdata": os.path.join(os.path.dirname(path), rawdata) if rawdata else None,
+        "measurement": get("General", "id"),
+        "mode": get("General", "mode"),
+        "molecule": get("General", "molecule"),
+        "chemicalformula": get("General", "chemicalformula"),
+        "user": get("General", "user"),
+        "project": get("General", "project"),
+        "setup": get("General", "setup"),
+        "comment": get("General", "comment"),
+        "probe_min": probe_min,
+        "probe_max": probe_max,
+        "pump_min": pump_min,
+        "pump_max": pump_max,
+        "pressure_start": parse_float(get("General", "pressurestart")),
+        "pressure_end": parse_float(get("General", "pressureend")),
+        "date_start": date_start,
+        "date_end": date_end,
+        "duration": (end - start).total_seconds() if start and end else None,
+        "aborted": int(get("General", "aborted") == "True"),
+        "modified": os.path.getmtime(ini),
+    }
+
+
+class Catalogue:
+    def __init__(self, filename=None):
+        self.filename = filename or default_filename()
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        # The GUI queries from its loading threads
+        self.connection = sqlite3.connect(
+            self.filename, timeout=TIMEOUT, check_same_thread=False
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.create()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def create(self):
+        definitions = ", ".join(f"{key} {type_}" for key, type_ in columns.items())
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, {definitions})"
+            )
+            for index in indices:
+                self.connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS files_{'_'.join(index)} ON files ({', '.join(index)})"
+                )
+
+    def insert(self, records):
+        keys = list(columns)
+        placeholders = ", ".join("?" for _ in keys)
+        updates = ", ".join(f"{key}=excluded.{key}" for key in keys[1:])
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f"INSERT INTO files ({', '.join(keys)}) VALUES ({placeholders}) "
+                f"ON CONFLICT(path) DO UPDATE SET {updates}",
+                [[record[key] for key in keys] for record in records],
+            )
+
+    def add(self, filenames):
+        self.insert([read_record(filename) for filename in filenames])
+
+    def backfill(self, folder, progress=None):
+        # Only new or changed files are read, files that disappeared are removed
+        folder = os.path.realpath(folder)
+        with self.lock:
+            known = dict(
+                self.connection.execute(
+                    "SELECT path, modified FROM files WHERE path LIKE ? ESCAPE '\\'",
+                    (like_prefix(folder),),
+                ).fetchall()
+            )
+
+        records, errors, found = [], [], set()
+        for root, _, filenames in os.walk(folder):
+            for filename in filenames:
+                if not filename.endswith(".dat"):
+                    continue
+                path = os.path.realpath(os.path.join(root, filename))
+                found.add(path)
+                ini = f"{os.path.splitext(path)[0]}.ini"
+                try:
+                    if known.get(path) == os.path.getmtime(ini):
+                        continue
+                    records.append(read_record(path))
+                except (OSError, CatalogueError, configparser.Error) as E:
+                    errors.append(f"{path}: {E}")
+                    continue
+                if progress and len(records) % 1000 == 0:
+                    progress(len(records))
+
+        self.insert(records)
+        removed = [path for path in known if path not in found]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM files WHERE path = ?", [(path,) for path in removed]
+            )
+        return {"added": len(records), "removed": len(removed), "errors": errors}
+
+    def query(
+        self,
+        mode=None,
+        molecule=None,
+        user=None,
+        project=None,
+        setup=None,
+        measurement=None,
+        frequency=None,
+        pump=None,
+        pressure=None,
+        date=None,
+        aborted=None,
+        limit=None,
+    ):
+        # Text values may use * as wildcard, frequencies, pressures and dates are
+        # single values or ranges given as (low, high)
+        conditions, parameters = [], []
+
+        for key, value in (
+            ("mode", mode),
+            ("molecule", molecule),
+            ("user", user),
+            ("project", project),
+            ("setup", setup),
+            ("measurement", measurement),
+        ):
+            if not value:
+                continue
+            if "*" in value:
+                conditions.append(f"{key} LIKE ? ESCAPE '\\'")
+                parameters.append(like_pattern(value))
+            else:
+                conditions.append(f"{key} = ?")
+                parameters.append(value)
+
+        for key, value in (("probe", frequency), ("pump", pump)):
+            if value is None:
+                continue
+            low, high = bounds(value)
+            conditions.append(f"{key}_max >= ? AND {key}_min <= ?")
+            parameters.extend((low, high))
+
+        for key, value in (("pressure_start", pressure), ("date_start", date)):
+            if value is None:
+                continue
+            low, high = bounds(value)
+            conditions.append(f"{key} BETWEEN ? AND ?")
+            parameters.extend((low, high))
+
+        if aborted is not None:
+            conditions.append("aborted = ?")
+            parameters.append(int(aborted))
+
+        statement = "SELECT * FROM files"
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        statement += " ORDER BY date_start DESC, path"
+        if limit:
+            statement += " LIMIT ?"
+            parameters.append(int(limit))
+
+        with self.lock:
+            rows = self.connection.execute(statement, parameters).fetchall()
+        return [dict(row) for row in rows]
+
+    def values(self, key):
+        # Distinct values of a column, e.g. to offer the known molecules
+        if key not in columns:
+            raise CatalogueError(f"The column '{key}' does not exist.")
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT DISTINCT {key} FROM files WHERE {key} IS NOT NULL ORDER BY {key}"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+def bounds(value):
+    if isinstance(value, (list, tuple)):
+        low, high = value
+        return min(low, high), max(low, high)
+    return value, value
+
+
+def like_prefix(folder):
+    folder = os.path.join(folder, "")
+    return re.sub(r"([\\%_])", r"\\\1", folder) + "%"
+
+
+def like_pattern(value):
+    return re.sub(r"([\\%_])", r"\\\1", value).replace("*", "%")
+
+
+def parse_range(value):
+    # '60000-120000', '1e-3-2e-3' or a single value, signs of exponents do not split
+    values = re.split(r"(?<=[\d.])\s*-\s*(?=[\d.])", value.strip(), maxsplit=1)
+    if len(values) == 2:
+        return tuple(float(x) for x in values)
+    return float(values[0])
+
+
+def start():
+    parser = argparse.ArgumentParser(
+        prog="trace_catalogue",
+        description="Search the catalogue of saved measurements",
+    )
+    parser.add_argument(
+        "--backfill",
+        nargs="?",
+        const=os.path.join(os.path.expanduser("~"), "TRACE", "data"),
+        help="Add the files of a data folder, by default ~/TRACE/data",
+    )
+    parser.add_argument(
+        "--database", help="Catalogue file, by default ~/TRACE/catalogue.sqlite"
+    )
+    for key in ("mode", "molecule", "user", "project", "setup"):
+        parser.add_argument(f"--{key}", help="Value, * can be used as wildcard")
+    parser.add_argument(
+        "--frequency",
+        type=parse_range,
+        help="Probe frequency or range, e.g. 60000-61000",
+    )
+    parser.add_argument("--pump", type=parse_range, help="Pump frequency or range")
+    parser.add_argument(
+        "--pressure",
+        type=parse_range,
+        help="Pressure or range in mbar, e.g. 1e-3-5e-3",
+    )
+    parser.add_argument("--limit", type=int, default=100, help="Most files listed")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    with Catalogue(args.database) as catalogue:
+        if args.backfill:
+            start_time = time.perf_counter()
+            result = catalogue.backfill(
+                args.backfill, progress=lambda x: print(f"Read {x} files", end="\r")
+            )
+            print(
+                f"Added {result['added']} and removed {result['removed']} files in {time.perf_counter() - start_time:.1f} s."
+            )
+            for error in result["errors"]:
+                print(f"  {error}")
+
+        start_time = time.perf_counter()
+        results = catalogue.query(
+            mode=args.mode,
+            molecule=args.molecule,
+            user=args.user,
+            project=args.project,
+            setup=args.setup,
+            frequency=args.frequency,
+            pump=args.pump,
+            pressure=args.pressure,
+            limit=args.limit,
+        )
+        duration = time.perf_counter() - start_time
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        print(
+            f"{result['date_start'] or '':19}  {result['mode'] or '':12}  {result['molecule'] or '':16}  "
+            f"{result['probe_min'] or 0:12.3f} - {result['probe_max'] or 0:12.3f}  {result['path']}"
+        )
+    print(f"{len(results)} files in {duration * 1000:.1f} ms.")
+
+
+if __name__ == "__main__":
+    start()
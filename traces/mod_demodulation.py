@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import numpy as np
+from concurrent import futures
+
+from . import mod_imports as imports
+
+## Only the filter design is needed, scipy.signal is slow to import
+signal = imports.LazyModule("scipy.signal")
+
+
+def get_channels(dict_):
+    # The first listed harmonic of the first reference is the main channel
+    mode = dict_["general_mode"]
+    harmonics = [
+        int(x) for x in str(dict_.get("lockin_harmonics", "2")).split(",") if x.strip()
+    ]
+
+    references = {}
+    if mode == "dr_pufm":
+        references["pump"] = dict_["lockin_fmfrequency"]
+    else:
+        references["probe"] = dict_["lockin_fmfrequency"]
+
+    if mode in ("dmdr", "dmdr_am"):
+        # The DM period is given in ms
+        references["pump"] = 1000 / dict_["general_dmperiod"]
+
+    channels = []
+    for reference, frequency in references.items():
+        for harmonic in harmonics:
+            channels.append((f"{reference}{harmonic}f", frequency * harmonic))
+    return channels
+
+
+class Demodulator:
+    def __init__(self, channels, samplefrequency, points, timeconstant, workers=2):
+        self.names = [name for name, frequency in channels]
+        self.frequencies = np.array([frequency for name, frequency in channels])
+        self.numtaps = points if points % 2 else points - 1
+
+        # Combine mixing and FIR low-pass into one weight matrix, the output of the
+        # filter is only needed at a single point per trace
+        cutoff = min(1 / (2 * np.pi * timeconstant), samplefrequency / 4)
+        taps = signal.firwin(self.numtaps, cutoff, fs=samplefrequency)
+        ks = np.arange(self.numtaps)
+        self.weights = (
+            np.sqrt(2)
+            * taps
+            * np.exp(-2j * np.pi * self.frequencies[:, None] * ks / samplefrequency)
+        )
+
+        self.pool = futures.ThreadPoolExecutor(max_workers=workers)
+
+    def demodulate(self, t0, ys):
+        # Phase relative to the absolute start time of the trace
+        values = (self.weights @ ys[: self.numtaps]) * np.exp(
+            -2j * np.pi * self.frequencies * t0
+        )
+        return np.column_stack((values.real, values.imag)).ravel()
+
+    def submit(self, t0, ys):
+        return self.pool.submit(self.demodulate, t0, ys)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
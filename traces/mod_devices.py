@@ -3,10 +3,21 @@
 
 # Author: Luis Bonah
 
+import os
+import sys
 import time
-import pyvisa
+import importlib
 import numpy as np
-import zhinst.ziPython as zi
+from concurrent import futures
+from collections.abc import Mapping
+
+from . import mod_demodulation as demodulation
+from . import mod_simulation as simulation
+from . import mod_imports as imports
+
+## Driver backends are only imported when a device needs them
+pyvisa = imports.LazyModule("pyvisa")
+zi = imports.LazyModule("zhinst.ziPython")
 
 SILENT = True
 # @Luis: Remove after Timesignal Testing
@@ -35,6 +46,25 @@ class Synthesizer:
         if not SILENT:
             print(f"SETTING RF FREQUENCY TO {value}")
 
+    # Sweeps are only available for drivers declaring the capability
+    def prepare_list_sweep(self, frequencies, dwelltime):
+        raise NotImplementedError("This synthesizer does not support list sweeps.")
+
+    def start_list_sweep(self):
+        raise NotImplementedError("This synthesizer does not support list sweeps.")
+
+    def stop_list_sweep(self):
+        raise NotImplementedError("This synthesizer does not support list sweeps.")
+
+    def prepare_ramp_sweep(self, start, stop, duration, steps):
+        raise NotImplementedError("This synthesizer does not support ramp sweeps.")
+
+    def start_ramp_sweep(self):
+        raise NotImplementedError("This synthesizer does not support ramp sweeps.")
+
+    def stop_ramp_sweep(self):
+        raise NotImplementedError("This synthesizer does not support ramp sweeps.")
+
 
 class LockInAmplifier:
     TC_OPTIONS = {
@@ -68,6 +98,22 @@ class LockInAmplifier:
         26: "500mV",
         27: "1V",
     }
+    # Time to settle within 1 % after a step, in time constants, per filter order
+    SETTLE_FACTORS = {1: 4.6, 2: 6.6, 3: 8.4, 4: 10.0}
+    filterorder = 1
+    fullscale = 1
+    channels = ("signal",)
+    BUFFER_LENGTH = 32768
+    # Most samples a stream can record, None if it is not limited
+    STREAM_MAX_POINTS = None
+
+    def parse_fullscale(self, value):
+        self.fullscale = float(
+            value.replace("nV", "E-9")
+            .replace("μV", "E-6")
+            .replace("mV", "E-3")
+            .replace("V", "")
+        )
 
     def get_intensity(self):
         if not SILENT:
@@ -81,6 +127,47 @@ class LockInAmplifier:
 
         return self.get_intensity()
 
+    # Digital DMDR switches the pump off and on for every point
+    def measure_intensity_dmdr_digital(self, delaytime=0):
+        results = {}
+        for state in (0, 1):
+            self.pump.set_rfpower(state)
+            counterstart = time.perf_counter()
+
+            additional_delay_time = state * delaytime
+            while (
+                time.perf_counter() - counterstart
+                < self.timeconstant + additional_delay_time
+            ):
+                continue
+            results[state] = self.get_intensity()
+
+        x, y = results[0][0] - results[1][0], results[0][1] - results[1][1]
+        return (x, y)
+
+    def stream_rate(self, rate):
+        # Sample rate a stream records at for the requested rate
+        return rate
+
+    # Buffers and streams are only available for drivers declaring the capability
+    def prepare_buffer(self, points):
+        raise NotImplementedError("This lock-in amplifier has no curve buffer.")
+
+    def start_buffer(self):
+        raise NotImplementedError("This lock-in amplifier has no curve buffer.")
+
+    def buffer_points(self):
+        raise NotImplementedError("This lock-in amplifier has no curve buffer.")
+
+    def read_buffer(self, points):
+        raise NotImplementedError("This lock-in amplifier has no curve buffer.")
+
+    def start_stream(self, rate, duration):
+        raise NotImplementedError("This lock-in amplifier does not support streams.")
+
+    def read_stream(self):
+        raise NotImplementedError("This lock-in amplifier does not support streams.")
+
 
 class MockDevice(Synthesizer, LockInAmplifier):
     EOL = ";"
@@ -93,18 +180,67 @@ class MockDevice(Synthesizer, LockInAmplifier):
         if not SILENT:
             print("CHECKING ERRORS")
 
+    def prepare_list_sweep(self, frequencies, dwelltime):
+        if not SILENT:
+            print(f"PREPARING LIST SWEEP WITH {len(frequencies)} FREQUENCIES")
+
+    def start_list_sweep(self):
+        if not SILENT:
+            print("STARTING LIST SWEEP")
+
+    def stop_list_sweep(self):
+        if not SILENT:
+            print("STOPPING LIST SWEEP")
+
+    def prepare_ramp_sweep(self, start, stop, duration, steps):
+        if not SILENT:
+            print(f"PREPARING RAMP SWEEP FROM {start} TO {stop} IN {duration} s")
+
+    def start_ramp_sweep(self):
+        if not SILENT:
+            print("STARTING RAMP SWEEP")
+
+    def stop_ramp_sweep(self):
+        if not SILENT:
+            print("STOPPING RAMP SWEEP")
+
+    def prepare_buffer(self, points):
+        self.buffer_length = points
+
+    def start_buffer(self):
+        if not SILENT:
+            print("STARTING BUFFER")
+
+    def buffer_points(self):
+        return self.buffer_length
+
+    def read_buffer(self, points):
+        x, y = self.get_intensity()
+        return np.full(points, x, dtype=np.float64), np.full(
+            points, y, dtype=np.float64
+        )
+
+    def start_stream(self, rate, duration):
+        self.stream_start = time.perf_counter()
+        self.stream_rate = rate
+        self.stream_duration = duration
+
+    def read_stream(self):
+        remaining = self.stream_start + self.stream_duration - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        ts = np.arange(0, self.stream_duration, 1 / self.stream_rate)
+        x, y = self.get_intensity()
+        return ts, np.full_like(ts, x), np.full_like(ts, y)
+
     def prepare_measurement(self, dict_, devicetype):
         self.check_errors()
 
         if "lockin_timeconstant" in dict_:
-            self.timeconstant = float(
-                dict_["lockin_timeconstant"]
-                .replace("μs", "E-3")
-                .replace("ms", "")
-                .replace("ks", "E6")
-                .replace("s", "E3")
-            )
-            self.timeconstant /= 1000
+            self.timeconstant = parse_timeconstant(dict_["lockin_timeconstant"])
+        if "lockin_sensitivity" in dict_:
+            self.parse_fullscale(dict_["lockin_sensitivity"])
         if not SILENT:
             print("SETTING START VALUES")
 
@@ -112,6 +248,134 @@ class MockDevice(Synthesizer, LockInAmplifier):
         pass
 
 
+class SimulatedDevice(Synthesizer, LockInAmplifier):
+    # Synthesizer and lock-in amplifier with simulated latencies and a synthetic
+    # spectrum, the settings are given as the address (see mod_simulation)
+
+    def __init__(self, address, multiplication=1):
+        Synthesizer.__init__(self, multiplication=multiplication)
+        LockInAmplifier.__init__(self)
+        self.settings = simulation.parse_settings(address)
+        self.rng = np.random.default_rng(int(self.settings["seed"]))
+        self.devicetype = None
+
+    def delay(self, command):
+        settings, rng = self.settings, self.rng
+        simulation.wait(
+            simulation.latency(settings, rng, command) + simulation.spike(settings, rng)
+        )
+
+        # A hanging call ends with the timeout of the connection
+        if simulation.fault(settings, rng, "timeouts"):
+            simulation.wait(settings["timeout"])
+            raise DeviceError(f"Timeout expired before '{command}' completed.")
+
+    def prepare_measurement(self, dict_, devicetype):
+        self.delay("prepare_measurement")
+        self.devicetype = devicetype
+
+        if devicetype == "lockin":
+            if simulation.fault(self.settings, self.rng, "unlocked"):
+                simulation.wait(self.settings["timeout"])
+                raise CustomError(
+                    "Timed out when waiting for Lock-In to lock to reference signal"
+                )
+
+            self.timeconstant = parse_timeconstant(dict_["lockin_timeconstant"])
+            self.parse_fullscale(dict_["lockin_sensitivity"])
+            self.model = simulation.LockInModel(self.settings, self.rng)
+            self.model.configure(
+                self.timeconstant,
+                self.SETTLE_FACTORS[self.filterorder],
+                self.fullscale,
+                dict_["lockin_fmdeviation"] / 1000,
+            )
+
+            # Blocked digital DMDR switches the pump in the measurement loop instead
+            if (
+                dict_.get("general_mode") == "digital_dmdr"
+                and dict_.get("general_dmblocksize", 1) == 1
+            ):
+                dt = dict_["lockin_delaytime"] / 1000
+                self.measure_intensity = (
+                    lambda dt=dt: self.measure_intensity_dmdr_digital(delaytime=dt)
+                )
+        else:
+            simulation.state[devicetype] = {
+                "frequency": None,
+                "time": time.perf_counter(),
+                "rfpower": 1,
+            }
+
+    def set_frequency(self, value):
+        self.delay("set_frequency")
+        simulation.state[self.devicetype].update(
+            {"frequency": value, "time": time.perf_counter()}
+        )
+        # *OPC? returns once the synthesizer has settled
+        simulation.wait(self.settings["opc"])
+
+    def set_rfpower(self, value, blocking=True):
+        self.delay("set_rfpower")
+        simulation.state[self.devicetype].update(
+            {"rfpower": value, "time": time.perf_counter()}
+        )
+        if blocking:
+            simulation.wait(self.settings["opc"])
+
+    def get_intensity(self):
+        self.delay("get_intensity")
+        if simulation.fault(self.settings, self.rng, "malformed"):
+            raise ValueError("could not convert string to float: '1.23E-4,'")
+        return self.model.read()
+
+    def close(self):
+        self.delay("close")
+
+
+class TraceWriter:
+    # Rows are written to memory-mapped .npy chunks of roughly CHUNK_BYTES each
+    CHUNK_BYTES = 2**28
+
+    def __init__(self, filename, width):
+        self.filename = filename
+        self.width = width
+        self.chunkrows = max(1, self.CHUNK_BYTES // (8 * width))
+        self.rows = 0
+        self.chunk = None
+
+    def chunk_filename(self, index):
+        return f"{self.filename}_{index:04d}.npy"
+
+    def append(self, row):
+        index, position = divmod(self.rows, self.chunkrows)
+        if position == 0:
+            self.flush()
+            self.chunk = np.lib.format.open_memmap(
+                self.chunk_filename(index),
+                mode="w+",
+                dtype=np.float64,
+                shape=(self.chunkrows, self.width),
+            )
+        self.chunk[position] = row
+        self.rows += 1
+
+    def flush(self):
+        if self.chunk is not None:
+            self.chunk.flush()
+
+    def close(self):
+        if self.chunk is None:
+            return
+
+        # Trim the last chunk to the rows actually written
+        index, position = divmod(self.rows - 1, self.chunkrows)
+        self.flush()
+        last_rows = np.array(self.chunk[: position + 1])
+        self.chunk = None
+        np.save(self.chunk_filename(index), last_rows)
+
+
 class SCPIAttribute:
     def __init__(self, options=None, range_=None, readonly=False, novalue=False):
         self.readonly = readonly
@@ -156,6 +420,10 @@ class SCPIDevice:
         self.connection = None
         self.connection = rm.open_resource(visa_address, timeout=self.TIMEOUT)
 
+        # Raw sockets have no end indicator, responses are terminated by a newline
+        if visa_address.upper().endswith("::SOCKET"):
+            self.connection.read_termination = "\n"
+
     def check_errors(self):
         response = self.connection.query("SYST:ERR?")
         if int(response.split(",")[0]):
@@ -194,7 +462,54 @@ class SCPISynthesizer(Synthesizer, SCPIDevice):
         else:
             self.connection.write(f":OUTP:STATe {value}")
 
+    def prepare_list_sweep(self, frequencies, dwelltime):
+        # Each list step is signalled at the trigger output to the lock-in
+        factor = self.multiplication
+        self.set_values(
+            {
+                "SOUR:LIST:SEL": "'TRACE'",
+                "SOUR:LIST:FREQ": ",".join(
+                    f"{x * 1e6 / factor:.0f}" for x in frequencies
+                ),
+                "SOUR:LIST:POW": ",".join([str(self.power)] * len(frequencies)),
+                "SOUR:LIST:DWEL": f"{dwelltime}s",
+                "SOUR:LIST:MODE": "AUTO",
+                "SOUR:LIST:TRIG:SOUR": "SING",
+                "SOUR:FREQ:MODE": "LIST",
+            }
+        )
+
+    def start_list_sweep(self):
+        self.connection.write("SOUR:LIST:TRIG:EXEC")
+
+    def stop_list_sweep(self):
+        self.set_values({"SOUR:FREQ:MODE": "CW"})
+
+    def prepare_ramp_sweep(self, start, stop, duration, steps):
+        # Digital step sweep with small steps, direction is given by start and stop
+        factor = self.multiplication
+        self.set_values(
+            {
+                "SOUR:FREQ:STAR": f"{start / factor}MHz",
+                "SOUR:FREQ:STOP": f"{stop / factor}MHz",
+                "SOUR:SWE:FREQ:SPAC": "LIN",
+                "SOUR:SWE:FREQ:STEP:LIN": f"{abs(stop - start) / steps / factor}MHz",
+                "SOUR:SWE:FREQ:DWEL": f"{duration / steps}s",
+                "SOUR:SWE:FREQ:MODE": "AUTO",
+                "TRIG:FSW:SOUR": "SING",
+                "SOUR:FREQ:MODE": "SWE",
+            }
+        )
+
+    def start_ramp_sweep(self):
+        self.connection.write("SOUR:SWE:FREQ:EXEC")
+
+    def stop_ramp_sweep(self):
+        self.set_values({"SOUR:FREQ:MODE": "CW"})
+
     def prepare_measurement(self, dict_, devicetype):
+        self.power = dict_[f"{devicetype}_power"]
+
         if not dict_["static_skipreset"]:
             # Create repeatable default state
             self.connection.write("*RST")
@@ -312,6 +627,25 @@ class SCPISynthesizer(Synthesizer, SCPIDevice):
 
 
 class Agilent8257d(SCPISynthesizer, Synthesizer):
+    def prepare_ramp_sweep(self, start, stop, duration, steps):
+        # Analog ramp sweep
+        factor = self.multiplication
+        self.set_values(
+            {
+                "SOUR:FREQ:STAR": f"{min(start, stop) / factor}MHz",
+                "SOUR:FREQ:STOP": f"{max(start, stop) / factor}MHz",
+                "SOUR:SWE:GEN": "ANAL",
+                "SOUR:SWE:TIME": f"{duration}s",
+                "SOUR:SWE:DIR": "UP" if stop > start else "DOWN",
+                "TRIG:SOUR": "IMM",
+                "INIT:CONT": "OFF",
+                "SOUR:FREQ:MODE": "SWE",
+            }
+        )
+
+    def start_ramp_sweep(self):
+        self.connection.write("INIT")
+
     def prepare_measurement(self, dict_, devicetype):
         if not dict_["static_skipreset"]:
             # Create repeatable default state
@@ -385,6 +719,8 @@ class RSSMF100A(SCPISynthesizer, Synthesizer):
 
 class SignalRecovery7265(LockInAmplifier, SCPIDevice):
     EOL = ";"
+    # Streams are recorded into the curve buffer
+    STREAM_MAX_POINTS = LockInAmplifier.BUFFER_LENGTH
 
     SEN_OPTIONS = {
         18: "1mV",
@@ -490,28 +826,68 @@ class SignalRecovery7265(LockInAmplifier, SCPIDevice):
 
         return self.get_intensity()
 
-    def measure_intensity_dmdr_digital(self):
-        results = {}
-        for state in (0, 1):
-            self.pump.set_rfpower(state)
-            counterstart = time.perf_counter()
-
-            additional_delay_time = state * self["lockin_delaytime"]
-            while (
-                time.perf_counter() - counterstart
-                < self.timeconstant + additional_delay_time
-            ):
-                continue
-            results[state] = self.get_intensity()
-
-        x, y = results[0][0] - results[1][0], results[0][1] - results[1][1]
-        return (x, y)
-
     def get_intensity(self):
         tmp = self.connection.query("XY.?")
         x, y = [float(x.split("\n")[0]) for x in tmp.split(",")]
         return (x, y)
 
+    def prepare_buffer(self, points):
+        # Store X (bit 0) and Y (bit 1) in the curve buffer
+        self.connection.write("NC")
+        self.connection.write("CBD 3")
+        self.connection.write(f"LEN {points}")
+
+    def start_buffer(self):
+        # Store one point per trigger received at TRIG IN
+        self.connection.write("TDT 1")
+
+    def buffer_points(self):
+        response = self.connection.query("M")
+        return int(response.split(",")[3])
+
+    def read_buffer(self, points):
+        results = []
+        for curve in (0, 1):
+            self.connection.write(f"DCB {curve}")
+            raw = self.connection.read_bytes(2 * points)
+            # Binary curves are 16 bit integers with full scale at 10000
+            values = np.frombuffer(raw, dtype=">i2").astype(np.float64)
+            results.append(values * self.fullscale / 10000)
+        return results
+
+    def stream_interval_ms(self, rate):
+        # Internal storage interval in ms, 5 ms is the fastest interval for X and Y
+        return max(int(np.ceil(1000 / rate)), 5)
+
+    def stream_rate(self, rate):
+        return 1000 / self.stream_interval_ms(rate)
+
+    def start_stream(self, rate, duration):
+        interval = self.stream_interval_ms(rate)
+        points = min(int(duration * 1000 / interval) + 1, self.BUFFER_LENGTH)
+        self.stream_interval = interval / 1000
+        self.stream_points = points
+
+        self.prepare_buffer(points)
+        self.connection.write(f"STR {interval}")
+        self.connection.write("TD")
+
+    def read_stream(self):
+        points = self.stream_points
+        timeout = points * self.stream_interval + 5
+        timeout_start = time.perf_counter()
+        while self.buffer_points() < points:
+            time.sleep(0.1)
+
+            if time.perf_counter() - timeout_start > timeout:
+                raise DeviceError(
+                    "Timed out when waiting for the lock-in buffer to be filled."
+                )
+
+        xs, ys = self.read_buffer(points)
+        ts = np.arange(points) * self.stream_interval
+        return ts, xs, ys
+
     def prepare_measurement(self, dict_, devicetype):
         # Create repeatable default state
         # Problem is phase, which might get lost!
@@ -520,7 +896,11 @@ class SignalRecovery7265(LockInAmplifier, SCPIDevice):
         dict_ = dict_.copy()
 
         # Set special options
-        if dict_.get("general_mode") == "digital_dmdr":
+        # Blocked digital DMDR switches the pump in the measurement loop instead
+        if (
+            dict_.get("general_mode") == "digital_dmdr"
+            and dict_.get("general_dmblocksize", 1) == 1
+        ):
             dt = dict_["lockin_delaytime"] / 1000
             self.measure_intensity = (
                 lambda *args, dt=dt, **kwargs: self.measure_intensity_dmdr_digital(
@@ -529,14 +909,8 @@ class SignalRecovery7265(LockInAmplifier, SCPIDevice):
             )
 
         # Create format that is understood by lockin amplifier
-        self.timeconstant = float(
-            dict_["lockin_timeconstant"]
-            .replace("μs", "E-3")
-            .replace("ms", "")
-            .replace("ks", "E6")
-            .replace("s", "E3")
-        )
-        self.timeconstant /= 1000
+        self.timeconstant = parse_timeconstant(dict_["lockin_timeconstant"])
+        self.parse_fullscale(dict_["lockin_sensitivity"])
 
         for key, options in (
             ("lockin_timeconstant", self.TC_OPTIONS),
@@ -571,13 +945,24 @@ class SignalRecovery7265(LockInAmplifier, SCPIDevice):
                 }
             )
 
+        actual_freq = dict_["lockin_fmfrequency"]
+
+        # Further lock-in amplifiers of a group demodulate the pump modulation
+        if dict_.get("lockin_stage", 0) > 0:
+            startvalues.update(
+                {
+                    "REFN": 1,
+                }
+            )
+            actual_freq = 1000 / dict_["general_dmperiod"]
+
         # Set start values
         self.set_values(startvalues)
+        self.filterorder = startvalues["SLOPE"] + 1
 
         locked_freq = lambda self=self: float(
             self.connection.query("FRQ.?").split("\n")[0]
         )
-        actual_freq = dict_["lockin_fmfrequency"]
 
         timeout_start = time.perf_counter()
         while not abs(locked_freq() - actual_freq) / actual_freq < 0.01:
@@ -652,19 +1037,15 @@ class ZurichInstrumentsMFLI(LockInAmplifier):
         pass
 
     def prepare_measurement(self, dict_, devicetype):
-        self.timeconstant = float(
-            dict_["lockin_timeconstant"]
-            .replace("μs", "E-6")
-            .replace("ms", "E-3")
-            .replace("ks", "E3")
-            .replace("s", "")
-        )
-        self.timeconstant /= 1000
+        self.timeconstant = parse_timeconstant(dict_["lockin_timeconstant"])
+        tc = self.timeconstant
+        self.parse_fullscale(dict_["lockin_sensitivity"])
+        self.filterorder = 1
 
         # External 10 MHz reference
         self.daq.setInt("/dev4055/system/extclk", 1)
 
-        if dict_["general_mode"] == "classic":
+        if dict_["general_mode"] in ("classic", "fastsweep"):
             self.daq.setInt("/dev4055/demods/0/enable", 1)
             self.daq.setInt("/dev4055/demods/1/enable", 1)
 
@@ -686,6 +1067,13 @@ class ZurichInstrumentsMFLI(LockInAmplifier):
 
             self.daq.setDouble("/dev4055/demods/0/timeconstant", tc)
 
+        self.demods = [0]
+        if dict_["general_mode"] in ("dmdr", "dmdr_am"):
+            self.prepare_cascaded_demodulation(tc)
+
+        if dict_.get("lockin_acquisition") == "software":
+            self.prepare_software_demodulation(dict_)
+
         # @Luis: Remove after time signal testing
         if TIMESINGAL:
             self.measure_intensity = self.measure_intensity_ts
@@ -693,16 +1081,11 @@ class ZurichInstrumentsMFLI(LockInAmplifier):
             self.duration = tc
             self.rate = 15e6
             ts, ys = self.get_signal(self.rate, self.duration, timeoffset=False)
-            self.data = np.zeros((1000, len(ts) + 1))
-            self.data[0, 1:] = ts
-            self.i = 1
-            self.tmp_dict = dict_
-
-    def get_signal(
-        self, samplefrequency, duration, records=1, timeout=2, timeoffset=True
-    ):
-        sco = self.daq.scopeModule()
+            amp = dict_["lockin_fmdeviation"]
+            self.data = TraceWriter(os.path.join("..", f"fmamp_{amp:.0f}"), len(ts) + 1)
+            self.data.append(np.concatenate(((np.nan,), ts)))
 
+    def scope_settings(self, samplefrequency, duration):
         sti = int(-np.log2(samplefrequency / 60e6))
         samplefrequency = 60e6 / 2**sti
         if sti < 0:
@@ -716,6 +1099,12 @@ class ZurichInstrumentsMFLI(LockInAmplifier):
         elif points > 5.12e6:
             raise ValueError("Recorded points cannot be more than 5120000")
 
+        return sti, points
+
+    def open_scope(self, sti, points):
+        self.close_scope()
+        sco = self.daq.scopeModule()
+
         # Set sample frequency
         self.daq.setInt("/dev4055/scopes/0/time", sti)
 
@@ -738,17 +1127,41 @@ class ZurichInstrumentsMFLI(LockInAmplifier):
         self.daq.setInt("/dev4055/scopes/0/single", 1)
 
         sco.subscribe("/dev4055/scopes/0/wave")
-        self.daq.setInt("/dev4055/scopes/0/enable", 1)
         self.daq.sync()
 
+        self.scope = {
+            "module": sco,
+            "key": (sti, points),
+            "clockbase": self.daq.getInt("/dev4055/clockbase"),
+        }
+
+    def close_scope(self):
+        scope = getattr(self, "scope", None)
+        if scope:
+            scope["module"].unsubscribe("*")
+            scope["module"].clear()
+        self.scope = None
+
+    def get_signal(
+        self, samplefrequency, duration, records=1, timeout=2, timeoffset=True
+    ):
+        # The scope is configured once and reused as long as the settings do not change
+        key = self.scope_settings(samplefrequency, duration)
+        if not getattr(self, "scope", None) or self.scope["key"] != key:
+            self.open_scope(*key)
+        sco = self.scope["module"]
+
+        self.daq.setInt("/dev4055/scopes/0/single", 1)
+        self.daq.setInt("/dev4055/scopes/0/enable", 1)
         sco.execute()
 
         progress = 0
         c_record = 0
         st = time.perf_counter()
+        interval = min(0.1, duration / 10)
 
         while (c_record < records) or (progress < 1.0):
-            time.sleep(0.1)
+            time.sleep(interval)
             c_record = sco.getInt("records")
             progress = sco.progress()[0]
             if (time.perf_counter() - st) > timeout:
@@ -768,7 +1181,7 @@ class ZurichInstrumentsMFLI(LockInAmplifier):
         # Time offset
         timestamp = record[0]["timestamp"]
         triggertimestamp = record[0]["triggertimestamp"]
-        clockbase = self.daq.getInt(f"/dev4055/clockbase")
+        clockbase = self.scope["clockbase"]
         time_offset = triggertimestamp / clockbase
 
         ts = np.arange(0, totalsamples) * dt
@@ -780,11 +1193,97 @@ class ZurichInstrumentsMFLI(LockInAmplifier):
         ]
         return result
 
+    def prepare_cascaded_demodulation(self, tc):
+        # Demod 0 demodulates the probe FM (2f), its X output is passed via
+        # Aux Out 1 to Aux In 1, where demod 1 demodulates the pump modulation
+        self.daq.setInt("/dev4055/extrefs/0/enable", 1)
+        self.daq.setInt("/dev4055/demods/0/enable", 1)
+        self.daq.setInt("/dev4055/demods/0/oscselect", 0)
+        self.daq.setDouble("/dev4055/demods/0/harmonic", 2)
+        self.daq.setInt("/dev4055/demods/0/order", 1)
+        self.daq.setDouble("/dev4055/demods/0/timeconstant", tc)
+
+        self.daq.setInt("/dev4055/auxouts/0/outputselect", 0)
+        self.daq.setInt("/dev4055/auxouts/0/demodselect", 0)
+
+        self.daq.setInt("/dev4055/extrefs/1/enable", 1)
+        self.daq.setInt("/dev4055/demods/1/enable", 1)
+        self.daq.setInt("/dev4055/demods/1/adcselect", 8)
+        self.daq.setInt("/dev4055/demods/1/oscselect", 1)
+        self.daq.setDouble("/dev4055/demods/1/harmonic", 1)
+        self.daq.setInt("/dev4055/demods/1/order", 1)
+        self.daq.setDouble("/dev4055/demods/1/timeconstant", tc)
+
+        # The difference spectrum is the main channel
+        self.demods = [1, 0]
+        self.channels = ("signal", "probe")
+        for demod in self.demods:
+            self.daq.subscribe(f"/dev4055/demods/{demod}/sample")
+        self.daq.sync()
+
+    def prepare_software_demodulation(self, dict_):
+        channels = demodulation.get_channels(dict_)
+        self.channels = [name for name, frequency in channels]
+
+        # Lowest sample rate with ten samples per period of the fastest channel
+        max_frequency = max(frequency for name, frequency in channels)
+        sti = 0
+        while sti < 16 and 60e6 / 2 ** (sti + 1) >= 10 * max_frequency:
+            sti += 1
+        self.rate = 60e6 / 2**sti
+        self.duration = min(
+            max(self.timeconstant, 4096 / self.rate), 5.12e6 / self.rate
+        )
+
+        points = int(self.rate * self.duration)
+        self.demodulator = demodulation.Demodulator(
+            channels, self.rate, points, self.timeconstant
+        )
+        self.measure_intensity = self.measure_intensity_software
+
+    def measure_intensity_software(self):
+        ts, ys = self.get_signal(self.rate, self.duration)
+        return self.demodulator.submit(ts[0], ys)
+
     def get_intensity(self):
+        if len(self.demods) > 1:
+            return self.get_intensities()
+
         sample = self.daq.getSample("/dev4055/demods/0/sample")
         x, y = sample["x"][0], sample["y"][0]
         return (x, y)
 
+    def get_intensities(self):
+        # A single poll returns the samples of all subscribed demodulators
+        values = {}
+        timeout_start = time.perf_counter()
+        while len(values) < len(self.demods):
+            data = self.daq.poll(0.001, 100, 0, True)
+            for demod in self.demods:
+                sample = data.get(f"/dev4055/demods/{demod}/sample")
+                if sample is not None and len(sample["x"]):
+                    values[demod] = (sample["x"][-1], sample["y"][-1])
+
+            if time.perf_counter() - timeout_start > 5:
+                raise DeviceError("Timed out when reading the demodulator samples.")
+
+        return tuple(value for demod in self.demods for value in values[demod])
+
+    def start_stream(self, rate, duration):
+        self.daq.setDouble("/dev4055/demods/0/rate", rate)
+        self.daq.subscribe("/dev4055/demods/0/sample")
+        self.daq.sync()
+        self.stream_duration = duration
+
+    def read_stream(self):
+        data = self.daq.poll(self.stream_duration, 500, 0, True)
+        self.daq.unsubscribe("/dev4055/demods/0/sample")
+
+        sample = data["/dev4055/demods/0/sample"]
+        clockbase = self.daq.getInt("/dev4055/clockbase")
+        ts = (sample["timestamp"] - sample["timestamp"][0]) / clockbase
+        return ts, sample["x"], sample["y"]
+
     def measure_intensity(self):
         counterstart = time.perf_counter()
         while time.perf_counter() - counterstart < self.timeconstant:
@@ -795,21 +1294,80 @@ class ZurichInstrumentsMFLI(LockInAmplifier):
     # @Luis: Remove after time signal testing
     def measure_intensity_ts(self):
         ts, ys = self.get_signal(self.rate, self.duration)
-        self.data[self.i, 0] = ts[0]
-        self.data[self.i, 1:] = ys
-        self.i += 1
+        self.data.append(np.concatenate(((ts[0],), ys)))
         res = self.get_intensity()
 
         return res
 
     def close(self):
+        if getattr(self, "demodulator", None):
+            self.demodulator.close()
+        self.close_scope()
+        if len(getattr(self, "demods", ())) > 1:
+            self.daq.unsubscribe("*")
         self.daq.disconnect()
 
     # @Luis: Remove after time signal testing
     def close_ts(self):
+        self.close_scope()
         self.daq.disconnect()
-        amp = self.tmp_dict["lockin_fmdeviation"]
-        np.save(f"..\\fmamp_{amp:.0f}.npy", self.data[: self.i])
+        self.data.close()
+
+
+def parse_timeconstant(value):
+    # Time constant strings like "100ms" in seconds
+    return float(
+        value.replace("μs", "E-6")
+        .replace("ms", "E-3")
+        .replace("ks", "E3")
+        .replace("s", "")
+    )
+
+
+class LockInGroup:
+    # Several lock-in amplifiers that are read concurrently as one device
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.pool = futures.ThreadPoolExecutor(max_workers=len(devices))
+        self.skew = 0
+
+    def __getattr__(self, name):
+        return getattr(self.devices[0], name)
+
+    def prepare_measurement(self, dict_, devicetype):
+        for i, device in enumerate(self.devices):
+            tmp_dict = dict(dict_)
+            tmp_dict["lockin_stage"] = i
+            device.prepare_measurement(tmp_dict, devicetype)
+
+        channels = list(self.devices[0].channels)
+        for i, device in enumerate(self.devices[1:], 1):
+            channels.extend(f"{channel}{i}" for channel in device.channels)
+        self.channels = tuple(channels)
+        self.timeconstant = max(device.timeconstant for device in self.devices)
+
+    def read_device(self, device):
+        return time.perf_counter(), device.get_intensity()
+
+    def get_intensity(self):
+        results = list(self.pool.map(self.read_device, self.devices))
+
+        timestamps = [timestamp for timestamp, values in results]
+        self.skew = max(self.skew, max(timestamps) - min(timestamps))
+        return tuple(value for timestamp, values in results for value in values)
+
+    def measure_intensity(self):
+        counterstart = time.perf_counter()
+        while time.perf_counter() - counterstart < self.timeconstant:
+            continue
+
+        return self.get_intensity()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for device in self.devices:
+            device.close()
 
 
 def connect(mdict, devicetype):
@@ -818,7 +1376,12 @@ def connect(mdict, devicetype):
     deviceclass = deviceclasses[devicetype][devicename]
 
     if devicetype == "lockin":
-        device = deviceclass(deviceaddress)
+        # Multiple addresses are read as a group of lock-in amplifiers
+        addresses = [x.strip() for x in deviceaddress.split(",")]
+        if len(addresses) > 1:
+            device = LockInGroup([deviceclass(address) for address in addresses])
+        else:
+            device = deviceclass(deviceaddress)
     elif devicetype in ["probe", "pump"]:
         multiplication = mdict[f"static_{devicetype}multiplication"]
         device = deviceclass(deviceaddress, multiplication=multiplication)
@@ -827,13 +1390,211 @@ def connect(mdict, devicetype):
     return device
 
 
+## Capabilities drivers can declare
+capabilities = {
+    "list_sweep": "Steps through a frequency list and triggers the lock-in for each step",
+    "ramp_sweep": "Sweeps continuously between two frequencies",
+    "buffered": "Stores triggered readings in an internal buffer",
+    "stream": "Records timestamped samples at a fixed rate",
+    "timesignal": "Records the raw detector signal for software demodulation",
+    "multichannel": "Demodulates several references at once",
+}
+
+
+class Driver:
+    # Declaration of a device driver, the class is only imported when it is selected.
+    # Other packages declare drivers as entry points in the group 'traces.drivers'.
+
+    def __init__(self, name, target, types, capabilities=()):
+        self.name = name
+        self.target = target
+        self.types = tuple(types)
+        self.capabilities = frozenset(capabilities)
+        self.class_ = None
+
+    def load(self):
+        if self.class_ is None:
+            module, _, attribute = self.target.partition(":")
+            self.class_ = getattr(importlib.import_module(module), attribute)
+        return self.class_
+
+    def supports(self, *capabilities):
+        return self.capabilities.issuperset(capabilities)
+
+
+class Mode:
+    # Declaration of a measurement mode with the acquisitions it allows and the
+    # capabilities it needs per device. Other packages declare modes as entry points
+    # in the group 'traces.modes', the devices have to implement them.
+    # Groups of lock-in amplifiers are only read where further lock-ins demodulate
+    # the pump modulation.
+
+    def __init__(
+        self,
+        name,
+        probeonly=False,
+        acquisitions=("point", "buffered", "software", "auto"),
+        requires=None,
+        lockingroups=False,
+    ):
+        self.name = name
+        self.probeonly = probeonly
+        self.acquisitions = tuple(acquisitions)
+        self.requires = requires or {}
+        self.lockingroups = lockingroups
+
+
+drivers = {}
+measurementmodes = {}
+
+
+def register_driver(driver):
+    drivers[driver.name] = driver
+
+
+def register_mode(mode):
+    measurementmodes[mode.name] = mode
+
+
+def load_plugins():
+    try:
+        from importlib import metadata
+    except ImportError:
+        return
+
+    groups = (("traces.drivers", register_driver), ("traces.modes", register_mode))
+    entry_points = metadata.entry_points()
+    for group, register in groups:
+        if hasattr(entry_points, "select"):
+            selected = entry_points.select(group=group)
+        else:
+            selected = entry_points.get(group, [])
+
+        for entry_point in selected:
+            try:
+                register(entry_point.load())
+            except Exception as E:
+                sys.stderr.write(
+                    f"Could not load the plugin '{entry_point.name}' from '{group}': {E}\n"
+                )
+
+
+class DeviceClasses(Mapping):
+    # Names of the drivers for one device type, the classes are loaded on access
+
+    def __init__(self, type_):
+        self.type_ = type_
+
+    def names(self):
+        return [name for name, x in drivers.items() if self.type_ in x.types]
+
+    def __getitem__(self, name):
+        driver = drivers.get(name)
+        if driver is None or self.type_ not in driver.types:
+            raise KeyError(name)
+        return driver.load()
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.names())
+
+
+def driver_supports(devicename, *capabilities):
+    driver = drivers.get(devicename)
+    return bool(driver) and driver.supports(*capabilities)
+
+
+def fastest_acquisition(mode, probedevice, lockindevice, n_lockins=1):
+    # Buffered acquisition removes the communication per point, if all devices support it
+    mode = measurementmodes[mode]
+    if (
+        "buffered" in mode.acquisitions
+        and n_lockins == 1
+        and driver_supports(probedevice, "list_sweep")
+        and driver_supports(lockindevice, "buffered")
+    ):
+        return "buffered"
+    return "point"
+
+
+for driver in (
+    Driver(
+        "MockDevice",
+        f"{__name__}:MockDevice",
+        ("synthesizer", "lockin"),
+        ("list_sweep", "ramp_sweep", "buffered", "stream"),
+    ),
+    Driver("SimulatedDevice", f"{__name__}:SimulatedDevice", ("synthesizer", "lockin")),
+    Driver(
+        "SCPISynthesizer",
+        f"{__name__}:SCPISynthesizer",
+        ("synthesizer",),
+        ("list_sweep", "ramp_sweep"),
+    ),
+    Driver(
+        "Agilent8257d",
+        f"{__name__}:Agilent8257d",
+        ("synthesizer",),
+        ("ramp_sweep",),
+    ),
+    Driver(
+        "RSSMF100A",
+        f"{__name__}:RSSMF100A",
+        ("synthesizer",),
+        ("list_sweep", "ramp_sweep"),
+    ),
+    Driver(
+        "SignalRecovery7265",
+        f"{__name__}:SignalRecovery7265",
+        ("lockin",),
+        ("buffered", "stream"),
+    ),
+    Driver(
+        "SignalRecovery7270",
+        f"{__name__}:SignalRecovery7270",
+        ("lockin",),
+        ("buffered", "stream"),
+    ),
+    Driver(
+        "ZurichInstrumentsMFLI",
+        f"{__name__}:ZurichInstrumentsMFLI",
+        ("lockin",),
+        ("stream", "timesignal", "multichannel"),
+    ),
+):
+    register_driver(driver)
+
+for mode in (
+    Mode("classic", probeonly=True),
+    Mode("dr"),
+    Mode("dmdr", lockingroups=True),
+    Mode("dmdr_am"),
+    Mode("dr_pufm"),
+    Mode("tandem"),
+    Mode("digital_dmdr", acquisitions=("point",)),
+    Mode(
+        "fastsweep",
+        probeonly=True,
+        acquisitions=("point",),
+        requires={"probe": ("ramp_sweep",), "lockin": ("stream",)},
+    ),
+):
+    register_mode(mode)
+
+load_plugins()
+
 deviceclasses = {
-    "probe": {cls.__name__: cls for cls in Synthesizer.__subclasses__()},
-    "pump": {cls.__name__: cls for cls in Synthesizer.__subclasses__()},
-    "lockin": {cls.__name__: cls for cls in LockInAmplifier.__subclasses__()},
+    "probe": DeviceClasses("synthesizer"),
+    "pump": DeviceClasses("synthesizer"),
+    "lockin": DeviceClasses("lockin"),
 }
 
-modes = ("classic", "dr", "dmdr", "dmdr_am", "dr_pufm", "tandem", "digital_dmdr")
+modes = tuple(measurementmodes)
+probeonly_modes = tuple(name for name, x in measurementmodes.items() if x.probeonly)
+settlemodes = ("fixed", "adaptive")
+acquisitionmodes = ("point", "buffered", "software", "auto")
 
 if __name__ == "__main__":
     # import matplotlib.pyplot as plt
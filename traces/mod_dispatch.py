@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import websockets
+from collections import deque
+
+from . import mod_experiment as experiment
+from . import mod_run as run
+
+## Seconds between two connection attempts to a server that is not reachable
+RECONNECT = 2
+
+## Attempts of a measurement after device errors or lost servers
+RETRIES = 2
+
+
+class DispatchError(Exception):
+    pass
+
+
+class Server:
+    # Experiment server, or one setup of it, and the work it is running
+    def __init__(self, address, setup=None, capabilities=(), frequencies=None):
+        self.address = address
+        self.setup = setup
+        self.capabilities = set(capabilities)
+        self.frequencies = frequencies
+
+        self.websocket = None
+        self.state = None
+        self.queue_length = 0
+        self.work = None
+        self.finished = 0
+
+    @property
+    def name(self):
+        return f"{self.address}/{self.setup}" if self.setup else self.address
+
+    @property
+    def idle(self):
+        return (
+            self.websocket is not None
+            and self.work is None
+            and self.state == "waiting"
+            and not self.queue_length
+        )
+
+    def accepts(self, work):
+        if not work.requires <= self.capabilities:
+            return False
+        if self.frequencies and work.frequencies:
+            low, high = self.frequencies
+            return low <= work.frequencies[0] and work.frequencies[1] <= high
+        return True
+
+
+class Work:
+    # Measurement of the global queue with the requirements for its server
+    def __init__(self, index, measurement, requires=()):
+        self.index = index
+        self.measurement = measurement
+        self.requires = set(requires)
+        frequencies = measurement["probe_frequency"].frequencies()
+        self.frequencies = (frequencies.min(), frequencies.max())
+
+        self.status = "queued"
+        self.server = None
+        self.attempts = 0
+        self.started = False
+        self.aborted = False
+        self.errors = []
+        self.start = None
+        self.duration = None
+
+
+def parse_list(value):
+    if isinstance(value, str):
+        value = value.split(",")
+    return [x.strip() for x in value if x.strip()]
+
+
+def parse_server(spec):
+    # e.g. "localhost:8113;setup=b;capabilities=stream,cryo;frequencies=60000-120000"
+    address, *items = spec.split(";")
+    kwargs = {}
+    for item in items:
+        if not item.strip():
+            continue
+        key, _, value = item.partition("=")
+        key, value = key.strip(), value.strip()
+        if key == "setup":
+            kwargs["setup"] = value
+        elif key == "capabilities":
+            kwargs["capabilities"] = parse_list(value)
+        elif key == "frequencies":
+            try:
+                low, high = (float(x) for x in value.split("-"))
+            except ValueError:
+                raise DispatchError(
+                    f"The frequency range '{value}' of the server '{address}' is not understood, please use e.g. 'frequencies=60000-120000'."
+                )
+            kwargs["frequencies"] = (low, high)
+        else:
+            raise DispatchError(
+                f"The server option '{key}' is not understood, please use 'setup', 'capabilities' or 'frequencies'."
+            )
+    return Server(address.strip(), **kwargs)
+
+
+def load_works(dicts):
+    # The requirements are only known to the dispatcher, the servers never see them
+    works = []
+    for i, dict_ in enumerate(dicts):
+        requires = parse_list(dict_.pop("dispatch_requires", ""))
+        works.append(Work(i + 1, experiment.Measurement(dict_), requires))
+    return works
+
+
+class Dispatcher:
+    def __init__(self, servers, works, retries=RETRIES, on_deviceerror="stop"):
+        self.servers = servers
+        self.works = works
+        self.retries = retries
+        self.on_deviceerror = on_deviceerror
+        self.queue = deque()
+        self.done = None
+
+        for work in works:
+            if any(server.accepts(work) for server in servers):
+                self.queue.append(work)
+            else:
+                self.fail(work, "No server provides the required capabilities.")
+
+    @property
+    def total(self):
+        return len(self.works)
+
+    def print(self, work, message):
+        print(f"[{work.index}/{self.total}] {message}")
+
+    def fail(self, work, error):
+        work.errors.append(error)
+        self.complete(work, "failed")
+
+    def complete(self, work, status):
+        work.status = status
+        if work.server:
+            work.server.work = None
+        message = status.capitalize()
+        if work.server:
+            message += f" on {work.server.name}"
+        if status == "failed" and work.errors:
+            message += f": {work.errors[-1].strip().splitlines()[-1]}"
+        self.print(work, message)
+
+        if self.done and all(x.status not in ("queued", "running") for x in self.works):
+            self.done.set()
+
+    def requeue(self, work, reason):
+        server, work.server = work.server, None
+        if server:
+            server.work = None
+        work.attempts += 1
+        if work.attempts > self.retries:
+            work.server = server
+            self.fail(work, reason)
+            return
+
+        work.status = "queued"
+        work.started = work.aborted = False
+        work.errors = []
+        self.queue.appendleft(work)
+        self.print(work, f"Requeued ({reason})")
+
+    async def send(self, server, dict_):
+        if server.setup:
+            dict_ = {**dict_, "setup": server.setup}
+        await server.websocket.send(json.dumps(dict_))
+
+    async def dispatch(self, server):
+        if not server.idle:
+            return
+
+        for work in self.queue:
+            if server.accepts(work):
+                break
+        else:
+            return
+
+        self.queue.remove(work)
+        work.status = "running"
+        work.server = server
+        work.start = time.perf_counter()
+        server.work = work
+        await self.send(
+            server, {"action": "add_measurement_last", "measurement": work.measurement}
+        )
+        self.print(work, f"Sent to {server.name}")
+
+    async def handle(self, server, message):
+        # Servers running several setups label their broadcasts with the setup
+        if server.setup and message.get("setup", server.setup) != server.setup:
+            return
+
+        action = message.get("action")
+        work = server.work
+
+        if action == "queue":
+            server.queue_length = len(message["data"])
+
+        elif action == "state":
+            server.state = message["state"]
+            if not work:
+                pass
+            elif server.state == "running":
+                work.started = True
+            elif server.state == "aborting":
+                work.aborted = True
+            elif server.state == "deviceerror":
+                self.requeue(work, f"device error on {server.name}")
+                if self.on_deviceerror == "continue":
+                    await self.send(server, {"action": "state", "state": "running"})
+            elif server.state == "waiting" and work.started:
+                work.duration = time.perf_counter() - work.start
+                if work.errors:
+                    self.complete(work, "failed")
+                elif work.aborted:
+                    self.complete(work, "aborted")
+                else:
+                    server.finished += 1
+                    self.complete(work, "finished")
+
+        elif action in ("error", "uerror") and work:
+            # Pressure readings fail without failing the measurement
+            if message["error"].startswith("Could not read pressure"):
+                return
+            work.errors.append(message["error"])
+            # The measurement was rejected before it reached the queue
+            if not work.started:
+                self.complete(work, "failed")
+
+    async def serve(self, server):
+        url = f"ws://{server.address}"
+        while not self.done.is_set():
+            try:
+                async with websockets.connect(url, max_size=None) as websocket:
+                    server.websocket = websocket
+                    print(f"Connected to {server.name}")
+                    if server.setup:
+                        await self.send(server, {"action": "setup"})
+
+                    async for message in websocket:
+                        await self.handle(server, json.loads(message))
+                        for server_ in self.servers:
+                            await self.dispatch(server_)
+                        if self.done.is_set():
+                            break
+
+            except (OSError, websockets.WebSocketException) as E:
+                if server.websocket:
+                    print(f"Lost the connection to {server.name}: {E!r}")
+            finally:
+                server.websocket = None
+                server.state = None
+
+            # The work might still finish on the server, but it cannot be followed anymore
+            if server.work:
+                self.requeue(server.work, f"lost connection to {server.name}")
+                for server_ in self.servers:
+                    await self.dispatch(server_)
+
+            if not self.done.is_set():
+                await asyncio.sleep(RECONNECT)
+
+    async def run(self):
+        self.done = asyncio.Event()
+        if not self.queue:
+            self.done.set()
+
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(self.serve(server)) for server in self.servers]
+        await self.done.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return time.perf_counter() - start
+
+
+def summary(dispatcher, wall):
+    works = dispatcher.works
+    counts = {
+        status: sum(x.status == status for x in works)
+        for status in ("finished", "aborted", "failed", "queued", "running")
+    }
+    return {
+        "measurements": dispatcher.total,
+        "finished": counts["finished"],
+        "aborted": counts["aborted"],
+        "failed": counts["failed"],
+        "skipped": counts["queued"] + counts["running"],
+        "wall": wall,
+        "servers": {server.name: server.finished for server in dispatcher.servers},
+        "results": [
+            {
+                "measurement": x.index,
+                "status": x.status,
+                "server": x.server.name if x.server else None,
+                "attempts": x.attempts + 1,
+                "duration": x.duration,
+                "errors": x.errors,
+            }
+            for x in works
+        ],
+    }
+
+
+def start():
+    parser = argparse.ArgumentParser(
+        prog="trace_dispatch",
+        description="Distribute measurements across several experiment servers",
+    )
+    parser.add_argument(
+        "files", nargs="+", help="Queue files (.queue) or measurement files (.meas)"
+    )
+    parser.add_argument(
+        "--server",
+        action="append",
+        required=True,
+        help="Server as 'host:port' with the optional options ';setup=name', ';capabilities=a,b' and ';frequencies=low-high', can be given multiple times",
+    )
+    parser.add_argument(
+        "--table",
+        help="CSV (or TSV) table, every row overrides the values of the single measurement given",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=RETRIES,
+        help="Attempts of a measurement after device errors or lost servers",
+    )
+    parser.add_argument(
+        "--on-device-error",
+        choices=("stop", "continue"),
+        default="stop",
+        help="Leave a server with a device error until it is confirmed there or continue with the next measurement",
+    )
+    parser.add_argument("--output", help="JSON file the summary is written to")
+    args = parser.parse_args()
+
+    try:
+        servers = [parse_server(x) for x in args.server]
+        dicts = run.load_measurements(args.files, args.table)
+        works = load_works(dicts)
+    except (
+        DispatchError,
+        run.BatchError,
+        OSError,
+        ValueError,
+        experiment.CustomError,
+        experiment.CustomValueError,
+    ) as E:
+        print(f"Could not load the measurements: {E}")
+        sys.exit(2)
+
+    dispatcher = Dispatcher(servers, works, args.retries, args.on_device_error)
+    try:
+        wall = asyncio.run(dispatcher.run())
+    except KeyboardInterrupt:
+        print("Stopped dispatching, the measurements sent to the servers keep running.")
+        sys.exit(1)
+    results = summary(dispatcher, wall)
+
+    print(
+        f"{results['finished']} of {results['measurements']} measurements finished, "
+        f"{results['aborted']} aborted, {results['failed']} failed in {wall:.1f} s."
+    )
+    for name, finished in results["servers"].items():
+        print(f"  {name}: {finished} measurements")
+
+    if args.output:
+        with open(args.output, "w+", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    sys.exit(0 if results["finished"] == results["measurements"] else 1)
+
+
+if __name__ == "__main__":
+    start()
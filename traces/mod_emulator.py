@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import re
+import time
+import argparse
+import threading
+import socketserver
+import numpy as np
+from collections import deque
+
+from . import mod_devices as devices
+from . import mod_simulation as simulation
+
+URL = "localhost"
+
+## Frequency units in MHz
+frequency_units = {
+    "HZ": 1e-6,
+    "KHZ": 1e-3,
+    "MHZ": 1,
+    "GHZ": 1e3,
+}
+
+
+def parse_frequency(value, default_unit="MHZ"):
+    match = re.fullmatch(r"\s*([-+\d.eE]+)\s*([a-zA-Z]*)\s*", value)
+    if not match:
+        raise ValueError(f"Could not parse the frequency '{value}'.")
+    number, unit = match.groups()
+    return float(number) * frequency_units[unit.upper() or default_unit]
+
+
+class EmulatedInstrument:
+    # Command parser shared by the emulated instruments, unknown setters are stored
+    # and can be read back by appending '?'
+
+    SEPARATORS = "\n"
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.rng = np.random.default_rng(int(settings["seed"]))
+        self.values = {}
+        self.errors = deque()
+        self.lock = threading.Lock()
+
+        self.commands = {
+            "*OPC?": self.opc,
+            "*RST": self.reset,
+            "*IDN?": lambda argument: type(self).__name__,
+            "SYST:ERR?": self.error,
+        }
+
+    def split(self, message):
+        commands = [message]
+        for separator in self.SEPARATORS:
+            commands = [y for x in commands for y in x.split(separator)]
+        return [x.strip() for x in commands if x.strip()]
+
+    def process(self, message):
+        responses = []
+        with self.lock:
+            for command in self.split(message):
+                response = self.process_command(command)
+                if response is not None:
+                    responses.append(response)
+        return responses
+
+    def process_command(self, command):
+        header, _, argument = command.partition(" ")
+        header = header.upper()
+        name = re.sub(r"\W+", "_", header).strip("_").lower()
+        settings, rng = self.settings, self.rng
+        simulation.wait(
+            simulation.latency(settings, rng, name) + simulation.spike(settings, rng)
+        )
+
+        query = header.endswith("?")
+        # Injected faults: queries are dropped (the client times out), other commands fail
+        if query and simulation.fault(settings, rng, "drops"):
+            return None
+        if not query and simulation.fault(settings, rng, "errors"):
+            self.errors.append('-113,"Undefined header"')
+            return None
+
+        handler = self.commands.get(header)
+        if handler:
+            response = handler(argument.strip())
+            # Truncated text responses
+            if isinstance(response, str) and simulation.fault(
+                settings, rng, "malformed"
+            ):
+                response = response[: len(response) // 2]
+            return response
+        elif query:
+            key = header[:-1]
+            if key not in self.values:
+                self.errors.append('-113,"Undefined header"')
+                return None
+            return self.values[key]
+        else:
+            self.values[header] = argument.strip()
+            return None
+
+    def opc(self, argument):
+        simulation.wait(self.settings["opc"])
+        return "1"
+
+    def reset(self, argument):
+        self.values.clear()
+
+    def error(self, argument):
+        if self.errors:
+            return self.errors.popleft()
+        return '0,"No error"'
+
+
+class EmulatedSynthesizer(EmulatedInstrument):
+    # Commands sent by SCPISynthesizer, RSSMF100A and Agilent8257d
+
+    SEPARATORS = "\n;"
+
+    def __init__(self, settings, role):
+        super().__init__(settings)
+        self.role = role
+        self.multiplication = settings.get("multiplication", 1)
+        simulation.state[role] = {
+            "frequency": None,
+            "time": time.perf_counter(),
+            "rfpower": 0,
+        }
+
+        self.commands.update(
+            {
+                "FREQ:CW": self.set_frequency,
+                "FREQ:CW?": self.get_frequency,
+                ":OUTP:STATE": self.set_rfpower,
+                "SOUR:LIST:FREQ": self.set_list,
+                "SOUR:LIST:DWEL": self.set_dwelltime,
+                "SOUR:LIST:TRIG:EXEC": self.start_list,
+                "SOUR:LFO1:FREQ": self.set_modulation,
+                "SOUR:FM1:INT:FREQ": self.set_modulation,
+                "SOUR:FM1:DEV": self.set_deviation,
+                "SOUR:FM1": self.set_deviation,
+            }
+        )
+
+    @property
+    def state(self):
+        return simulation.state[self.role]
+
+    def set_frequency(self, argument):
+        frequency = parse_frequency(argument) * self.multiplication
+        self.state.update({"frequency": frequency, "time": time.perf_counter()})
+
+    def get_frequency(self, argument):
+        return f"{self.state['frequency'] / self.multiplication * 1e6:.0f}"
+
+    def set_rfpower(self, argument):
+        self.state.update({"rfpower": int(argument), "time": time.perf_counter()})
+
+    def set_list(self, argument):
+        self.state["list"] = [
+            float(x) * 1e-6 * self.multiplication for x in argument.split(",")
+        ]
+
+    def set_dwelltime(self, argument):
+        self.state["dwelltime"] = float(argument.rstrip("sS"))
+
+    def start_list(self, argument):
+        self.state["list_start"] = time.perf_counter()
+
+    def set_modulation(self, argument):
+        self.state["modulation"] = parse_frequency(argument) * 1e6
+
+    def set_deviation(self, argument):
+        self.state["deviation"] = parse_frequency(argument, "HZ") * self.multiplication
+
+
+class EmulatedSignalRecovery7265(EmulatedInstrument):
+    # Commands sent by SignalRecovery7265
+
+    SEPARATORS = "\n;"
+    DEVICE = devices.SignalRecovery7265
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.model = simulation.LockInModel(settings, self.rng)
+        self.values.update({"TC": "6", "SEN": "26", "SLOPE": "0", "REFN": "2"})
+        self.buffer_length = 0
+        self.buffer_start = None
+        self.buffer_read = 0
+        self.curves = None
+        self.buffer_triggered = False
+        self.buffer_interval = 0.005
+
+        self.commands.update(
+            {
+                "XY.?": self.get_intensity,
+                "FRQ.?": self.get_reference,
+                "NC": self.clear_buffer,
+                "LEN": self.set_buffer_length,
+                "STR": self.set_buffer_interval,
+                "TD": lambda argument: self.start_buffer(False),
+                "TDT": lambda argument: self.start_buffer(True),
+                "M": self.get_buffer_status,
+                "DCB": self.get_buffer,
+            }
+        )
+
+    def configure(self):
+        timeconstant = devices.parse_timeconstant(
+            self.DEVICE.TC_OPTIONS[int(self.values["TC"])]
+        )
+        fullscale = float(
+            self.DEVICE.SEN_OPTIONS[int(self.values["SEN"])]
+            .replace("mV", "E-3")
+            .replace("V", "")
+        )
+        filterorder = int(self.values["SLOPE"]) + 1
+        deviation = simulation.state.get("probe", {}).get("deviation", 0)
+        self.model.configure(
+            timeconstant,
+            self.DEVICE.SETTLE_FACTORS[filterorder],
+            fullscale,
+            deviation,
+        )
+
+    def process_command(self, command):
+        response = super().process_command(command)
+        if command.split(" ")[0].upper() in ("TC", "SEN", "SLOPE"):
+            self.configure()
+        return response
+
+    def get_intensity(self, argument):
+        x, y = self.model.read()
+        return f"{x:.6E},{y:.6E}"
+
+    def get_reference(self, argument):
+        # The reference is the FM frequency of the probe synthesizer
+        if "reference" in self.settings:
+            return f"{self.settings['reference']:.4f}"
+        modulation = simulation.state.get("probe", {}).get("modulation", 0)
+        return f"{modulation:.4f}"
+
+    def clear_buffer(self, argument):
+        self.buffer_start = None
+        self.curves = None
+
+    def set_buffer_length(self, argument):
+        self.buffer_length = int(argument)
+
+    def set_buffer_interval(self, argument):
+        self.buffer_interval = int(argument) / 1000
+
+    def start_buffer(self, triggered):
+        self.buffer_start = time.perf_counter()
+        self.buffer_triggered = triggered
+
+    def buffer_points(self):
+        if self.curves is not None:
+            return len(self.curves[0])
+        if self.buffer_start is None:
+            return 0
+
+        if self.buffer_triggered:
+            # Triggers are given by the list sweep of the probe synthesizer
+            probe = simulation.state.get("probe", {})
+            list_start = probe.get("list_start")
+            # The instruments are served independently, only sweeps started
+            # after the last readout trigger the buffer
+            if list_start is None or list_start < self.buffer_read:
+                return 0
+            points = (time.perf_counter() - list_start) / probe["dwelltime"]
+        else:
+            points = (
+                time.perf_counter() - self.buffer_start
+            ) / self.buffer_interval + 1
+        return min(int(points), self.buffer_length)
+
+    def get_buffer_status(self, argument):
+        return f"0,0,0,{self.buffer_points()}"
+
+    def get_buffer(self, argument):
+        # The acquisition stops with the first readout
+        if self.curves is None:
+            points = self.buffer_points()
+            self.buffer_read = time.perf_counter()
+
+            probe = simulation.state.get("probe", {})
+            if self.buffer_triggered:
+                frequencies = probe.get("list", [])[:points]
+            else:
+                frequencies = [probe.get("frequency")] * points
+
+            values = np.array([self.model.settled(x) for x in frequencies])
+            values = np.round(values / self.model.fullscale * 10000)
+            self.curves = values.reshape(-1, 2).T.astype(">i2")
+
+        return self.curves[int(argument)].tobytes()
+
+
+class InstrumentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        instrument = self.server.instrument
+        for line in self.rfile:
+            for response in instrument.process(line.decode("utf-8")):
+                if isinstance(response, str):
+                    response = f"{response}\n".encode("utf-8")
+                self.wfile.write(response)
+
+
+class InstrumentServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, instrument):
+        super().__init__((URL, port), InstrumentHandler)
+        self.instrument = instrument
+
+    @property
+    def address(self):
+        return f"TCPIP::{URL}::{self.server_address[1]}::SOCKET"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=[])
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def create_servers(probe=None, pump=None, lockin=None, settings=""):
+    settings = simulation.parse_settings(settings)
+    instruments = {
+        "probe": (probe, lambda: EmulatedSynthesizer(settings, "probe")),
+        "pump": (pump, lambda: EmulatedSynthesizer(settings, "pump")),
+        "lockin": (lockin, lambda: EmulatedSignalRecovery7265(settings)),
+    }
+
+    servers = {}
+    for key, (port, create_instrument) in instruments.items():
+        if port is not None:
+            servers[key] = InstrumentServer(port, create_instrument())
+    return servers
+
+
+def start():
+    parser = argparse.ArgumentParser(prog="trace_emulator")
+    parser.add_argument("--probe", type=int, default=5025, help="Port of the probe")
+    parser.add_argument("--pump", type=int, default=5026, help="Port of the pump")
+    parser.add_argument("--lockin", type=int, default=5027, help="Port of the lock-in")
+    parser.add_argument(
+        "--settings",
+        default="",
+        help="Settings of the simulation, e.g. 'cat=lines.cat;latency=0.002;errors=0.01'",
+    )
+    args = parser.parse_args()
+
+    servers = create_servers(args.probe, args.pump, args.lockin, args.settings)
+    threads = []
+    for key, server in servers.items():
+        threads.append(server.start())
+        print(f"Emulating the {key} at {server.address}")
+
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    start()
@@ -7,64 +7,64 @@ import os
 import sys
 import time
 import json
-import serial
+import uuid
+import sqlite3
+import queue
 import traceback
-import pandas as pd
 import numpy as np
 import threading
 import websockets
 import asyncio
+import argparse
+import multiprocessing
 from multiprocessing import shared_memory
 from collections import deque
 from datetime import datetime
 import configparser
+import functools
+from contextlib import nullcontext
+from concurrent import futures
 
 from . import mod_devices as devices
+from . import mod_timing as timing
+from . import mod_sensors as sensors
+from . import mod_streaming as streaming
+from . import mod_query as query
+from . import mod_catalogue as catalogue
+from . import mod_logging as logs
+from . import mod_imports as imports
+
+## Only needed for saving
+pd = imports.LazyModule("pandas")
 
 URL, PORT = "localhost", 8112
 
+## Name of the setup of a server running a single instrument chain
+DEFAULT_SETUP = "default"
+
+## Fewest stream samples per probe point of a fast sweep, fewer leave empty bins
+MIN_SWEEP_SAMPLES = 2
+
+## Optional tracer recording events of the measurements, enabled via --trace
+tracer = None
+
+## Settings of the log files, the worker processes write their own files with them
+log_settings = None
+
 homefolder = os.path.join(os.path.expanduser("~"), "TRACE")
 os.makedirs(homefolder, exist_ok=True)
 
-## Options for Initializing Serial Devices
-kwargs_serial_gauge = {
-    "baudrate": 2400,
-    "timeout": 1,
-}
-
-## Translate units into mbar
-pressure_translation = {
-    "mbar": 1,
-    "torr": 1.33322,
-    "pa": 0.01,
-    "micron": 0.001,
-}
-
-
-class Tee(object):
-    def __init__(self, name, mode, target_stderr=False):
-        self._file = open(name, mode)
-        self._original_object = sys.stderr if target_stderr else sys.stdout
-        self._target_stderr = target_stderr
-
-        if self._target_stderr:
-            sys.stderr = self
-        else:
-            sys.stdout = self
 
-    def __del__(self):
-        if self._target_stderr:
-            sys.stderr = self._original_object
-        else:
-            sys.stdout = self._original_object
-        self._file.close()
+def trace_span(name, category):
+    return tracer.span(name, category) if tracer else nullcontext()
 
-    def write(self, data):
-        self._file.write(data)
-        self._original_object.write(data)
 
-    def flush(self):
-        self._file.flush()
+def dump_trace(suffix=""):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+    log_folder = os.path.join(homefolder, "logs")
+    os.makedirs(log_folder, exist_ok=True)
+    filename = os.path.join(log_folder, f"trace_{timestamp}{suffix}.json")
+    tracer.dump(filename)
 
 
 class CustomError(Exception):
@@ -75,6 +75,10 @@ class CustomValueError(Exception):
     pass
 
 
+class WorkerError(Exception):
+    pass
+
+
 class UserAbort(Exception):
     pass
 
@@ -271,6 +275,46 @@ class Sweep(dict):
         self.init_frequency = init_frequency
 
 
+def bin_sweep(grid, frequencies, values):
+    # Average all samples onto the nearest point of the uniform grid
+    step = (grid[-1] - grid[0]) / (len(grid) - 1)
+    indices = np.rint((frequencies - grid[0]) / step).astype(np.int64)
+    mask = (indices >= 0) & (indices < len(grid))
+
+    counts = np.bincount(indices[mask], minlength=len(grid))
+    sums = np.bincount(indices[mask], weights=values[mask], minlength=len(grid))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def estimate_sweep_shift(grid, forward, backward):
+    # Cross-correlate both sweeps, the peak is at twice the shift of each sweep
+    n = len(grid)
+    step = (grid[-1] - grid[0]) / (n - 1)
+    for values in (forward, backward):
+        if not np.nanmax(values) > np.nanmin(values):
+            return 0
+
+    forward = np.nan_to_num(forward - np.nanmean(forward))
+    backward = np.nan_to_num(backward - np.nanmean(backward))
+
+    spectrum = np.fft.rfft(forward, 2 * n) * np.conj(np.fft.rfft(backward, 2 * n))
+    correlation = np.fft.irfft(spectrum, 2 * n)
+    correlation = np.concatenate((correlation[-(n - 1) :], correlation[:n]))
+
+    # Parabolic interpolation for sub-grid resolution
+    index = np.argmax(correlation)
+    offset = 0
+    if 0 < index < len(correlation) - 1:
+        y0, y1, y2 = correlation[index - 1 : index + 2]
+        denominator = y0 - 2 * y1 + y2
+        if denominator:
+            offset = 0.5 * (y0 - y2) / denominator
+
+    lag = index - (n - 1) + offset
+    return lag * step / 2
+
+
 class Cdeque(deque):
     def __init__(self, *args, onchange=print, **kwargs):
         self.onchange = onchange
@@ -335,15 +379,22 @@ class Measurement(dict):
             "lockin_sensitivity*": str,
             "lockin_acgain*": str,
             "lockin_iterations*": pint,
+            "lockin_settlemode": str,
+            "lockin_settletolerance": pfloat,
+            "lockin_settlemaxdelay": pfloat,
+            "lockin_acquisition": str,
+            "lockin_harmonics": str,
             "general_user": str,
             "general_molecule": str,
             "general_chemicalformula": str,
             "general_comment": str,
             "general_project": str,
+            "general_setup": str,
+            "general_id": str,
             "general_sendnotification": bool,
         }
 
-        if self.mode != "classic":
+        if self.mode not in devices.probeonly_modes:
             checktype_dict.update(
                 {
                     "static_pumpaddress*": str,
@@ -362,6 +413,20 @@ class Measurement(dict):
                 }
             )
 
+        if self.mode == "digital_dmdr":
+            checktype_dict.update(
+                {
+                    "general_dmblocksize": pint,
+                }
+            )
+
+        if self.mode == "fastsweep":
+            checktype_dict.update(
+                {
+                    "probe_sweeptime": pfloat,
+                }
+            )
+
         if self.sendnotification:
             checktype_dict.update(
                 {
@@ -369,6 +434,61 @@ class Measurement(dict):
                 }
             )
 
+        settlemode = dict_.get("lockin_settlemode", "fixed")
+        settlemodes = devices.settlemodes
+        if settlemode not in settlemodes:
+            raise CustomValueError(
+                f"The parameter 'lockin_settlemode' has to be in {settlemodes} but is {settlemode}"
+            )
+
+        acquisition = dict_.get("lockin_acquisition", "point")
+        acquisitionmodes = devices.acquisitionmodes
+        if acquisition not in acquisitionmodes:
+            raise CustomValueError(
+                f"The parameter 'lockin_acquisition' has to be in {acquisitionmodes} but is {acquisition}"
+            )
+        mode = devices.measurementmodes[self.mode]
+        if acquisition not in mode.acquisitions:
+            raise CustomValueError(
+                f"The '{acquisition}' acquisition is not available for the '{self.mode}' mode."
+            )
+
+        # The capabilities are declared by the drivers, the classes are not imported
+        probedevice = dict_.get("static_probedevice")
+        lockindevice = dict_.get("static_lockindevice")
+        n_lockins = len(dict_.get("static_lockinaddress", "").split(","))
+        if acquisition == "auto":
+            acquisition = devices.fastest_acquisition(
+                self.mode, probedevice, lockindevice, n_lockins
+            )
+        if acquisition == "software" and not devices.driver_supports(
+            lockindevice, "timesignal"
+        ):
+            raise CustomValueError(
+                "Software demodulation needs a lock-in amplifier that can record time signals."
+            )
+        if acquisition == "buffered" and not (
+            devices.driver_supports(probedevice, "list_sweep")
+            and devices.driver_supports(lockindevice, "buffered")
+        ):
+            raise CustomValueError(
+                "Buffered acquisition needs a probe synthesizer with list sweeps and a lock-in amplifier with a curve buffer."
+            )
+        if n_lockins > 1 and not mode.lockingroups:
+            raise CustomValueError(
+                f"Multiple lock-in amplifiers are not available for the '{self.mode}' mode."
+            )
+        if acquisition != "point" and n_lockins > 1:
+            raise CustomValueError(
+                f"The '{acquisition}' acquisition is not available for multiple lock-in amplifiers."
+            )
+        for devicetype, capabilities in mode.requires.items():
+            devicename = dict_.get(f"static_{devicetype}device")
+            if not devices.driver_supports(devicename, *capabilities):
+                raise CustomValueError(
+                    f"The '{self.mode}' mode needs a {devicetype} device supporting {', '.join(capabilities)}, which '{devicename}' does not declare."
+                )
+
         creation_dict_ = {}
         exceptions = []
         for key, class_ in checktype_dict.items():
@@ -389,28 +509,80 @@ class Measurement(dict):
         if exceptions:
             raise CustomValueError("\n".join(exceptions))
 
+        if "lockin_acquisition" in creation_dict_:
+            creation_dict_["lockin_acquisition"] = acquisition
+
+        if (
+            self.mode == "fastsweep"
+            and creation_dict_["probe_frequency"]["mode"] != "sweep"
+        ):
+            raise CustomValueError(
+                "The 'fastsweep' mode needs a probe frequency sweep instead of a fixed frequency."
+            )
+
+        # The ramps are binned onto the unique and evenly spaced probe points
+        if self.mode == "fastsweep":
+            probe_frequency = creation_dict_["probe_frequency"]
+            if probe_frequency["direction"] not in ("forth", "back"):
+                raise CustomValueError(
+                    f"The 'fastsweep' mode needs the probe direction 'forth' or 'back' but is '{probe_frequency['direction']}'."
+                )
+            if len(probe_frequency.frequencies()) < 2:
+                raise CustomValueError(
+                    "The 'fastsweep' mode needs at least two probe points."
+                )
+
         self.basic_information = None
+        self.timings = timing.Timings(tracer)
+        self.prediction = None
+        self.pressure_sampler = None
+        self.pressure_window = None
+        self._experiment = None
         super().__init__(**creation_dict_)
 
+    @property
+    def experiment(self):
+        # The setup running the measurement, the module level one by default
+        return self._experiment or experiment
+
+    @experiment.setter
+    def experiment(self, value):
+        self._experiment = value
+
     def run(self):
         self.lockin = None
         self.probe = None
         self.pump = None
         try:
-            self.probe = devices.connect(self, "probe")
-            if self.mode != "classic":
-                self.pump = devices.connect(self, "pump")
-            self.lockin = devices.connect(self, "lockin")
-
-            self["general_pressurestart"] = self.measure_pressure()
+            t0 = time.perf_counter()
+            self.probe = self.connect_device("probe")
+            if self.mode not in devices.probeonly_modes:
+                self.pump = self.connect_device("pump")
+            self.lockin = self.connect_device("lockin")
+
+            # The gauge is sampled in the background, start and end are the latest samples
+            self.pressure_sampler = self.experiment.sensors.sampler(
+                "pressure", self["static_pressuregaugaaddress"]
+            )
+            with trace_span("measure_pressure", "setup"):
+                self["general_pressurestart"] = self.measure_pressure()
             self["general_datestart"] = str(datetime.now())[:19]
 
+            t1 = time.perf_counter()
             self.spectrum_loop()
+            t2 = time.perf_counter()
+            self.pressure_window = (t1, t2)
 
             self["general_dateend"] = str(datetime.now())[:19]
-            self["general_pressureend"] = self.measure_pressure()
+            with trace_span("measure_pressure", "setup"):
+                self["general_pressureend"] = self.measure_pressure()
 
             self.save()
+            t3 = time.perf_counter()
+
+            self.timings.add("setup", t0, t1)
+            self.timings.add("loop", t1, t2)
+            self.timings.add("save", t2, t3)
 
             if self.sendnotification:
                 address = self["general_notificationaddress"]
@@ -429,6 +601,17 @@ class Measurement(dict):
                 if device:
                     device.close()
 
+            if tracer:
+                dump_trace()
+
+    def connect_device(self, devicetype):
+        if not tracer:
+            return devices.connect(self, devicetype)
+
+        with tracer.span(f"connect_{devicetype}", "setup"):
+            device = devices.connect(self, devicetype)
+        return timing.TracedDevice(device, tracer, devicetype)
+
     def spectrum_loop(self):
         shm = None
         try:
@@ -437,7 +620,7 @@ class Measurement(dict):
             probe_frequencies = self["probe_frequency"].frequencies()
             probe_iterations = self["probe_frequency"]["iterations"]
 
-            if self.mode == "classic":
+            if self.mode in devices.probeonly_modes:
                 pump_frequencies = [0]
                 pump_iterations = 1
             else:
@@ -447,33 +630,58 @@ class Measurement(dict):
                 if self.mode == "digital_dmdr":
                     self.lockin.pump = self.pump
 
+            blocked_dmdr = (
+                self.mode == "digital_dmdr" and self.get("general_dmblocksize", 1) > 1
+            )
+            buffered = self.get("lockin_acquisition") == "buffered"
+            continuous = self.mode == "fastsweep"
+
             # @Luis: Maybe change for loops to while loops -> allows to change iterations while running
-            point_iterations = self["lockin_iterations"]
+            point_iterations = self["lockin_iterations"] if not continuous else 1
 
             n_probe, n_pump = len(probe_frequencies), len(pump_frequencies)
+            self.probe_step = (
+                abs(probe_frequencies[1] - probe_frequencies[0]) if n_probe > 1 else 0
+            )
+            self.last_probe_frequency = None
+            timings = self.timings
+            perf_counter = time.perf_counter
 
             n_total = (
                 pump_iterations * n_pump * probe_iterations * n_probe * point_iterations
             )
-            values_per_point = 4
+            # Frequencies followed by x and y for each lock-in channel
+            values_per_point = 2 + 2 * len(self.lockin.channels)
+            self.pending = []
             bytes_per_float = 8
             size = n_total * bytes_per_float * values_per_point
             shape = (n_total, values_per_point)
             shm = shared_memory.SharedMemory(create=True, size=size)
             result = np.ndarray(shape=shape, buffer=shm.buf, dtype=np.float64)
             result[:] = np.nan
+            self.result_buffer = result
+            self.loop_start = self.next_progress = time.perf_counter()
 
             time_estimate = (delay_time * n_total / probe_iterations) + (
                 self.lockin.timeconstant * n_total
             )
+            # Digital DMDR measures every point with pump on and off
+            if self.mode == "digital_dmdr":
+                time_estimate *= 2
+            # Fast sweeps consist of a forward and a backward sweep
+            elif continuous:
+                time_estimate = (
+                    2 * probe_iterations * self.sweep_time(n_probe, delay_time)
+                )
             self.basic_information = {
                 "action": "measurement",
                 "size": size,
                 "name": shm.name,
                 "shape": shape,
                 "time": time_estimate,
+                "id": self.get("general_id"),
             }
-            server.send_all(self.basic_information)
+            self.experiment.send_all(self.basic_information)
 
             row = 0
             for _ in range(pump_iterations):
@@ -482,40 +690,68 @@ class Measurement(dict):
                     if pump_frequency:
                         self.pump.set_frequency(pump_frequency)
                     for _ in range(probe_iterations):
+                        if blocked_dmdr:
+                            row = self.probe_sweep_blocked(
+                                result,
+                                row,
+                                probe_frequencies,
+                                pump_frequency,
+                                delay_time,
+                                point_iterations,
+                            )
+                            continue
+
+                        if continuous:
+                            row = self.probe_sweep_continuous(
+                                result, row, probe_frequencies, delay_time
+                            )
+                            continue
+
+                        if buffered:
+                            row = self.probe_sweep_buffered(
+                                result,
+                                row,
+                                probe_frequencies,
+                                pump_frequency,
+                                delay_time,
+                                point_iterations,
+                            )
+                            continue
+
                         for probe_index in range(n_probe):
                             probe_frequency = probe_frequencies[probe_index]
+                            t0 = perf_counter()
                             self.probe.set_frequency(probe_frequency)
-
-                            # Wait delay time before measuring anything
-                            counterstart = time.perf_counter()
-                            while time.perf_counter() - counterstart < delay_time:
-                                continue
-
-                            counterend = time.perf_counter()
-                            if counterend - counterstart > delay_time + 0.05:
-                                print(counterend - counterstart - delay_time)
+                            t1 = perf_counter()
+                            self.wait_delay(delay_time, probe_frequency)
+                            t2 = perf_counter()
+                            timings.add("set_frequency", t0, t1)
+                            timings.add("settle", t1, t2)
 
                             for _ in range(point_iterations):
-
-                                x, y = self.lockin.measure_intensity()
-                                result[row] = probe_frequency, pump_frequency, x, y
+                                t0 = perf_counter()
+                                values = self.lockin.measure_intensity()
+                                t1 = perf_counter()
+                                # The probe frequency is written last, it marks
+                                # the row as complete for the streams
+                                self.write_values(result, row, values)
+                                result[row, 1] = pump_frequency
+                                result[row, 0] = probe_frequency
                                 row += 1
+                                t2 = perf_counter()
 
-                                while experiment.state != "running":
-                                    if experiment.state == "aborting":
-                                        raise UserAbort("__ABORTING__")
-
-                                    with experiment.nextfrequency_lock:
-                                        if experiment.nextfrequency:
-                                            experiment.nextfrequency = False
-                                            break
-
-                                    time.sleep(0.1)
+                                self.check_state()
+                                t3 = perf_counter()
+                                timings.add("measure", t0, t1)
+                                timings.add("write", t1, t2)
+                                timings.add("check_state", t2, t3)
 
+            self.wait_pending()
             self.result = result.copy()
             self.aborted = False
 
         except UserAbort as E:
+            self.wait_pending()
             # Aborting can lead to different number of occurences for probe- and pump-frequency pairs
             result = result[~np.isnan(result[:, 0])]
             self.result = result.copy()
@@ -525,95 +761,486 @@ class Measurement(dict):
             raise
 
         finally:
+            self.result_buffer = None
             if shm:
+                futures.wait(self.pending)
                 shm.close()
                 shm.unlink()
             self.basic_information = None
 
-    def measure_pressure(self):
-        device = None
-        address = self["static_pressuregaugaaddress"]
+    def write_values(self, result, row, values):
+        # Software demodulation finishes in the background
+        if isinstance(values, futures.Future):
+            self.pending.append(values)
 
-        if not address.strip():
-            return None
+            def callback(future, row=row):
+                if not future.exception():
+                    result[row, 2:] = future.result()
 
+            values.add_done_callback(callback)
+        else:
+            result[row, 2:] = values
+
+    def wait_pending(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def probe_sweep_blocked(
+        self,
+        result,
+        row,
+        probe_frequencies,
+        pump_frequency,
+        delay_time,
+        point_iterations,
+    ):
+        blocksize = self["general_dmblocksize"]
+        timings = self.timings
+        perf_counter = time.perf_counter
+
+        # The pump is on outside of the blocks, as after every point of the unblocked mode
         try:
-            device = serial.Serial(port=address, **kwargs_serial_gauge)
+            for block_start in range(0, len(probe_frequencies), blocksize):
+                block = probe_frequencies[block_start : block_start + blocksize]
+                n_block = len(block) * point_iterations
+                intensities = np.empty((2, n_block, 2 * len(self.lockin.channels)))
+
+                # Measure the whole block with pump on and then with pump off
+                for state in (1, 0):
+                    self.pump.set_rfpower(state)
+                    index = 0
+                    for probe_frequency in block:
+                        t0 = perf_counter()
+                        self.probe.set_frequency(probe_frequency)
+                        t1 = perf_counter()
+                        self.wait_delay(delay_time, probe_frequency)
+                        t2 = perf_counter()
+                        timings.add("set_frequency", t0, t1)
+                        timings.add("settle", t1, t2)
+
+                        for _ in range(point_iterations):
+                            t0 = perf_counter()
+                            intensities[state, index] = self.lockin.measure_intensity()
+                            index += 1
+                            t1 = perf_counter()
+
+                            self.check_state()
+                            t2 = perf_counter()
+                            timings.add("measure", t0, t1)
+                            timings.add("check_state", t1, t2)
+
+                t0 = perf_counter()
+                result[row : row + n_block, 2:] = intensities[0] - intensities[1]
+                result[row : row + n_block, 1] = pump_frequency
+                result[row : row + n_block, 0] = np.repeat(block, point_iterations)
+                row += n_block
+                timings.add("write", t0, perf_counter())
+        finally:
+            self.pump.set_rfpower(1)
+
+        return row
+
+    def probe_sweep_buffered(
+        self,
+        result,
+        row,
+        probe_frequencies,
+        pump_frequency,
+        delay_time,
+        point_iterations,
+    ):
+        frequencies = np.repeat(probe_frequencies, point_iterations)
+        dwelltime = delay_time + self.lockin.timeconstant
+        chunksize = self.lockin.BUFFER_LENGTH
+
+        for chunk_start in range(0, len(frequencies), chunksize):
+            chunk = frequencies[chunk_start : chunk_start + chunksize]
+            n_chunk = len(chunk)
+
+            # The synthesizer steps through the list and triggers every lock-in sample
+            self.probe.prepare_list_sweep(chunk, dwelltime)
+            self.lockin.prepare_buffer(n_chunk)
+            self.lockin.start_buffer()
+            self.probe.start_list_sweep()
+            sweep_start = time.perf_counter()
+
+            timeout = 2 * n_chunk * dwelltime + 5
+            timeout_start = time.perf_counter()
+            while self.lockin.buffer_points() < n_chunk:
+                if self.experiment.state == "aborting":
+                    self.probe.stop_list_sweep()
+                    raise UserAbort("__ABORTING__")
+
+                if time.perf_counter() - timeout_start > timeout:
+                    self.probe.stop_list_sweep()
+                    raise devices.DeviceError(
+                        "Timed out when waiting for the lock-in buffer to be filled."
+                    )
+                time.sleep(0.1)
+
+            self.probe.stop_list_sweep()
+            read_start = time.perf_counter()
+            xs, ys = self.lockin.read_buffer(n_chunk)
+            self.timings.add("sweep", sweep_start, read_start)
+            self.timings.add("read_buffer", read_start, time.perf_counter())
+
+            result[row : row + n_chunk, 3] = ys
+            result[row : row + n_chunk, 2] = xs
+            result[row : row + n_chunk, 1] = pump_frequency
+            result[row : row + n_chunk, 0] = chunk
+            row += n_chunk
+
+            self.check_state()
+
+        return row
+
+    def report_progress(self):
+        # Rows are filled in order, the first empty row is found by bisection
+        result = self.result_buffer
+        lo, hi = 0, len(result)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if np.isnan(result[mid, 0]):
+                hi = mid
+            else:
+                lo = mid + 1
+
+        now = time.perf_counter()
+        self.next_progress = now + 1
+        self.experiment.update_progress(lo / len(result), now - self.loop_start)
+
+    def runtime_keys(self):
+        mode = self.mode
+        acquisition = self.get("lockin_acquisition", "point")
+        lockin = f"{self['static_lockindevice']}|{self['lockin_timeconstant']}"
+        return {
+            "setup": f"{mode}|{self['static_probedevice']}|{self.get('static_pumpdevice')}|{self['static_lockindevice']}",
+            "set_frequency": self["static_probedevice"],
+            "settle": f"{self.get('lockin_settlemode', 'fixed')}|{self['lockin_delaytime']}|{lockin}",
+            "measure": f"{mode}|{acquisition}|{lockin}|{self.get('general_dmblocksize', 1)}",
+            "write": f"{mode}|{acquisition}",
+            "check_state": mode,
+            "loop": f"{mode}|{acquisition}|{lockin}",
+            "save": mode,
+        }
 
-            command = "MES R TM2\r\n"
-            command = command.encode("utf-8")
-            device.write(command)
-            response = device.readline().decode("utf-8")
+    def runtime_rows(self):
+        n_probe = len(self["probe_frequency"].frequencies())
+        n_probe *= self["probe_frequency"]["iterations"]
+        if self.mode not in devices.probeonly_modes:
+            n_pump = len(self["pump_frequency"].frequencies())
+            n_pump *= self["pump_frequency"]["iterations"]
+        else:
+            n_pump = 1
+        point_iterations = self["lockin_iterations"] if self.mode != "fastsweep" else 1
+        return n_probe * n_pump * point_iterations
+
+    def runtime_components(self):
+        # Calls and default costs of the phases of the point by point loops
+        delay_time = self["lockin_delaytime"] / 1000
+        timeconstant = devices.parse_timeconstant(self["lockin_timeconstant"])
+        probe_iterations = self["probe_frequency"]["iterations"]
+        n_probe = len(self["probe_frequency"].frequencies())
+        n_total = self.runtime_rows()
+
+        analytic = (delay_time * n_total / probe_iterations) + (timeconstant * n_total)
+        if self.mode == "digital_dmdr":
+            analytic *= 2
+        elif self.mode == "fastsweep":
+            sweep_time = self.get("probe_sweeptime", 0) or n_probe * (
+                delay_time + timeconstant
+            )
+            analytic = 2 * probe_iterations * sweep_time
+
+        if self.mode == "fastsweep" or self.get("lockin_acquisition") == "buffered":
+            return None, None, analytic
+
+        point_iterations = self["lockin_iterations"]
+        n_points = n_total // point_iterations
+        blocksize = self.get("general_dmblocksize", 1)
+        if self.mode == "digital_dmdr" and blocksize > 1:
+            n_blocks = n_points // n_probe * -(-n_probe // blocksize)
+            counts = {
+                "set_frequency": 2 * n_points,
+                "settle": 2 * n_points,
+                "measure": 2 * n_total,
+                "write": n_blocks,
+                "check_state": 2 * n_total,
+            }
+            measure_time = timeconstant
+        else:
+            counts = {
+                "set_frequency": n_points,
+                "settle": n_points,
+                "measure": n_total,
+                "write": n_total,
+                "check_state": n_total,
+            }
+            # Digital DMDR measures with pump on and off for every point
+            measure_time = timeconstant * (2 if self.mode == "digital_dmdr" else 1)
+
+        defaults = {
+            "set_frequency": 0,
+            "settle": delay_time,
+            "measure": measure_time,
+            "write": 0,
+            "check_state": 0,
+        }
+        return counts, defaults, analytic
+
+    def sweep_time(self, n_probe, delay_time):
+        sweep_time = self.get("probe_sweeptime", 0)
+        if not sweep_time:
+            sweep_time = n_probe * (delay_time + self.lockin.timeconstant)
+        return sweep_time
+
+    def probe_sweep_continuous(self, result, row, probe_frequencies, delay_time):
+        grid = np.sort(probe_frequencies)
+        n_probe = len(grid)
+        duration = self.sweep_time(n_probe, delay_time)
+
+        # Oversample the output grid and record longer to cover the lock-in delay
+        rate = 4 * n_probe / duration
+        steps = 10 * n_probe
+        margin = delay_time + 10 * self.lockin.timeconstant
+
+        # The lock-in limits the rate and a buffer has to hold the whole sweep
+        max_points = self.lockin.STREAM_MAX_POINTS
+        if max_points:
+            rate = min(rate, (max_points - 1) / (duration + margin))
+        rate = self.lockin.stream_rate(rate)
+        samples = rate * duration / n_probe
+        if samples < MIN_SWEEP_SAMPLES:
+            raise CustomValueError(
+                f"The lock-in amplifier records {rate:.1f} samples per second in this sweep, which are {samples:.2f} samples per probe point instead of at least {MIN_SWEEP_SAMPLES}. Please increase the sweep time or reduce the number of points."
+            )
 
-            if not response:
-                server.send_all(
-                    {
-                        "action": "error",
-                        "error": f"Could not read pressure. Error reads {tmp}.",
-                    }
+        sweeps = []
+        for start, stop in ((grid[0], grid[-1]), (grid[-1], grid[0])):
+            self.probe.prepare_ramp_sweep(start, stop, duration, steps)
+
+            stream_start = time.perf_counter()
+            self.lockin.start_stream(rate, duration + margin)
+            sweep_start = time.perf_counter()
+            self.probe.start_ramp_sweep()
+            ts, xs, ys = self.lockin.read_stream()
+            self.probe.stop_ramp_sweep()
+
+            ts = ts - (sweep_start - stream_start)
+            frequencies = start + (stop - start) * ts / duration
+            sweeps.append((frequencies, xs, ys))
+
+            if self.experiment.state == "aborting":
+                raise UserAbort("__ABORTING__")
+
+        # The lock-in delay shifts forward and backward sweeps in opposite directions
+        (forward, xs_forward, ys_forward), (backward, xs_backward, ys_backward) = sweeps
+        shift = estimate_sweep_shift(
+            grid,
+            bin_sweep(grid, forward, xs_forward),
+            bin_sweep(grid, backward, xs_backward),
+        )
+        self["probe_sweepdelay"] = shift / (grid[-1] - grid[0]) * duration
+
+        xs = np.nanmean(
+            (
+                bin_sweep(grid, forward - shift, xs_forward),
+                bin_sweep(grid, backward + shift, xs_backward),
+            ),
+            axis=0,
+        )
+        ys = np.nanmean(
+            (
+                bin_sweep(grid, forward - shift, ys_forward),
+                bin_sweep(grid, backward + shift, ys_backward),
+            ),
+            axis=0,
+        )
+
+        result[row : row + n_probe, 3] = ys
+        result[row : row + n_probe, 2] = xs
+        result[row : row + n_probe, 1] = 0
+        result[row : row + n_probe, 0] = grid
+        row += n_probe
+
+        self.check_state()
+        return row
+
+    def check_state(self):
+        if time.perf_counter() > self.next_progress:
+            self.report_progress()
+
+        while self.experiment.state != "running":
+            if self.experiment.state == "aborting":
+                raise UserAbort("__ABORTING__")
+
+            with self.experiment.nextfrequency_lock:
+                if self.experiment.nextfrequency:
+                    self.experiment.nextfrequency = False
+                    break
+
+            time.sleep(0.1)
+
+    def wait_delay(self, delay_time, probe_frequency):
+        last_probe_frequency = self.last_probe_frequency
+        self.last_probe_frequency = probe_frequency
+
+        if self.get("lockin_settlemode") == "adaptive":
+            if last_probe_frequency is None or not self.probe_step:
+                jump_ratio = 1
+            else:
+                jump_ratio = (
+                    abs(probe_frequency - last_probe_frequency) / self.probe_step
                 )
-                return None
+            self.wait_settled(delay_time, jump_ratio)
+            return
+
+        # Wait delay time before measuring anything
+        counterstart = time.perf_counter()
+        while time.perf_counter() - counterstart < delay_time:
+            continue
+
+        counterend = time.perf_counter()
+        if counterend - counterstart > delay_time + 0.05:
+            print(counterend - counterstart - delay_time)
+
+    def wait_settled(self, delay_time, jump_ratio):
+        lockin = self.lockin
+        timeconstant = lockin.timeconstant
+        tolerance = self.get("lockin_settletolerance", 1) / 100
+
+        # Larger jumps (e.g. fromcenter sweeps) may take longer, capped by the maximum delay
+        max_delay = delay_time * (1 + np.log2(max(jump_ratio, 1)))
+        if "lockin_settlemaxdelay" in self:
+            max_delay = min(max_delay, self["lockin_settlemaxdelay"] / 1000)
+
+        # Higher filter orders settle slower than a single exponential with the same time constant
+        factors = lockin.SETTLE_FACTORS
+        effective_timeconstant = timeconstant * factors[lockin.filterorder] / factors[1]
+        floor = tolerance * lockin.fullscale
+
+        # Minimal dead time of one time constant before the first reading
+        counterstart = time.perf_counter()
+        while time.perf_counter() - counterstart < timeconstant:
+            continue
+        previous = lockin.get_intensity()
+
+        while time.perf_counter() - counterstart < max_delay:
+            samplestart = time.perf_counter()
+            while time.perf_counter() - samplestart < timeconstant:
+                continue
+            current = lockin.get_intensity()
+
+            # Extrapolate the remaining deviation from the change between two readings
+            change = np.hypot(current[0] - previous[0], current[1] - previous[1])
+            residual = change * effective_timeconstant / timeconstant
+            level = np.hypot(current[0], current[1])
+            if residual <= max(tolerance * level, floor):
+                break
+            previous = current
 
-            _, unit, value = response.split(":")[:3]
-            unit_factor = pressure_translation[unit.lower().strip()]
-            pressure = np.float64(value) * unit_factor
-            return pressure / 1000
+    def measure_pressure(self):
+        sampler = self.pressure_sampler
+        if sampler is None:
+            return None
 
-        except Exception as E:
-            server.send_all(
+        pressure = sampler.latest()
+        if pressure is None:
+            self.experiment.send_all(
                 {
                     "action": "error",
-                    "error": f"Could not read pressure. Error reads {tmp}.",
+                    "error": f"Could not read pressure. Error reads {sampler.error}.",
                 }
             )
-            return None
-        finally:
-            if device and device.is_open:
-                device.close()
+        return pressure
 
     def save(self):
-        directory = os.path.join(homefolder, "data", str(datetime.now())[:10])
+        # Every further setup of the server keeps its spectra in its own folder
+        directory = os.path.join(
+            homefolder, "data", self.get("general_setup", ""), str(datetime.now())[:10]
+        )
         if not os.path.exists(directory):
             os.makedirs(directory, exist_ok=True)
 
-        self.save_spectrum(directory)
-        # @Luis: add here database ...
+        filenames = self.save_spectrum(directory)
+
+        # The catalogue only indexes the files, failing to update it keeps the data
+        try:
+            with catalogue.Catalogue(
+                os.path.join(homefolder, catalogue.FILENAME)
+            ) as catalogue_:
+                catalogue_.add(filenames)
+        except (sqlite3.Error, catalogue.CatalogueError) as E:
+            print(f"Could not add the measurement to the catalogue: {E}")
 
     def save_spectrum(self, directory):
         result = self.result
-        result_df = pd.DataFrame(result, columns=["probe", "pump", "x", "y"])
-        pivot_df_x = result_df.pivot_table(
-            index="probe", columns="pump", values="x", sort=True
-        )
-        pivot_df_y = result_df.pivot_table(
-            index="probe", columns="pump", values="y", sort=True
-        )
 
-        intensities_x = pivot_df_x.values
-        intensities_y = pivot_df_y.values
-        probe_frequencies = pivot_df_x.index.values
-        pump_frequencies = pivot_df_x.columns.values
+        # The first channel is saved as x and y, further channels are appended
+        channels = self.lockin.channels
+        value_columns = ["x", "y"]
+        for channel in channels[1:]:
+            value_columns.extend((f"x_{channel}", f"y_{channel}"))
+        if len(channels) > 1:
+            self["lockin_channels"] = list(channels)
+        if getattr(self.lockin, "skew", None):
+            self["lockin_maxskew"] = self.lockin.skew
+
+        result_df = pd.DataFrame(result, columns=["probe", "pump", *value_columns])
+        pivot_dfs = [
+            result_df.pivot_table(
+                index="probe", columns="pump", values=column, sort=True
+            )
+            for column in value_columns
+        ]
+
+        intensities = [pivot_df.values for pivot_df in pivot_dfs]
+        probe_frequencies = pivot_dfs[0].index.values
+        pump_frequencies = pivot_dfs[0].columns.values
 
         probe = (probe_frequencies.min() + probe_frequencies.max()) / 2
 
-        for column_x, column_y, pump in zip(
-            intensities_x.T, intensities_y.T, pump_frequencies
-        ):
+        # All measured rows in acquisition order for queries by the measurement id
+        if self.get("general_id"):
+            rawdata = f"{self['general_id']}.npy"
+            np.save(os.path.join(directory, rawdata), result[~np.isnan(result[:, 0])])
+            self["general_rawdata"] = rawdata
+
+        filenames = []
+        for i, pump in enumerate(pump_frequencies):
             tmp = f"_Pump@{pump:.2f}" if pump else ""
             tmp2 = f"_ABORTED" if self.aborted else ""
             filename = f"Probe@{probe:.2f}{tmp}{tmp2}_{self['general_datestart'].replace(':', '-')}"
             filename = os.path.realpath(f"{directory}/{filename}")
             np.savetxt(
                 f"{filename}.dat",
-                np.array((probe_frequencies, column_x, column_y)).T,
+                np.array(
+                    (probe_frequencies, *[values[:, i] for values in intensities])
+                ).T,
                 delimiter="\t",
             )
             self.save_meta(filename)
+            filenames.append(f"{filename}.dat")
+        return filenames
 
     def save_meta(self, filename):
         if self.aborted:
             self["general_aborted"] = True
 
+        if self.timings:
+            self["timings_edges"] = timing.bin_edges()
+            for phase, histogram in self.timings.items():
+                self[f"timings_{phase}"] = histogram.summary()
+
+        # Pressure vs time since the start of the acquisition
+        if self.pressure_sampler and self.pressure_window:
+            start, end = self.pressure_window
+            times, values = self.pressure_sampler.window(start, end)
+            if times:
+                self["pressure_times"] = [round(x - start, 3) for x in times]
+                self["pressure_values"] = values
+
         output_dict = {}
         for key, value in self.items():
             category, name = key.split("_", 1)
@@ -636,15 +1263,15 @@ class Measurement(dict):
 
 
 class Experiment:
-    def __init__(self):
+    def __init__(self, sensor_interval=sensors.INTERVAL, name=DEFAULT_SETUP):
+        self.name = name
+        # Further setups keep their data and runtime model separate
+        self.folder = "" if name == DEFAULT_SETUP else name
         self._state = "ready"
         self._pause_after_abort = False
         self.send_all = print
-        self.queue = Cdeque(
-            onchange=lambda queue: self.send_all(
-                {"action": "queue", "data": list(queue)}
-            )
-        )
+        self.queue = Cdeque(onchange=self.queue_changed)
+        self.sensors = sensors.SensorService(sensor_interval)
 
         self.queue_lock = threading.Lock()
         self.current_measurement = None
@@ -653,6 +1280,21 @@ class Experiment:
         self.nextfrequency = 0
         self.nextfrequency_lock = threading.Lock()
 
+        # Optional worker process running the measurements
+        self.worker = None
+        self.worker_kwargs = {}
+        self.connection = None
+        self.connection_lock = threading.Lock()
+        self.worker_timings = None
+        self.timings_event = threading.Event()
+
+        # Learned costs for the time estimates of the measurements and the queue
+        suffix = f"_{self.folder}" if self.folder else ""
+        self.runtime_model = timing.RuntimeModel(
+            os.path.join(homefolder, f"runtime_model{suffix}.json")
+        )
+        self.progress = (0, 0)
+
         self.spectrum = {
             "ranges": {
                 "probe": (0, 100),
@@ -676,6 +1318,7 @@ class Experiment:
     def state(self, value):
         send_message = self.state != value
         self._state = value
+        self.send_worker(("state", value))
         if send_message:
             self.send_all(
                 {
@@ -710,13 +1353,33 @@ class Experiment:
                         time.sleep(0.1)
 
                 self.current_measurement = self.queue.popleft()
+                self.current_measurement.experiment = self
+                self.current_measurement["general_id"] = uuid.uuid4().hex
+                if self.folder:
+                    self.current_measurement["general_setup"] = self.name
                 self.state = "running"
-                self.current_measurement.run()
+                self.progress = (0, 0)
+                self.send_eta()
+                if self.worker:
+                    try:
+                        summary, aborted = self.run_in_worker(self.current_measurement)
+                    finally:
+                        # Events of the server process, the worker writes its own trace
+                        if tracer:
+                            dump_trace("_server")
+                else:
+                    self.current_measurement.run()
+                    summary = self.current_measurement.timings.summary()
+                    aborted = self.current_measurement.aborted
+                self.update_runtime_model(self.current_measurement, summary, aborted)
             except IndexError:
                 self.state = "waiting"
                 time.sleep(0.2)
-            except (CustomValueError, CustomError) as E:
+            except (CustomValueError, CustomError, devices.CustomError) as E:
                 self.send_all({"action": "error", "error": f"{E}"})
+            except WorkerError as E:
+                self.send_all({"action": "uerror", "error": f"{E}"})
+                stderr.write(f"{E}\n")
             except devices.DeviceError as E:
                 self.send_all({"action": "error", "error": f"{E}"})
                 self.state = "deviceerror"
@@ -735,11 +1398,139 @@ class Experiment:
                     f"An error occurred while performing a measurement:\n{E}\n{traceback.format_exc()}"
                 )
 
+    def queue_changed(self, queue):
+        self.send_all({"action": "queue", "data": list(queue)})
+        self.send_eta()
+
+    def predict(self, measurement):
+        if measurement.prediction is None:
+            measurement.prediction = self.runtime_model.predict(measurement)
+        return measurement.prediction
+
+    def update_progress(self, fraction, elapsed):
+        self.progress = (fraction, elapsed)
+        self.send_eta()
+
+    def send_eta(self):
+        measurement = self.current_measurement
+        remaining = 0
+        if measurement and self.state in ("running", "pausing"):
+            prediction = self.predict(measurement)
+            fraction, elapsed = self.progress
+            remaining = prediction["loop"] * (1 - fraction)
+            if fraction > 0:
+                # Trust the measured rate more the further the measurement has progressed
+                extrapolated = elapsed / fraction * (1 - fraction)
+                remaining = fraction * extrapolated + (1 - fraction) * remaining
+            remaining += prediction["save"]
+
+        queue = remaining + sum(self.predict(x)["total"] for x in list(self.queue))
+        self.send_all({"action": "eta", "measurement": remaining, "queue": queue})
+
+    def update_runtime_model(self, measurement, summary, aborted):
+        try:
+            self.runtime_model.update(measurement, summary, aborted)
+        except OSError as E:
+            print(f"Could not save the runtime model: {E}")
+
+        for queued_measurement in list(self.queue):
+            queued_measurement.prediction = None
+        self.send_eta()
+
     def start(self):
         self.thread = threading.Thread(target=self.loop, args=[])
         self.thread.daemon = True
         self.thread.start()
 
+    def start_worker(self, **kwargs):
+        kwargs["trace"] = bool(tracer)
+        kwargs["sensor_interval"] = self.sensors.interval
+        if log_settings:
+            name = f"WORKER_{self.folder}" if self.folder else "WORKER"
+            kwargs["log"] = dict(log_settings, name=name)
+        # Spawn a fresh interpreter so the worker does not inherit the server's threads
+        context = multiprocessing.get_context("spawn")
+        self.connection, worker_connection = context.Pipe()
+        self.worker_kwargs = kwargs
+        self.worker = context.Process(
+            target=worker, args=(worker_connection,), kwargs=kwargs, daemon=True
+        )
+        self.worker.start()
+        worker_connection.close()
+
+    def send_worker(self, message):
+        if not self.connection:
+            return
+        with self.connection_lock:
+            self.connection.send(message)
+
+    def run_in_worker(self, measurement):
+        # Sweeps are not picklable, the measurement is rebuilt from its JSON form
+        self.send_worker(("measurement", json.dumps(measurement)))
+
+        while True:
+            if not self.connection.poll(0.5):
+                if not self.worker.is_alive():
+                    exitcode = self.worker.exitcode
+                    self.start_worker(**self.worker_kwargs)
+                    raise WorkerError(
+                        f"The measurement worker process exited unexpectedly with exit code {exitcode} and was restarted."
+                    )
+                continue
+
+            message = self.connection.recv()
+            action = message[0]
+
+            if action == "send_all":
+                dict_ = message[1]
+                # Keep the shared memory information for clients connecting later
+                if dict_.get("action") == "measurement":
+                    measurement.basic_information = dict_
+                self.send_all(dict_)
+
+            elif action == "timings":
+                self.worker_timings = message[1]
+                self.timings_event.set()
+
+            elif action == "progress":
+                self.update_progress(*message[1])
+
+            # The sensors are only opened by the server, setups share them
+            elif action == "sensor":
+                self.send_worker(("sensor", self.sensors.request(*message[1])))
+
+            elif action == "done":
+                measurement.basic_information = None
+                self.worker_timings, aborted = message[1:]
+                return self.worker_timings, aborted
+
+            elif action == "error":
+                measurement.basic_information = None
+                errortype, errormessage = message[1:]
+                if errortype == "deviceerror":
+                    raise devices.DeviceError(errormessage)
+                elif errortype == "error":
+                    raise CustomError(errormessage)
+                else:
+                    raise WorkerError(errormessage)
+
+    def get_timings(self):
+        measurement = self.current_measurement
+        if self.worker and self.state in ("running", "pausing"):
+            self.timings_event.clear()
+            self.send_worker(("timings", None))
+            if self.timings_event.wait(1):
+                return self.worker_timings
+
+        if measurement and measurement.timings:
+            return measurement.timings.summary()
+        return self.worker_timings
+
+    def next_frequency(self):
+        with self.nextfrequency_lock:
+            self.nextfrequency = True
+        self.send_worker(("next_frequency", None))
+
     def add_measurement_last(self, measurement):
         self.queue.append(Measurement(measurement))
 
@@ -786,105 +1577,219 @@ class Experiment:
 
 
 class Websocket:
-    def __init__(self, experiment):
-        self.listeners = set()
-        self.experiment = experiment
-        experiment.send_all = self.send_all
+    def __init__(self, experiments):
+        # A single experiment or several independent setups by name
+        if not isinstance(experiments, dict):
+            experiments = {DEFAULT_SETUP: experiments}
+        self.experiments = experiments
+        self.default = next(iter(experiments))
+        self.experiment = experiments[self.default]
+        for name, experiment_ in experiments.items():
+            experiment_.send_all = functools.partial(self.send_all, setup=name)
+
+        # Every client receives the messages of the setup it is subscribed to
+        self.listeners = {}
         self.loop = None
 
+        # Optional binary streams of the measured rows for remote clients
+        self.streamer = streaming.Streamer(experiments)
+        self.followers = {}
+        self.queries = query.Queries(
+            os.path.join(homefolder, "data"),
+            self.streamer,
+            database=os.path.join(homefolder, catalogue.FILENAME),
+        )
+
     async def start(self):
         self.server = await websockets.serve(self.main, URL, PORT)
         self.loop = self.server.get_loop()
         await self.server.serve_forever()
 
-    def send_all(self, dict_):
+    def send_all(self, dict_, setup=None):
         while not self.loop:
             time.sleep(1)
-        asyncio.run_coroutine_threadsafe(self.send_all_core(dict_), self.loop)
-
-    async def send_all_core(self, dict_):
-        try:
-            await asyncio.gather(
-                *(listener.send(json.dumps(dict_)) for listener in self.listeners)
+        with trace_span("send_all", "websocket"):
+            asyncio.run_coroutine_threadsafe(
+                self.send_all_core(dict_, setup), self.loop
             )
-        except Exception as E:
-            print(E)
-            raise E
 
-    async def main(self, websocket):
-        try:
-            self.listeners.add(websocket)
-            await websocket.send(
-                json.dumps({"action": "state", "state": self.experiment.state})
+    async def send_all_core(self, dict_, setup=None):
+        # A dropped client must not keep the message from the others
+        with trace_span(f"broadcast_{dict_.get('action')}", "websocket"):
+            if setup is not None:
+                dict_ = {**dict_, "setup": setup}
+            message = json.dumps(dict_)
+            listeners = [
+                listener
+                for listener, subscription in list(self.listeners.items())
+                if setup in (None, subscription)
+            ]
+            results = await asyncio.gather(
+                *(listener.send(message) for listener in listeners),
+                return_exceptions=True,
             )
-            await websocket.send(
-                json.dumps({"action": "queue", "data": list(experiment.queue)})
-            )
-            await websocket.send(
-                json.dumps(
-                    {
-                        "action": "pause_after_abort",
-                        "state": self.experiment.pause_after_abort,
-                    }
-                )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Could not send to a client: {result!r}")
+
+    def get_setup(self, name):
+        if name not in self.experiments:
+            raise CustomError(
+                f"The setup '{name}' does not exist, the setups are {list(self.experiments)}."
             )
+        return name, self.experiments[name]
+
+    async def send_setup(self, websocket, setup):
+        # Current state of the setup for a client connecting or switching to it
+        experiment_ = self.experiments[setup]
+        dicts = [
+            {"action": "state", "state": experiment_.state},
+            {"action": "queue", "data": list(experiment_.queue)},
+            {"action": "pause_after_abort", "state": experiment_.pause_after_abort},
+        ]
+        current_measurement = experiment_.current_measurement
+        if current_measurement and current_measurement.basic_information:
+            dicts.append(current_measurement.basic_information)
+
+        for dict_ in dicts:
+            await websocket.send(json.dumps({**dict_, "setup": setup}))
 
-            if (
-                self.experiment.current_measurement
-                and self.experiment.current_measurement.basic_information
-            ):
-                await websocket.send(
-                    json.dumps(self.experiment.current_measurement.basic_information)
-                )
+    async def main(self, websocket):
+        try:
+            self.listeners[websocket] = self.default
+            await self.send_setup(websocket, self.default)
 
             async for message in websocket:
+                setup = self.listeners[websocket]
                 try:
                     output = {}
                     message = json.loads(message)
                     action = message.get("action")
+                    setup, experiment_ = self.get_setup(message.get("setup", setup))
+
+                    if action == "setup":
+                        self.listeners[websocket] = setup
+                        await self.send_setup(websocket, setup)
+
+                    elif action == "setups":
+                        await websocket.send(
+                            json.dumps(
+                                {
+                                    "action": "setups",
+                                    "setups": list(self.experiments),
+                                    "setup": self.listeners[websocket],
+                                }
+                            )
+                        )
 
-                    if action == "state":
-                        self.experiment.state = message.get("state")
+                    elif action == "state":
+                        experiment_.state = message.get("state")
 
                     elif action == "add_measurement_last":
-                        self.experiment.add_measurement_last(message.get("measurement"))
+                        experiment_.add_measurement_last(message.get("measurement"))
 
                     elif action == "add_measurement_first":
-                        self.experiment.add_measurement_first(
-                            message.get("measurement")
-                        )
+                        experiment_.add_measurement_first(message.get("measurement"))
 
                     elif action == "add_measurement_now":
-                        self.experiment.add_measurement_now(message.get("measurement"))
+                        experiment_.add_measurement_now(message.get("measurement"))
 
                     elif action == "del_measurements":
-                        self.experiment.del_measurements()
+                        experiment_.del_measurements()
 
                     elif action == "del_measurement":
-                        self.experiment.del_measurements(message.get("indices"))
+                        experiment_.del_measurements(message.get("indices"))
 
                     elif action == "reorder_measurement":
-                        self.experiment.reorder_measurement(
+                        experiment_.reorder_measurement(
                             message.get("oldindex"), message.get("newindex")
                         )
 
                     elif action == "add_measurements":
-                        self.experiment.add_measurements(message.get("measurements"))
+                        experiment_.add_measurements(message.get("measurements"))
 
                     elif action == "next_frequency":
-                        with self.experiment.nextfrequency_lock:
-                            self.experiment.nextfrequency = True
+                        experiment_.next_frequency()
+
+                    elif action == "timings":
+                        timings = await asyncio.get_running_loop().run_in_executor(
+                            None, experiment_.get_timings
+                        )
+                        await websocket.send(
+                            json.dumps({"action": "timings", "timings": timings})
+                        )
 
                     elif action == "pop_measurement":
-                        self.experiment.pop_measurement()
+                        experiment_.pop_measurement()
 
                     elif action == "pause_after_abort":
-                        self.experiment.pause_after_abort = (
-                            not self.experiment.pause_after_abort
+                        experiment_.pause_after_abort = (
+                            not experiment_.pause_after_abort
+                        )
+
+                    elif action == "stream":
+                        await self.unfollow(websocket)
+                        rate = message.get("rate", streaming.RATE)
+                        if not isinstance(rate, (int, float)) or rate < 0:
+                            raise CustomValueError(
+                                f"The stream rate has to be a positive number of blocks per second but is {rate}."
+                            )
+                        if rate:
+                            self.followers[websocket] = asyncio.create_task(
+                                self.follow(websocket, rate)
+                            )
+
+                    elif action == "stream_range":
+                        await self.streamer.send_range(
+                            websocket,
+                            message.get("stream"),
+                            message.get("start", 0),
+                            message.get("stop"),
+                        )
+
+                    elif action == "streams":
+                        streams = [
+                            stream.information()
+                            for stream in self.streamer.streams.values()
+                        ]
+                        await websocket.send(
+                            json.dumps({"action": "streams", "streams": streams})
+                        )
+
+                    elif action == "query":
+                        # Sorting and binning large measurements must not block the server
+                        self.streamer.refresh()
+                        kwargs = {
+                            key: message[key]
+                            for key in ("axis", "points", "limit")
+                            if key in message
+                        }
+                        result = await asyncio.get_running_loop().run_in_executor(
+                            None,
+                            functools.partial(
+                                self.queries.query,
+                                message.get("id"),
+                                message.get("query"),
+                                range_=message.get("range"),
+                                **kwargs,
+                            ),
+                        )
+                        await websocket.send(
+                            json.dumps(
+                                {
+                                    "action": "query",
+                                    "id": message.get("id"),
+                                    "query": message.get("query"),
+                                    "request": message.get("request"),
+                                    "result": result,
+                                }
+                            )
                         )
 
                     elif action == "measurements_folder":
                         folder = os.path.join(homefolder, "data")
+                        if experiment_.folder:
+                            folder = os.path.join(folder, experiment_.folder)
                         await websocket.send(
                             json.dumps(
                                 {"action": "measurements_folder", "folder": folder}
@@ -893,7 +1798,7 @@ class Websocket:
 
                     elif action == "kill":
                         await asyncio.gather(
-                            *[listener.close() for listener in self.listeners]
+                            *[listener.close() for listener in list(self.listeners)]
                         )
                         exit()
 
@@ -902,7 +1807,12 @@ class Websocket:
                             f"The request with action '{action}' was not understood."
                         )
 
-                except (CustomError, CustomValueError) as E:
+                except (
+                    CustomError,
+                    CustomValueError,
+                    streaming.StreamError,
+                    query.QueryError,
+                ) as E:
                     output = {
                         "action": "error",
                         "error": str(E),
@@ -916,30 +1826,272 @@ class Websocket:
 
                 finally:
                     if output:
-                        self.send_all(output)
+                        self.send_all(output, setup)
+
+        # Clients may disappear without closing the connection
+        except websockets.ConnectionClosed:
+            pass
 
         except Exception as E:
             raise
 
         finally:
-            self.listeners.remove(websocket)
+            self.listeners.pop(websocket, None)
+            await self.unfollow(websocket)
+
+    async def follow(self, websocket, rate):
+        # The stream follows the setup the client is subscribed to
+        try:
+            await self.streamer.follow(
+                websocket, lambda: self.listeners.get(websocket, self.default), rate
+            )
+        except websockets.ConnectionClosed:
+            pass
+
+    async def unfollow(self, websocket):
+        task = self.followers.pop(websocket, None)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+class WorkerExperiment:
+    # Stands in for the experiment and the server inside the worker process
+    def __init__(self, connection, sensor_interval=sensors.INTERVAL):
+        self.connection = connection
+        self.connection_lock = threading.Lock()
+        self.sensors = sensors.RemoteSensorService(self.request_sensor, sensor_interval)
+        self.sensor_replies = queue.Queue()
+        self.state = "running"
+        self.nextfrequency = False
+        self.nextfrequency_lock = threading.Lock()
+        self.measurements = deque()
+        self.measurements_event = threading.Event()
+        self.current_measurement = None
+
+    def timings(self):
+        measurement = self.current_measurement
+        if measurement and measurement.timings:
+            return measurement.timings.summary()
+        return None
+
+    def send(self, message):
+        with self.connection_lock:
+            self.connection.send(message)
+
+    def send_all(self, dict_):
+        self.send(("send_all", dict_))
+
+    def update_progress(self, fraction, elapsed):
+        self.send(("progress", (fraction, elapsed)))
+
+    def request_sensor(self, *request):
+        self.send(("sensor", request))
+        return self.sensor_replies.get()
+
+    def listen(self):
+        while True:
+            try:
+                action, value = self.connection.recv()
+            except EOFError:
+                # Server has exited
+                os._exit(0)
+
+            if action == "state":
+                self.state = value
+            elif action == "next_frequency":
+                with self.nextfrequency_lock:
+                    self.nextfrequency = True
+            elif action == "measurement":
+                self.measurements.append(value)
+                self.measurements_event.set()
+            elif action == "timings":
+                self.send(("timings", self.timings()))
+            elif action == "sensor":
+                self.sensor_replies.put(value)
+
+
+def set_process_priority(cpus=None, priority="normal"):
+    try:
+        if cpus:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, cpus)
+            elif sys.platform.startswith("win"):
+                import ctypes
+
+                mask = sum(1 << cpu for cpu in cpus)
+                kernel32 = ctypes.windll.kernel32
+                kernel32.SetProcessAffinityMask(kernel32.GetCurrentProcess(), mask)
+
+        if priority == "high":
+            if sys.platform.startswith("win"):
+                import ctypes
+
+                HIGH_PRIORITY_CLASS = 0x80
+                kernel32 = ctypes.windll.kernel32
+                kernel32.SetPriorityClass(
+                    kernel32.GetCurrentProcess(), HIGH_PRIORITY_CLASS
+                )
+            else:
+                os.nice(-10)
+    except OSError as E:
+        print(f"Could not set the affinity or priority of the worker process: {E}")
+
+
+def worker(
+    connection,
+    cpus=None,
+    priority="normal",
+    trace=False,
+    sensor_interval=sensors.INTERVAL,
+    log=None,
+):
+    global experiment
+    global server
+    global tracer
+    global stdout
+    global stderr
+
+    # The output of the worker is written by its own background thread as well
+    if log:
+        logs.install(**log)
+    stdout, stderr = sys.stdout, sys.stderr
+
+    set_process_priority(cpus, priority)
+    if trace:
+        tracer = timing.Tracer()
+
+    experiment = server = WorkerExperiment(connection, sensor_interval)
+    thread = threading.Thread(target=experiment.listen, args=[])
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        experiment.measurements_event.wait()
+        experiment.measurements_event.clear()
+        while experiment.measurements:
+            measurement = experiment.measurements.popleft()
+            try:
+                measurement = Measurement(json.loads(measurement))
+                experiment.current_measurement = measurement
+                measurement.run()
+                experiment.send(("done", experiment.timings(), measurement.aborted))
+            except (CustomValueError, CustomError, devices.CustomError) as E:
+                experiment.send(("error", "error", f"{E}"))
+            except devices.DeviceError as E:
+                experiment.send(("error", "deviceerror", f"{E}"))
+            except Exception as E:
+                experiment.send(
+                    (
+                        "error",
+                        "uerror",
+                        f"An error occurred while performing a measurement:\n{E}\n{traceback.format_exc()}",
+                    )
+                )
 
 
 def start():
     global experiment
     global server
     global stderr
+    global PORT
     global stdout
-
+    global tracer
+    global log_settings
+
+    parser = argparse.ArgumentParser(prog="trace_exp")
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Run the measurements in a separate worker process",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=lambda x: [int(cpu) for cpu in x.split(",")],
+        help="Comma separated CPUs the worker process is bound to",
+    )
+    parser.add_argument(
+        "--priority",
+        choices=("normal", "high"),
+        default="normal",
+        help="Priority of the worker process",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write a Chrome trace of every measurement to the logs folder",
+    )
+    parser.add_argument(
+        "--sensor-interval",
+        type=float,
+        default=sensors.INTERVAL,
+        help="Seconds between two samples of the pressure gauge",
+    )
+    parser.add_argument(
+        "--log-jsonl",
+        action="store_true",
+        help="Additionally write the log as JSON lines to EXPERIMENT.jsonl",
+    )
+    parser.add_argument(
+        "--log-max-bytes",
+        type=int,
+        default=logs.MAX_BYTES,
+        help="Size in bytes after which the log files are rotated",
+    )
+    parser.add_argument(
+        "--log-backups",
+        type=int,
+        default=logs.BACKUPS,
+        help="Number of rotated log files that are kept",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PORT,
+        help="Port of the websocket server, e.g. for several servers on one machine",
+    )
+    parser.add_argument(
+        "--setups",
+        type=lambda x: [setup.strip() for setup in x.split(",") if setup.strip()],
+        help="Comma separated names of independent setups served by this process",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Report the import time per module once the server is started",
+    )
+    args = parser.parse_args()
+    PORT = args.port
+
+    # Output is written by a background thread, printing never waits for the disk
     log_folder = os.path.join(homefolder, "logs")
     os.makedirs(log_folder, exist_ok=True)
-    stdout = Tee(os.path.join(log_folder, "EXPERIMENT.txt"), "a+", False)
-    stderr = Tee(os.path.join(log_folder, "EXPERIMENT.err"), "a+", True)
-
-    experiment = Experiment()
-    server = Websocket(experiment)
-
-    experiment.start()
+    log_settings = {
+        "folder": log_folder,
+        "jsonl": args.log_jsonl,
+        "max_bytes": args.log_max_bytes,
+        "backups": args.log_backups,
+    }
+    logs.install(**log_settings)
+    stdout, stderr = sys.stdout, sys.stderr
+
+    if args.trace:
+        tracer = timing.Tracer()
+
+    # Every setup has its own queue, state, loop thread and optional worker
+    setups = args.setups or [DEFAULT_SETUP]
+    experiments = {name: Experiment(args.sensor_interval, name) for name in setups}
+    experiment = experiments[setups[0]]
+    server = Websocket(experiments)
+
+    for experiment_ in experiments.values():
+        # Setups sharing a pressure gauge must not open its port twice
+        experiment_.sensors = experiment.sensors
+        if args.worker:
+            experiment_.start_worker(cpus=args.cpus, priority=args.priority)
+        experiment_.start()
+    if args.profile_startup:
+        imports.report()
     asyncio.run(server.start())
 
 
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import io
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import websocket
+import numpy as np
+from collections import Counter
+
+from . import mod_experiment as experiment
+from . import mod_benchmark as benchmark
+
+## Simulated devices with small latencies, the faults are appended per run
+SIMULATION = "latency=0.0002;opc=0;noise=0.001"
+FAULTS = (
+    "spikes=0.01;spike=0.02;timeouts=0.0005;timeout=0.2;malformed=0.0005;unlocked=0.1"
+)
+
+## Messages reporting a failed measurement
+ERROR_ACTIONS = ("error", "uerror")
+
+
+def measurement_dicts(n_measurements, points, faults):
+    # Every device gets its own seed, otherwise all measurements fail identically
+    dicts = []
+    for i in range(n_measurements):
+        addresses = {
+            key: f"{SIMULATION};{faults};seed={3 * i + j}"
+            for j, key in enumerate(("probe", "pump", "lockin"))
+        }
+        dicts.append(
+            benchmark.measurement_dict(
+                static_probeaddress=addresses["probe"],
+                static_pumpaddress=addresses["pump"],
+                static_lockinaddress=addresses["lockin"],
+                probe_frequency=benchmark.sweep(points),
+            )
+        )
+    return dicts
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((experiment.URL, 0))
+        return sock.getsockname()[1]
+
+
+class Recorder(list):
+    # Timestamped messages sent by the experiment
+
+    def __init__(self, send_all=None):
+        super().__init__()
+        self.forward = send_all
+
+    def __call__(self, dict_):
+        self.append((time.perf_counter(), dict_))
+        if self.forward:
+            self.forward(dict_)
+
+    def times(self, actions):
+        return [t for t, dict_ in self if dict_.get("action") in actions]
+
+
+def start_server(experiment_):
+    experiment.PORT = free_port()
+    server = experiment.Websocket(experiment_)
+    thread = threading.Thread(target=asyncio.run, args=[server.start()])
+    thread.daemon = True
+    thread.start()
+
+    while not server.loop:
+        time.sleep(0.01)
+    return server
+
+
+def connect(timeout=1):
+    return websocket.create_connection(
+        f"ws://{experiment.URL}:{experiment.PORT}", timeout=timeout
+    )
+
+
+def observe(stop, received):
+    # Well-behaved client, counts the broadcasts it receives
+    connection = connect(0.1)
+    while not stop.is_set():
+        try:
+            message = json.loads(connection.recv())
+            received[message.get("action")] += 1
+        except websocket.WebSocketTimeoutException:
+            continue
+    connection.close()
+
+
+def drop_clients(stop, lifetime, rng, counts):
+    # Clients that disappear without a closing handshake, e.g. by a lost network
+    while not stop.is_set():
+        try:
+            connection = connect()
+        except OSError:
+            time.sleep(0.01)
+            continue
+        counts["connections"] += 1
+
+        end = time.perf_counter() + rng.exponential(lifetime)
+        while not stop.is_set() and time.perf_counter() < end:
+            try:
+                connection.settimeout(max(end - time.perf_counter(), 0.001))
+                connection.recv()
+            except (websocket.WebSocketException, OSError):
+                break
+
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.sock.close()
+        counts["drops"] += 1
+
+
+def run(dicts, clients=0, lifetime=0.5, confirm=0, seed=0):
+    experiment_ = experiment.Experiment()
+    recorder = Recorder()
+    if clients:
+        server = start_server(experiment_)
+        recorder.forward = server.send_all
+    experiment_.send_all = recorder
+    experiment.experiment = experiment.server = experiment_
+
+    stop = threading.Event()
+    threads = []
+    received, counts = Counter(), Counter()
+    if clients:
+        threads.append(threading.Thread(target=observe, args=(stop, received)))
+        for i in range(clients):
+            rng = np.random.default_rng(seed + i)
+            threads.append(
+                threading.Thread(
+                    target=drop_clients, args=(stop, lifetime, rng, counts)
+                )
+            )
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    measurements = [experiment.Measurement(dict_) for dict_ in dicts]
+    experiment_.queue.extend(measurements)
+
+    loop_thread = threading.Thread(target=experiment_.loop)
+    loop_thread.daemon = True
+    start = time.perf_counter()
+    loop_thread.start()
+
+    # Device errors wait for the user, who confirms after the given delay
+    while experiment_.queue or experiment_.state != "waiting":
+        if experiment_.state == "deviceerror":
+            time.sleep(confirm)
+            experiment_.state = "running"
+        time.sleep(0.01)
+    end = max(
+        t
+        for t, dict_ in recorder
+        if dict_.get("action") == "state" and dict_.get("state") == "waiting"
+    )
+    wall = end - start
+
+    time.sleep(0.2)
+    stop.set()
+    for thread in threads:
+        thread.join(2)
+
+    completed = [x for x in measurements if x.get("general_dateend")]
+    points = sum(len(x.result) for x in completed)
+
+    # Recovery is the time from a failure until the next measurement starts acquiring
+    starts = recorder.times(("measurement",))
+    recoveries = []
+    for error_time in recorder.times(ERROR_ACTIONS):
+        later = [t for t in starts if t > error_time]
+        if later:
+            recoveries.append(later[0] - error_time)
+
+    errors = Counter(
+        dict_["error"].splitlines()[-1] if dict_.get("error") else dict_.get("action")
+        for _, dict_ in recorder
+        if dict_.get("action") in ERROR_ACTIONS
+    )
+    sent = Counter(dict_.get("action") for _, dict_ in recorder)
+
+    results = {
+        "measurements": len(measurements),
+        "completed": len(completed),
+        "points": points,
+        "wall": wall,
+        "points_per_second": points / wall,
+        "errors": dict(errors),
+        "recovery_mean": float(np.mean(recoveries)) if recoveries else None,
+        "recovery_max": float(np.max(recoveries)) if recoveries else None,
+    }
+    if clients:
+        results.update(
+            {
+                "client_connections": counts["connections"],
+                "client_drops": counts["drops"],
+                "broadcasts_sent": sent["measurement"],
+                "broadcasts_received": received["measurement"],
+            }
+        )
+    return results
+
+
+def report(baseline, faults):
+    print(f"{'':>22}  {'baseline':>12}  {'faults':>12}")
+    for key in ("completed", "points", "wall", "points_per_second"):
+        print(f"{key:>22}  {baseline[key]:12.4g}  {faults[key]:12.4g}")
+    print(
+        f"{'degradation':>22}  {faults['points_per_second'] / baseline['points_per_second']:27.2f} x"
+    )
+
+    for key in ("recovery_mean", "recovery_max"):
+        if faults[key] is not None:
+            print(f"{key:>22}  {faults[key]:27.3f} s")
+    for key in (
+        "client_connections",
+        "client_drops",
+        "broadcasts_sent",
+        "broadcasts_received",
+    ):
+        if key in faults:
+            print(f"{key:>22}  {faults[key]:27d}")
+    for error, count in faults["errors"].items():
+        print(f"{count:>22}  {error}")
+
+
+def start():
+    parser = argparse.ArgumentParser(prog="trace_faults")
+    parser.add_argument(
+        "--measurements", type=int, default=20, help="Queued measurements"
+    )
+    parser.add_argument(
+        "--points", type=int, default=500, help="Points per measurement"
+    )
+    parser.add_argument(
+        "--faults",
+        default=FAULTS,
+        help="Injected faults in the settings format of the simulated devices",
+    )
+    parser.add_argument(
+        "--clients", type=int, default=0, help="Websocket clients that drop randomly"
+    )
+    parser.add_argument(
+        "--lifetime", type=float, default=0.5, help="Mean lifetime of the clients in s"
+    )
+    parser.add_argument(
+        "--confirm",
+        type=float,
+        default=0,
+        help="Delay until device errors are confirmed in s",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the clients")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    # Keep the data, logs and runtime model of the real setup untouched
+    with tempfile.TemporaryDirectory() as directory:
+        experiment.homefolder = directory
+        experiment.stderr = io.StringIO()
+
+        kwargs = {
+            "clients": args.clients,
+            "lifetime": args.lifetime,
+            "confirm": args.confirm,
+            "seed": args.seed,
+        }
+        baseline = run(measurement_dicts(args.measurements, args.points, ""), **kwargs)
+        faults = run(
+            measurement_dicts(args.measurements, args.points, args.faults), **kwargs
+        )
+
+    report(baseline, faults)
+
+    if args.output:
+        with open(args.output, "w+", encoding="utf-8") as file:
+            json.dump({"baseline": baseline, "faults": faults}, file, indent=2)
+
+
+if __name__ == "__main__":
+    start()
@@ -40,6 +40,7 @@ import wrapt
 import random
 import json
 import queue
+import sqlite3
 import threading
 import websocket
 import configparser
@@ -51,7 +52,6 @@ import webbrowser
 import pyckett
 
 from multiprocessing import shared_memory, resource_tracker
-from scipy import optimize, special, signal
 
 from PyQt6.QtCore import *
 from PyQt6.QtWidgets import *
@@ -64,6 +64,8 @@ from matplotlib.backends.backend_qt5agg import FigureCanvas, NavigationToolbar2Q
 QLocale.setDefault(QLocale("en_EN"))
 
 from . import mod_devices as devices
+from . import mod_imports as imports
+from . import mod_catalogue as catalogue
 
 
 ##
@@ -222,6 +224,9 @@ class MainWindow(QMainWindow):
         self.timeindicator = QQ(QLabel, text="")
         self.statusbar.addWidget(self.timeindicator)
 
+        self.etaindicator = QQ(QLabel, text="")
+        self.statusbar.addWidget(self.etaindicator)
+
         self.stateindicator = QQ(QLabel, text="")
         self.statusbar.addWidget(self.stateindicator)
 
@@ -348,6 +353,15 @@ class MainWindow(QMainWindow):
             queue = message["data"]
             self.queuewindow.update_queue(queue)
 
+        elif action == "eta":
+            # Hours are not wrapped at a day, queues can run over several days
+            format_time = (
+                lambda x: f"{int(x) // 3600}:{int(x) % 3600 // 60:02d}:{int(x) % 60:02d}"
+            )
+            remaining = format_time(message["measurement"])
+            queue = format_time(message["queue"])
+            self.etaindicator.setText(f"Remaining: {remaining}  Queue: {queue}")
+
         elif action == "state":
             state = message["state"]
             self.update_state(state)
@@ -386,6 +400,22 @@ class MainWindow(QMainWindow):
             folder = message["folder"]
             webbrowser.open("file://" + folder)
 
+        elif action == "timings":
+            timings = message["timings"]
+            if not timings:
+                self.notification("No timings are available yet.")
+                return
+
+            lines = [
+                f"{phase}: {values['count']} x {values['mean']*1000:.2f} ms (max {values['max']*1000:.2f} ms, total {values['total']:.1f} s)"
+                for phase, values in timings["phases"].items()
+            ]
+            self.notification("Timings<br>" + "<br>".join(lines))
+
+        elif action == "setups":
+            setups = ", ".join(message["setups"])
+            self.notification(f"Connected to setup '{message['setup']}' of {setups}.")
+
         else:
             self.notification(
                 f"<span style='color:#ff0000;'>ERROR</span>: Received a message with the unknown action '{action}' {message=}."
@@ -657,6 +687,14 @@ class MainWindow(QMainWindow):
                     ),
                     tooltip="Add Lin file(s)",
                 ),
+                QQ(
+                    QAction,
+                    parent=self,
+                    text="&Find Measurements",
+                    change=lambda x: CatalogueDialog().exec(),
+                    tooltip="Search the catalogue of saved measurements and load them",
+                    shortcut="Ctrl+F",
+                ),
                 None,
                 QQ(
                     QAction,
@@ -814,6 +852,13 @@ class MainWindow(QMainWindow):
                     tooltip="Open folder where measurements are stored",
                     change=lambda x: ws.send({"action": "measurements_folder"}),
                 ),
+                QQ(
+                    QAction,
+                    parent=self,
+                    text="&Show Timings",
+                    tooltip="Show where the time of the current measurement is spent",
+                    change=lambda x: ws.send({"action": "timings"}),
+                ),
                 None,
                 self.pause_after_abort_action,
                 QQ(
@@ -1533,6 +1578,12 @@ class Websocket:
         message = {"action": "opened"}
         mw.signalclass.websocketaction.emit(message)
 
+        # Servers running several setups send the messages of the subscribed one
+        setup = mw.config["flag_setup"]
+        if setup:
+            self.send({"action": "setup", "setup": setup})
+            self.send({"action": "setups"})
+
     def send(self, message):
         self.websocket.send(json.dumps(message))
 
@@ -2317,7 +2368,7 @@ class QueueWindow(EQDockWidget):
 
             measurement_string.append(f"{probe_string:25}")
 
-            if measurement["general_mode"] != devices.modes[0]:
+            if measurement["general_mode"] not in devices.probeonly_modes:
                 measurement_string.append(spacer)
                 pump, pump_width = frequencies["pump"]
                 pump_string = f"Pump: {pump:10.2f}"
@@ -2616,6 +2667,7 @@ class GeneralWindow(MeasWidget):
             "Notification Address": QQ(QLineEdit, "general_notificationaddress"),
             "DM Jump": QQ(QDoubleSpinBox, "general_dmjump", range=(0, None)),
             "DM Period": QQ(QDoubleSpinBox, "general_dmperiod", range=(0, None)),
+            "DM Block Size": QQ(QSpinBox, "general_dmblocksize", range=(1, None)),
         }
         return super().__init__(parent)
 
@@ -2662,6 +2714,7 @@ class ProbeWindow(MeasWidget):
         self.widgets = {
             "Power": QQ(QSpinBox, "probe_power", range=(1, None)),
             "Frequency": QQ(QSweep, "probe_frequency"),
+            "Sweep Time": QQ(QDoubleSpinBox, "probe_sweeptime", range=(0, None)),
         }
         return super().__init__(parent)
 
@@ -2703,6 +2756,19 @@ class LockInWindow(MeasWidget):
             "FM Deviation": QQ(QDoubleSpinBox, "lockin_fmdeviation", range=(0, None)),
             "Timeconstant": self.tc_widget,
             "Delay Time": QQ(QDoubleSpinBox, "lockin_delaytime", range=(0, None)),
+            "Settle Mode": QQ(
+                QComboBox, "lockin_settlemode", options=devices.settlemodes
+            ),
+            "Settle Tolerance": QQ(
+                QDoubleSpinBox, "lockin_settletolerance", range=(0, None)
+            ),
+            "Max Delay Time": QQ(
+                QDoubleSpinBox, "lockin_settlemaxdelay", range=(0, None)
+            ),
+            "Acquisition": QQ(
+                QComboBox, "lockin_acquisition", options=devices.acquisitionmodes
+            ),
+            "Harmonics": QQ(QLineEdit, "lockin_harmonics"),
             "Range": self.sen_widget,
             "AC Gain": self.acgain_widget,
             "Iterations": QQ(QSpinBox, "lockin_iterations", range=(1, None)),
@@ -2713,11 +2779,10 @@ class LockInWindow(MeasWidget):
 
     def update_lockin_options(self):
         current_key = mw.config["static_lockindevice"]
-        for key, class_ in devices.deviceclasses["lockin"].items():
-            if key == current_key:
-                current_class = class_
-                break
-        else:
+        # Only the selected driver is imported
+        try:
+            current_class = devices.deviceclasses["lockin"][current_key]
+        except KeyError:
             raise ValueError(
                 "Did not find your currently used lockin in the devices module."
             )
@@ -3378,6 +3443,185 @@ class ConsoleDialog(QDialog):
         mw.notification("\n".join(message))
 
 
+class CatalogueDialog(QDialog):
+    backfillprogress = pyqtSignal(int)
+    backfillfinished = pyqtSignal(dict)
+
+    columns = {
+        "date_start": "Start",
+        "mode": "Mode",
+        "molecule": "Molecule",
+        "user": "User",
+        "project": "Project",
+        "probe_min": "Probe Min",
+        "probe_max": "Probe Max",
+        "pump_min": "Pump",
+        "pressure_start": "Pressure",
+        "duration": "Duration",
+        "path": "File",
+    }
+
+    def __init__(self):
+        super().__init__()
+        QShortcut("Esc", self).activated.connect(lambda: self.predone(0))
+
+        self.setWindowTitle(f"Find Measurements")
+        self.resize(
+            mw.config["cataloguedialog_width"], mw.config["cataloguedialog_height"]
+        )
+
+        self.catalogue = catalogue.Catalogue()
+        self.results = []
+        values = mw.config["cataloguedialog_query"]
+
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+        form_layout = QGridLayout()
+        layout.addLayout(form_layout)
+
+        self.widgets = {}
+        for i, key in enumerate(("molecule", "mode", "user", "project")):
+            self.widgets[key] = QQ(
+                QLineEdit,
+                value=values.get(key, ""),
+                placeholder="Any, * can be used as wildcard",
+                completer=QCompleter(self.catalogue.values(key)),
+            )
+            form_layout.addWidget(QQ(QLabel, text=f"{key.capitalize()}: "), i, 0)
+            form_layout.addWidget(self.widgets[key], i, 1)
+
+        for i, (key, placeholder) in enumerate(
+            (
+                ("frequency", "Any, e.g. 60500 or 60000-61000"),
+                ("pressure", "Any, e.g. 0.001-0.01"),
+            ),
+            start=4,
+        ):
+            self.widgets[key] = QQ(
+                QLineEdit, value=values.get(key, ""), placeholder=placeholder
+            )
+            form_layout.addWidget(QQ(QLabel, text=f"{key.capitalize()}: "), i, 0)
+            form_layout.addWidget(self.widgets[key], i, 1)
+
+        self.table = QTableWidget()
+        self.table.setColumnCount(len(self.columns))
+        self.table.setHorizontalHeaderLabels(list(self.columns.values()))
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(self.table)
+
+        self.status = QQ(QLabel, text="")
+        layout.addWidget(self.status)
+
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addStretch()
+        self.buttons = {}
+        for text, change in (
+            ("Search", lambda x: self.search()),
+            ("Rescan Data Folder", lambda x: self.start_backfill()),
+            ("Load", lambda x: self.load(keep_old=False)),
+            ("Add", lambda x: self.load(keep_old=True)),
+            ("Cancel", lambda x: self.predone(0)),
+        ):
+            self.buttons[text] = QQ(QPushButton, text=text, change=change)
+            buttons_layout.addWidget(self.buttons[text])
+        buttons_layout.addStretch()
+        layout.addLayout(buttons_layout)
+
+        self.backfillprogress.connect(
+            lambda x: self.status.setText(
+                f"Scanning the data folder, read {x} files..."
+            )
+        )
+        self.backfillfinished.connect(self.finish_backfill)
+
+        self.search()
+
+    def get_query(self):
+        query = {
+            key: self.widgets[key].text().strip()
+            for key in ("molecule", "mode", "user", "project")
+        }
+        for key in ("frequency", "pressure"):
+            text = self.widgets[key].text().strip()
+            query[key] = catalogue.parse_range(text) if text else None
+        return query
+
+    def search(self):
+        try:
+            query = self.get_query()
+        except ValueError:
+            self.status.setText("The frequency or pressure could not be understood.")
+            return
+
+        start_time = time.perf_counter()
+        self.results = self.catalogue.query(**query)
+        duration = time.perf_counter() - start_time
+
+        self.table.setRowCount(len(self.results))
+        for row, result in enumerate(self.results):
+            for column, key in enumerate(self.columns):
+                value = result[key]
+                if isinstance(value, float):
+                    value = (
+                        f"{value:.4g}" if key == "pressure_start" else f"{value:.2f}"
+                    )
+                self.table.setItem(
+                    row, column, QTableWidgetItem("" if value is None else str(value))
+                )
+        self.table.resizeColumnsToContents()
+        self.status.setText(
+            f"Found {len(self.results)} files in {duration * 1000:.1f} ms."
+        )
+
+    def start_backfill(self):
+        self.buttons["Rescan Data Folder"].setEnabled(False)
+        self.status.setText("Scanning the data folder...")
+        self.backfill(self.catalogue.filename)
+
+    @threading_d
+    def backfill(self, filename):
+        # Scanning reads every new file, the results are reported to the GUI thread
+        folder = os.path.join(os.path.dirname(filename), "data")
+        try:
+            with catalogue.Catalogue(filename) as catalogue_:
+                result = catalogue_.backfill(folder, self.backfillprogress.emit)
+        except (sqlite3.Error, OSError) as E:
+            result = {"error": str(E)}
+        self.backfillfinished.emit(result)
+
+    def finish_backfill(self, result):
+        self.buttons["Rescan Data Folder"].setEnabled(True)
+        if "error" in result:
+            self.status.setText(f"Could not scan the data folder: {result['error']}")
+            return
+
+        self.search()
+        self.status.setText(
+            f"Added {result['added']} and removed {result['removed']} files, {len(result['errors'])} files could not be read. "
+            + self.status.text()
+        )
+
+    def load(self, keep_old):
+        rows = sorted({index.row() for index in self.table.selectedIndexes()})
+        if not rows:
+            rows = range(len(self.results))
+        filenames = [self.results[row]["path"] for row in rows]
+        if filenames:
+            mw.load_file("exp", add_files=filenames, keep_old=keep_old)
+        self.predone(1)
+
+    def predone(self, val):
+        mw.config["cataloguedialog_query"] = {
+            key: widget.text() for key, widget in self.widgets.items()
+        }
+        mw.config["cataloguedialog_width"] = self.geometry().width()
+        mw.config["cataloguedialog_height"] = self.geometry().height()
+        self.catalogue.close()
+        self.done(val)
+
+
 ##
 ## Global Functions
 ##
@@ -3660,6 +3904,7 @@ config_specs = {
     "general_notificationaddress": ["", str],
     "general_dmjump": [120, float],
     "general_dmperiod": [5, float],
+    "general_dmblocksize": [1, int],
     "static_probeaddress": ["", str],
     "static_probedevice": ["MockDevice", str],
     "static_probemultiplication": [1, int],
@@ -3671,6 +3916,7 @@ config_specs = {
     "static_skipreset": [False, bool],
     "static_pressuregaugaaddress": ["", str],
     "probe_power": [10, int],
+    "probe_sweeptime": [0, float],
     "probe_frequency": [
         {
             "mode": "sweep",
@@ -3694,6 +3940,11 @@ config_specs = {
     "lockin_fmdeviation": [180, float],
     "lockin_timeconstant": ["20ms", str],
     "lockin_delaytime": [25, float],
+    "lockin_settlemode": [devices.settlemodes[0], str],
+    "lockin_settletolerance": [1, float],
+    "lockin_settlemaxdelay": [500, float],
+    "lockin_acquisition": [devices.acquisitionmodes[0], str],
+    "lockin_harmonics": ["2", str],
     "lockin_sensitivity": ["500mV", str],
     "lockin_acgain": ["0dB", str],
     "lockin_iterations": [1, int],
@@ -3741,12 +3992,16 @@ config_specs = {
     "flag_logmaxrows": [10000, int],
     "flag_updateplot": [200, int],
     "flag_maxmeasurementspermessage": [200, int],
+    "flag_setup": ["", str],
     "commandlinedialog_width": [500, int],
     "commandlinedialog_height": [250, int],
     "commandlinedialog_commands": [[], list],
     "commandlinedialog_current": [1, int],
     "batchdialog_width": [1000, int],
     "batchdialog_height": [500, int],
+    "cataloguedialog_width": [1000, int],
+    "cataloguedialog_height": [500, int],
+    "cataloguedialog_query": [{}, dict],
     "files_exp": [{}, dict],
     "files_cat": [{}, dict],
     "files_lin": [{}, dict],
@@ -3766,6 +4021,10 @@ def start():
     mw = MainWindow()
     ws = Websocket()
 
+    # Reported once the event loop runs, i.e. the window is shown
+    if "--profile-startup" in sys.argv:
+        QTimer.singleShot(0, imports.report)
+
     sys.exit(app.exec())
 
 
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import sys
+import time
+import importlib
+
+## Execution times of the imported modules as (cumulative, self) in seconds
+records = {}
+_stack = []
+_start = None
+
+
+class LazyModule:
+    # Stands in for a module that is only imported on first use, e.g. driver backends
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attribute):
+        module = self._module
+        if module is None:
+            module = self.__dict__["_module"] = importlib.import_module(self._name)
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        state = "loaded" if self._module else "not loaded"
+        return f"<LazyModule '{self._name}' ({state})>"
+
+
+def timed_exec_module(loader, name):
+    exec_module = loader.exec_module
+
+    def wrapper(module):
+        start = time.perf_counter()
+        _stack.append(0.0)
+        try:
+            return exec_module(module)
+        finally:
+            children = _stack.pop()
+            total = time.perf_counter() - start
+            if _stack:
+                _stack[-1] += total
+            records[name] = (total, total - children)
+
+    loader.exec_module = wrapper
+
+
+class TimingFinder:
+    # Meta path finder that times the execution of every module found by the others
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            find_spec = getattr(finder, "find_spec", None)
+            if finder is self or find_spec is None:
+                continue
+            spec = find_spec(name, path, target)
+            if spec is None:
+                continue
+            # Builtin and frozen modules share their loader class
+            loader = spec.loader
+            if loader is not None and not isinstance(loader, type):
+                timed_exec_module(loader, name)
+            return spec
+        return None
+
+
+def enable():
+    global _start
+
+    if _start is None:
+        _start = time.perf_counter()
+        sys.meta_path.insert(0, TimingFinder())
+
+
+def report(limit=25, file=None):
+    file = file or sys.stderr
+    if _start is None:
+        return
+
+    elapsed = time.perf_counter() - _start
+    # The self times do not overlap, their sum is the total time spent importing
+    total = sum(self_time for _, self_time in records.values())
+
+    file.write(
+        f"Startup took {elapsed:.3f} s, importing {len(records)} modules took {total:.3f} s\n"
+    )
+    file.write(f"{'cumulative':>12}  {'self':>10}  module\n")
+    items = sorted(records.items(), key=lambda x: x[1][0], reverse=True)
+    for name, (cumulative, self_time) in items[:limit]:
+        file.write(f"{cumulative:10.3f} s  {self_time:8.3f} s  {name}\n")
+    file.flush()
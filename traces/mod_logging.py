@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from collections import deque
+from datetime import datetime, date
+
+## Rotation of the log files and batching of the background writer
+MAX_BYTES = 10 * 1024**2
+BACKUPS = 5
+INTERVAL = 0.2
+MAX_PENDING = 2**20
+
+
+class RotatingFile:
+    # Log file that is rotated when it exceeds max_bytes or when the day changes
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.open()
+
+    def open(self):
+        self.file = open(self.filename, "a+", encoding="utf-8")
+        self.size = self.file.tell()
+        if self.size:
+            self.day = date.fromtimestamp(os.path.getmtime(self.filename))
+        else:
+            self.day = date.today()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            source = f"{self.filename}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.filename}.{i + 1}")
+        if self.backups:
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+        self.open()
+
+    def write(self, data):
+        if self.size and (self.size > self.max_bytes or self.day != date.today()):
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class LogStream:
+    # Stands in for sys.stdout or sys.stderr, writing only enqueues the text
+
+    def __init__(self, writer, name, original):
+        self.writer = writer
+        self.name = name
+        self.original = original
+
+    def write(self, data):
+        self.writer.enqueue(self.name, data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class LogWriter:
+    # Background thread writing the enqueued text in batches to the console, the
+    # rotating log files and optionally a JSONL file with one record per line
+
+    def __init__(
+        self,
+        folder,
+        jsonl=False,
+        max_bytes=MAX_BYTES,
+        backups=BACKUPS,
+        interval=INTERVAL,
+        name="EXPERIMENT",
+    ):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.interval = interval
+
+        # Appending to and popping from a deque are atomic, producers never wait
+        self.queue = deque()
+        self.dropped = 0
+        self.streams = {}
+        self.files = {}
+        self.partial = {}
+        self.jsonl = (
+            RotatingFile(os.path.join(folder, f"{name}.jsonl"), max_bytes, backups)
+            if jsonl
+            else None
+        )
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=[])
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def stream(self, name, filename, original):
+        self.files[name] = RotatingFile(
+            os.path.join(self.folder, filename), self.max_bytes, self.backups
+        )
+        self.partial[name] = ""
+        self.streams[name] = LogStream(self, name, original)
+        return self.streams[name]
+
+    def enqueue(self, name, data):
+        # A stalled disk drops messages instead of growing without limit
+        if len(self.queue) >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self.queue.append((time.time(), name, data))
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write_pending()
+        self.write_pending()
+
+    def write_pending(self):
+        batches = {}
+        records = []
+        while self.queue:
+            timestamp, name, data = self.queue.popleft()
+            batches.setdefault(name, []).append(data)
+            if self.jsonl:
+                records.extend(self.lines(timestamp, name, data))
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            batches.setdefault("stderr", []).append(
+                f"{dropped} log messages were dropped.\n"
+            )
+
+        for name, texts in batches.items():
+            text = "".join(texts)
+            stream = self.streams.get(name)
+            try:
+                if stream:
+                    stream.original.write(text)
+                    stream.original.flush()
+                self.files[name].write(text)
+                self.files[name].flush()
+            except (OSError, ValueError, KeyError):
+                pass
+
+        if records:
+            try:
+                self.jsonl.write("".join(records))
+                self.jsonl.flush()
+            except (OSError, ValueError):
+                pass
+
+    def lines(self, timestamp, name, data):
+        # Writes are not aligned to lines, incomplete lines wait for the next write
+        text = self.partial[name] + data
+        *lines, self.partial[name] = text.split("\n")
+        time_string = datetime.fromtimestamp(timestamp).isoformat()
+        return [
+            json.dumps({"time": time_string, "stream": name, "message": line}) + "\n"
+            for line in lines
+            if line
+        ]
+
+    def close(self):
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.thread.join()
+
+        # Incomplete last lines
+        if self.jsonl:
+            for name in self.partial:
+                self.jsonl.write("".join(self.lines(time.time(), name, "\n")))
+
+        for name, stream in self.streams.items():
+            if getattr(sys, name) is stream:
+                setattr(sys, name, stream.original)
+        for file in self.files.values():
+            file.close()
+        if self.jsonl:
+            self.jsonl.close()
+
+
+def install(
+    folder, jsonl=False, max_bytes=MAX_BYTES, backups=BACKUPS, name="EXPERIMENT"
+):
+    # Replaces sys.stdout and sys.stderr, the console still receives all output.
+    # Every process needs its own name, the files are rotated by a single writer.
+    writer = LogWriter(folder, jsonl, max_bytes, backups, name=name)
+    sys.stdout = writer.stream("stdout", f"{name}.txt", sys.stdout)
+    sys.stderr = writer.stream("stderr", f"{name}.err", sys.stderr)
+    return writer
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import os
+import re
+import sqlite3
+import warnings
+import numpy as np
+from collections import OrderedDict
+
+from . import mod_catalogue as catalogue
+
+## Points of an overview and most rows returned before a range is decimated
+POINTS = 1000
+MAX_ROWS = 10000
+
+## Saved measurements kept open for further queries
+CACHE = 8
+
+## Columns of the rows, the values of the lock-in channels follow
+axes = {
+    "probe": 0,
+    "pump": 1,
+}
+
+date_pattern = re.compile(r"\d{4}-\d{2}-\d{2}$")
+
+
+class QueryError(Exception):
+    pass
+
+
+class Source:
+    # Rows of a measurement, sorted by frequency on first use
+    def __init__(self, id_, rows, live=False):
+        # Rows without frequencies were never measured, e.g. after an abort
+        measured = ~np.isnan(rows[:, : len(axes)]).any(axis=1)
+        if not measured.all():
+            rows = rows[measured]
+
+        self.id = id_
+        self.rows = rows
+        self.live = live
+        self.orders = {}
+
+    def sorted(self, axis):
+        column = axes[axis]
+        if column not in self.orders:
+            order = np.argsort(self.rows[:, column], kind="stable")
+            self.orders[column] = (order, np.asarray(self.rows[order, column]))
+        return self.orders[column]
+
+    def select(self, axis, range_=None):
+        # Rows within the frequency range, sorted by frequency
+        order, frequencies = self.sorted(axis)
+        if range_ is None:
+            return order
+        low, high = range_
+        start = frequencies.searchsorted(low, side="left")
+        stop = frequencies.searchsorted(high, side="right")
+        return order[start:stop]
+
+    def window(self, axis="probe", range_=None, limit=MAX_ROWS):
+        indices = self.select(axis, range_)
+        if len(indices) > limit:
+            return {"decimated": True, **self.overview(axis, range_, limit)}
+        return {"decimated": False, "rows": self.rows[indices].tolist()}
+
+    def overview(self, axis="probe", range_=None, points=POINTS):
+        # Minimum and maximum of every value column per bin keep the peaks visible
+        indices = self.select(axis, range_)
+        column = axes[axis]
+        n_bins = max(1, points // 2)
+        if not len(indices):
+            return {"frequencies": [], "counts": [], "min": [], "max": []}
+
+        rows = self.rows[indices]
+        frequencies = rows[:, column]
+        low, high = range_ if range_ else (frequencies[0], frequencies[-1])
+        width = (high - low) / n_bins or 1
+        bins = np.clip(((frequencies - low) / width).astype(np.int64), 0, n_bins - 1)
+
+        # The rows are sorted, every bin is a contiguous slice
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        values = rows[:, 2:]
+        with np.errstate(invalid="ignore"):
+            minima = np.fmin.reduceat(values, starts, axis=0)
+            maxima = np.fmax.reduceat(values, starts, axis=0)
+        return {
+            "frequencies": (low + (bins[starts] + 0.5) * width).tolist(),
+            "counts": np.diff(np.r_[starts, len(rows)]).tolist(),
+            "min": np.where(np.isnan(minima), None, minima).tolist(),
+            "max": np.where(np.isnan(maxima), None, maxima).tolist(),
+        }
+
+    def statistics(self, axis="probe", range_=None):
+        indices = self.select(axis, range_)
+        rows = self.rows[indices]
+        values = rows[:, 2:]
+        if not len(rows):
+            return {"rows": 0}
+
+        frequencies = rows[:, axes[axis]]
+        # Columns without any value are reported as None
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            statistics = {
+                "mean": np.nanmean(values, axis=0),
+                "std": np.nanstd(values, axis=0),
+                "min": np.nanmin(values, axis=0),
+                "max": np.nanmax(values, axis=0),
+            }
+        return {
+            "rows": len(rows),
+            "frequency_min": float(frequencies[0]),
+            "frequency_max": float(frequencies[-1]),
+            "missing": np.isnan(values).sum(axis=0).tolist(),
+            **{
+                key: np.where(np.isnan(value), None, value).tolist()
+                for key, value in statistics.items()
+            },
+        }
+
+    def query(self, kind, axis="probe", range_=None, points=POINTS, limit=MAX_ROWS):
+        if axis not in axes:
+            raise QueryError(f"The axis has to be in {list(axes)} but is '{axis}'.")
+        for name, value in (("points", points), ("limit", limit)):
+            if not isinstance(value, int) or value < 1:
+                raise QueryError(
+                    f"The number of {name} has to be a positive integer but is {value}."
+                )
+        if range_ is not None:
+            try:
+                low, high = sorted(float(x) for x in range_)
+            except (TypeError, ValueError):
+                raise QueryError(
+                    f"The range has to be given as [low, high] but is {range_}."
+                )
+            range_ = (low, high)
+
+        if kind == "rows":
+            result = self.window(axis, range_, limit)
+        elif kind == "overview":
+            result = self.overview(axis, range_, points)
+        elif kind == "statistics":
+            result = self.statistics(axis, range_)
+        else:
+            raise QueryError(
+                f"The query '{kind}' is not understood, please use 'rows', 'overview' or 'statistics'."
+            )
+        return {"live": self.live, "shape": self.rows.shape, **result}
+
+
+def find_saved(folder, id_):
+    # Data folders are named by date, further setups have their own folder of dates
+    filename = f"{id_}.npy"
+    if not os.path.isdir(folder):
+        return None
+    for entry in os.scandir(folder):
+        if not entry.is_dir():
+            continue
+        if date_pattern.match(entry.name):
+            directories = [entry.path]
+        else:
+            directories = [x.path for x in os.scandir(entry.path) if x.is_dir()]
+        for directory in directories:
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+class Queries:
+    # Measurements by id, from the streams of the running ones or the saved raw data
+    def __init__(self, folder, streamer=None, cache=CACHE, database=None):
+        self.folder = folder
+        self.database = database
+        self.streamer = streamer
+        self.cache = cache
+        self.saved = OrderedDict()
+
+    def live(self, id_):
+        if not self.streamer:
+            return None
+        for stream in list(self.streamer.streams.values()):
+            # Queries run outside of the event loop, only the streams move the cursor
+            buffer = stream.buffer
+            if stream.measurement == id_ and buffer is not None:
+                return Source(id_, buffer[: stream.rows], live=not stream.finished)
+        return None
+
+    def source(self, id_):
+        if not isinstance(id_, str) or not re.fullmatch(r"[0-9a-f]+", id_):
+            raise QueryError(f"The measurement id '{id_}' is not valid.")
+
+        if id_ in self.saved:
+            self.saved.move_to_end(id_)
+            return self.saved[id_]
+
+        # Finished streams are only used until their data is saved
+        source = self.live(id_)
+        path = None if source and source.live else self.find(id_)
+        if path:
+            source = Source(id_, np.load(path, mmap_mode="r"))
+            self.saved[id_] = source
+            while len(self.saved) > self.cache:
+                self.saved.popitem(last=False)
+        if source is None:
+            raise QueryError(f"No measurement with the id '{id_}' was found.")
+        return source
+
+    def find(self, id_):
+        # The catalogue knows the files of the saved measurements without scanning
+        if self.database and os.path.isfile(self.database):
+            try:
+                with catalogue.Catalogue(self.database) as catalogue_:
+                    records = catalogue_.query(measurement=id_)
+            except sqlite3.Error:
+                records = []
+            for record in records:
+                if record["rawdata"] and os.path.isfile(record["rawdata"]):
+                    return record["rawdata"]
+        return find_saved(self.folder, id_)
+
+    def query(self, id_, kind, **kwargs):
+        return self.source(id_).query(kind, **kwargs)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import sys
+import csv
+import json
+import time
+import argparse
+import configparser
+
+from . import mod_experiment as experiment
+
+
+class BatchError(Exception):
+    pass
+
+
+def parse_value(value):
+    # Values of .meas files and tables are strings, numbers and sweeps are JSON
+    if value in ("True", "False"):
+        return value == "True"
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def read_meas(filename):
+    config_parser = configparser.ConfigParser(interpolation=None)
+    config_parser.read(filename, encoding="utf-8")
+
+    measurement = {}
+    for section in config_parser.sections():
+        for key, value in config_parser.items(section):
+            measurement[f"{section.lower()}_{key.lower()}"] = parse_value(value)
+    return measurement
+
+
+def read_queue(filename):
+    with open(filename, "r", encoding="utf-8") as file:
+        queue = json.load(file)
+    if isinstance(queue, dict):
+        queue = [queue]
+    return queue
+
+
+def read_table(filename, base):
+    # Every row overrides the base measurement, nested values are given as
+    # e.g. 'probe_frequency.center'
+    delimiter = "\t" if filename.endswith((".tsv", ".txt")) else ","
+    measurements = []
+    with open(filename, "r", encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file, delimiter=delimiter):
+            measurement = json.loads(json.dumps(base))
+            for key, value in row.items():
+                if not key or value is None or value == "":
+                    continue
+                key, _, subkey = key.strip().partition(".")
+                value = parse_value(value.strip())
+                if subkey:
+                    measurement.setdefault(key, {})[subkey] = value
+                else:
+                    measurement[key] = value
+            measurements.append(measurement)
+    return measurements
+
+
+def load_measurements(filenames, table=None):
+    measurements = []
+    for filename in filenames:
+        if filename.endswith(".meas"):
+            measurements.append(read_meas(filename))
+        else:
+            measurements.extend(read_queue(filename))
+
+    if table:
+        if len(measurements) != 1:
+            raise BatchError(
+                "A parameter table needs exactly one .meas file or queue entry as base."
+            )
+        measurements = read_table(table, measurements[0])
+    return measurements
+
+
+class BatchExperiment(experiment.Experiment):
+    # Experiment that reports to the terminal instead of the websocket clients
+
+    def __init__(self, on_deviceerror="stop", **kwargs):
+        super().__init__(**kwargs)
+        self.on_deviceerror = on_deviceerror
+        self.send_all = self.report
+        self.measurements = []
+        self.finished = []
+        self.failures = []
+        self.line = ""
+
+    @property
+    def total(self):
+        return len(self.measurements)
+
+    @property
+    def index(self):
+        # Position of the current measurement, errors can occur before it is started
+        for i, measurement in enumerate(self.measurements):
+            if measurement is self.current_measurement:
+                return i + 1
+        return 0
+
+    def print(self, message):
+        if self.line:
+            sys.stdout.write("\n")
+            self.line = ""
+        print(message)
+
+    def report(self, dict_):
+        action = dict_.get("action")
+        if action == "measurement":
+            self.print(f"[{self.index}/{self.total}] Started")
+
+        elif action == "eta":
+            if self.state != "running" or not self.index:
+                return
+            fraction, elapsed = self.progress
+            self.line = (
+                f"[{self.index}/{self.total}] {fraction:6.1%}  elapsed {elapsed:8.1f} s"
+                f"  remaining {dict_['measurement']:8.1f} s  queue {dict_['queue']:8.1f} s"
+            )
+            sys.stdout.write(f"\r{self.line}")
+            sys.stdout.flush()
+
+        elif action in ("error", "uerror"):
+            # Pressure readings fail without failing the measurement
+            if dict_["error"].startswith("Could not read pressure"):
+                self.print(f"Warning: {dict_['error']}")
+                return
+            self.failures.append((self.index, dict_["error"]))
+            self.print(f"[{self.index}/{self.total}] Failed: {dict_['error']}")
+
+    def update_runtime_model(self, measurement, summary, aborted):
+        super().update_runtime_model(measurement, summary, aborted)
+        self.finished.append((measurement, aborted))
+        status = "Aborted" if aborted else "Finished"
+        self.print(f"[{self.index}/{self.total}] {status}")
+
+    def run_batch(self, measurements):
+        self.measurements = list(measurements)
+        self.queue.extend(measurements)
+        start = time.perf_counter()
+        self.start()
+
+        while self.queue or self.state != "waiting":
+            try:
+                if self.state == "deviceerror":
+                    if self.on_deviceerror == "continue":
+                        self.state = "running"
+                    else:
+                        self.print("Stopping the batch after the device error.")
+                        self.queue.clear()
+                        self.state = "waiting"
+                time.sleep(0.05)
+            except KeyboardInterrupt:
+                self.print("Aborting the current measurement and the batch.")
+                self.queue.clear()
+                self.state = "aborting"
+
+        return time.perf_counter() - start
+
+
+def points(measurement, aborted):
+    # The result only exists if the measurement ran in this process
+    result = getattr(measurement, "result", None)
+    if result is not None:
+        return len(result)
+    return 0 if aborted else measurement.runtime_rows()
+
+
+def summary(experiment_, wall):
+    finished = [x for x, aborted in experiment_.finished if not aborted]
+    aborted = [x for x, aborted in experiment_.finished if aborted]
+    n_points = sum(points(x, y) for x, y in experiment_.finished)
+    return {
+        "measurements": experiment_.total,
+        "finished": len(finished),
+        "aborted": len(aborted),
+        "failed": len(experiment_.failures),
+        "skipped": experiment_.total
+        - len(experiment_.finished)
+        - len(experiment_.failures),
+        "points": n_points,
+        "wall": wall,
+        "points_per_second": n_points / wall if wall else 0,
+        "failures": [
+            {"measurement": index, "error": error}
+            for index, error in experiment_.failures
+        ],
+    }
+
+
+def start():
+    parser = argparse.ArgumentParser(
+        prog="trace_run",
+        description="Run measurements from queue or measurement files without the GUI",
+    )
+    parser.add_argument(
+        "files", nargs="+", help="Queue files (.queue) or measurement files (.meas)"
+    )
+    parser.add_argument(
+        "--table",
+        help="CSV (or TSV) table, every row overrides the values of the single measurement given",
+    )
+    parser.add_argument(
+        "--on-device-error",
+        choices=("stop", "continue"),
+        default="stop",
+        help="Stop the batch or continue with the next measurement after device errors",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Run the measurements in a separate worker process",
+    )
+    parser.add_argument("--output", help="JSON file the summary is written to")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only validate the measurements and print the predicted duration",
+    )
+    args = parser.parse_args()
+
+    experiment.stderr = sys.stderr
+    experiment_ = BatchExperiment(args.on_device_error)
+    experiment.experiment = experiment.server = experiment_
+
+    try:
+        dicts = load_measurements(args.files, args.table)
+        measurements = [experiment.Measurement(x) for x in dicts]
+    except (
+        BatchError,
+        OSError,
+        ValueError,
+        experiment.CustomError,
+        experiment.CustomValueError,
+    ) as E:
+        print(f"Could not load the measurements: {E}")
+        sys.exit(2)
+
+    predicted = sum(experiment_.predict(x)["total"] for x in measurements)
+    print(f"Loaded {len(measurements)} measurements, predicted {predicted:.1f} s.")
+    if args.dry_run:
+        return
+
+    if args.worker:
+        experiment_.start_worker()
+    wall = experiment_.run_batch(measurements)
+    results = summary(experiment_, wall)
+
+    experiment_.print(
+        f"{results['finished']} of {results['measurements']} measurements finished, "
+        f"{results['aborted']} aborted, {results['failed']} failed, {results['skipped']} skipped "
+        f"in {wall:.1f} s ({results['points_per_second']:.1f} points/s)."
+    )
+    for failure in results["failures"]:
+        error = failure["error"].strip().splitlines()[-1]
+        print(f"  Measurement {failure['measurement']}: {error}")
+
+    if args.output:
+        with open(args.output, "w+", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    sys.exit(0 if results["finished"] == results["measurements"] else 1)
+
+
+if __name__ == "__main__":
+    start()
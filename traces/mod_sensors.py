@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import time
+import threading
+from collections import deque
+
+from . import mod_imports as imports
+
+serial = imports.LazyModule("serial")
+
+## Options for Initializing Serial Devices
+kwargs_serial_gauge = {
+    "baudrate": 2400,
+    "timeout": 1,
+}
+
+## Translate units into mbar
+pressure_translation = {
+    "mbar": 1,
+    "torr": 1.33322,
+    "pa": 0.01,
+    "micron": 0.001,
+}
+
+## Seconds between two samples and number of samples kept per sensor
+INTERVAL = 1
+CAPACITY = 2**16
+
+
+class SensorError(Exception):
+    pass
+
+
+class PressureGauge:
+    def __init__(self, address):
+        self.connection = serial.Serial(port=address, **kwargs_serial_gauge)
+
+    def read(self):
+        self.connection.write("MES R TM2\r\n".encode("utf-8"))
+        response = self.connection.readline().decode("utf-8")
+        if not response:
+            raise SensorError("The pressure gauge did not respond.")
+
+        _, unit, value = response.split(":")[:3]
+        unit_factor = pressure_translation[unit.lower().strip()]
+        return float(value) * unit_factor / 1000
+
+    def close(self):
+        self.connection.close()
+
+
+## Sensor types available to the sampler
+sensors = {
+    "pressure": PressureGauge,
+}
+
+
+class Sampler:
+    # Reads a sensor on its own thread and keeps the timestamped values in a ring buffer
+
+    def __init__(self, sensor, address, interval=INTERVAL, capacity=CAPACITY):
+        self.sensor = sensor
+        self.address = address
+        self.interval = interval
+        self.samples = deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.error = None
+        self.sampled = threading.Event()
+        self.stop_event = threading.Event()
+
+        self.thread = threading.Thread(target=self.run, args=[])
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        # The port stays open between samples and is reopened after errors
+        device = None
+        next_time = time.perf_counter()
+        while not self.stop_event.is_set():
+            try:
+                if device is None:
+                    device = self.sensor(self.address)
+                value = device.read()
+                with self.lock:
+                    self.samples.append((time.perf_counter(), value))
+                self.error = None
+            except Exception as E:
+                self.error = f"{E}"
+                if device:
+                    try:
+                        device.close()
+                    except Exception:
+                        pass
+                device = None
+            self.sampled.set()
+
+            next_time = max(next_time + self.interval, time.perf_counter())
+            self.stop_event.wait(next_time - time.perf_counter())
+
+        if device:
+            device.close()
+
+    def latest(self, timeout=None):
+        # Most recent value, None if the last attempt failed
+        if timeout is None:
+            timeout = self.interval + kwargs_serial_gauge["timeout"] + 1
+        self.sampled.wait(timeout)
+        if self.error or not self.samples:
+            return None
+        return self.samples[-1][1]
+
+    def window(self, start, end):
+        with self.lock:
+            samples = [x for x in self.samples if start <= x[0] <= end]
+        return [x[0] for x in samples], [x[1] for x in samples]
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+class SensorService:
+    # Samplers of the slow sensors, started on first use and kept running
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.samplers = {}
+        self.lock = threading.Lock()
+
+    def sampler(self, kind, address):
+        address = address.strip()
+        if not address:
+            return None
+
+        with self.lock:
+            key = (kind, address)
+            if key not in self.samplers:
+                self.samplers[key] = Sampler(sensors[kind], address, self.interval)
+            return self.samplers[key]
+
+    def request(self, kind, address, method, args):
+        # Requests of remote samplers, the error is returned with the value
+        if method not in ("latest", "window"):
+            return None, f"The sampler method '{method}' is not available."
+        try:
+            sampler = self.sampler(kind, address)
+            return getattr(sampler, method)(*args), sampler.error
+        except Exception as E:
+            return None, f"{E}"
+
+    def stop(self):
+        with self.lock:
+            for sampler in self.samplers.values():
+                sampler.stop()
+            self.samplers.clear()
+
+
+class RemoteSampler:
+    # Sampler of another process, e.g. of the server for its worker processes
+
+    def __init__(self, request, kind, address):
+        self.request = request
+        self.kind = kind
+        self.address = address
+        self.error = None
+
+    def call(self, method, *args):
+        value, self.error = self.request(self.kind, self.address, method, args)
+        return value
+
+    def latest(self, timeout=None):
+        return self.call("latest", timeout)
+
+    def window(self, start, end):
+        return self.call("window", start, end)
+
+
+class RemoteSensorService:
+    # Forwards the samplers to the SensorService of another process, so that every
+    # sensor is only opened once
+
+    def __init__(self, request, interval=INTERVAL):
+        self.request = request
+        self.interval = interval
+
+    def sampler(self, kind, address):
+        address = address.strip()
+        if not address:
+            return None
+        return RemoteSampler(self.request, kind, address)
+
+    def stop(self):
+        pass
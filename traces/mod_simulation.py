@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import time
+import numpy as np
+
+## Defaults of the simulated devices, times are given in seconds and frequencies in MHz
+defaults = {
+    "seed": 0,
+    "latency": 0.001,
+    "jitter": 0.2,
+    "opc": 0.002,
+    "noise": 0.001,
+    "amplitude": 0.1,
+    "width": 0.5,
+    "cat": "",
+    # Injected faults, rates are probabilities per command
+    "spikes": 0,
+    "spike": 0.1,
+    "timeouts": 0,
+    "timeout": 5,
+    "malformed": 0,
+    "unlocked": 0,
+    "errors": 0,
+    "drops": 0,
+}
+
+## Frequencies and RF states set by the simulated synthesizers, read by the simulated lock-in
+state = {}
+
+
+def parse_settings(address):
+    # Settings are given as the address, e.g. "cat=lines.cat;latency=0.002;latency_get_intensity=0.005"
+    settings = dict(defaults)
+    for item in address.split(";"):
+        if not item.strip():
+            continue
+        key, _, value = item.partition("=")
+        key, value = key.strip(), value.strip()
+        if key != "cat":
+            value = float(value)
+        settings[key] = value
+    return settings
+
+
+def latency(settings, rng, command):
+    # Log-normal distribution around the (command specific) median latency
+    median = settings.get(f"latency_{command}", settings["latency"])
+    if not median:
+        return 0
+    return median * np.exp(settings["jitter"] * rng.standard_normal())
+
+
+def spike(settings, rng):
+    # Occasional latency spikes on top of the regular latency
+    if settings["spikes"] and rng.random() < settings["spikes"]:
+        return settings["spike"]
+    return 0
+
+
+def fault(settings, rng, kind):
+    return bool(settings[kind]) and rng.random() < settings[kind]
+
+
+def wait(duration):
+    # Sleep for the bulk of the time and spin for the remainder to stay accurate
+    end = time.perf_counter() + duration
+    if duration > 0.002:
+        time.sleep(duration - 0.002)
+    while time.perf_counter() < end:
+        continue
+
+
+def read_cat(filename):
+    frequencies, intensities = [], []
+    with open(filename, "r", encoding="utf-8") as file:
+        for line in file:
+            if len(line) < 29 or not line[:13].strip():
+                continue
+            frequencies.append(float(line[:13]))
+            intensities.append(10 ** float(line[21:29]))
+
+    frequencies, intensities = np.array(frequencies), np.array(intensities)
+    order = np.argsort(frequencies)
+    return frequencies[order], intensities[order]
+
+
+class Spectrum:
+    # Gaussian lines seen through frequency modulation and detection at a harmonic
+
+    N_PHASES = 64
+
+    def __init__(self, frequencies, intensities, width, deviation, harmonic=2):
+        self.frequencies = frequencies
+        self.intensities = intensities
+        self.width = width
+        self.deviation = deviation
+        self.harmonic = harmonic
+        self.reach = 5 * width + deviation
+
+        thetas = np.linspace(0, 2 * np.pi, self.N_PHASES, endpoint=False)
+        self.offsets = deviation * np.cos(thetas)
+        self.weights = 2 * np.cos(harmonic * thetas) / self.N_PHASES
+
+    @classmethod
+    def from_settings(cls, settings, deviation):
+        if settings["cat"]:
+            frequencies, intensities = read_cat(settings["cat"])
+            intensities = intensities * settings["amplitude"] / intensities.max()
+        else:
+            frequencies, intensities = np.empty(0), np.empty(0)
+        return cls(frequencies, intensities, settings["width"], deviation)
+
+    def __call__(self, frequency):
+        start, stop = np.searchsorted(
+            self.frequencies, (frequency - self.reach, frequency + self.reach)
+        )
+        if start == stop:
+            return 0.0
+
+        # Fourier coefficient of the line shape sampled along one modulation period
+        detunings = (
+            frequency + self.offsets[None, :] - self.frequencies[start:stop, None]
+        )
+        shapes = np.exp(-4 * np.log(2) * (detunings / self.width) ** 2)
+        return float(self.intensities[start:stop] @ shapes @ self.weights)
+
+
+class LockInModel:
+    # Lock-in output for the probe frequency in state, including the settling after steps
+
+    def __init__(self, settings, rng):
+        self.settings = settings
+        self.rng = rng
+        self.deviation = None
+        self.configure(0.001, 4.6, 1, 0)
+
+    def configure(self, timeconstant, settlefactor, fullscale, deviation):
+        # The settle factor relates the filter order to a single exponential (4.6 for 1 %)
+        self.timeconstant = timeconstant
+        self.effective_timeconstant = timeconstant * settlefactor / 4.6
+        self.fullscale = fullscale
+        # Noise is given for a time constant of 1 ms
+        self.noise = self.settings["noise"] * np.sqrt(0.001 / timeconstant)
+
+        if deviation != self.deviation:
+            self.deviation = deviation
+            self.spectrum = Spectrum.from_settings(self.settings, deviation)
+
+        self.frequency = None
+        self.target = self.start = 0.0
+        self.start_time = time.perf_counter()
+
+    def output(self, timestamp):
+        decay = np.exp(-(timestamp - self.start_time) / self.effective_timeconstant)
+        return self.target + (self.start - self.target) * decay
+
+    def clip(self, value):
+        return float(np.clip(value, -self.fullscale, self.fullscale))
+
+    def read(self):
+        probe = state.get("probe", {})
+        frequency = probe.get("frequency")
+        if frequency != self.frequency:
+            self.start = self.output(probe["time"])
+            self.start_time = probe["time"]
+            self.frequency = frequency
+            self.target = self.spectrum(frequency) if probe["rfpower"] else 0.0
+
+        x = self.output(time.perf_counter()) + self.noise * self.rng.standard_normal()
+        y = self.noise * self.rng.standard_normal()
+        return self.clip(x), self.clip(y)
+
+    def settled(self, frequency):
+        # Settled reading at a frequency, e.g. for points of a list sweep
+        x = self.spectrum(frequency) + self.noise * self.rng.standard_normal()
+        y = self.noise * self.rng.standard_normal()
+        return self.clip(x), self.clip(y)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import json
+import struct
+import asyncio
+import itertools
+import numpy as np
+from multiprocessing import shared_memory
+
+## Blocks sent per second to a following client and bounds of the requested rate
+RATE = 10
+MAX_RATE = 100
+
+## Most rows in one binary message and finished streams kept for range requests
+MAX_ROWS = 2**14
+HISTORY = 4
+
+## Binary messages start with the stream id, the first row and the number of rows
+## and columns, followed by the rows as little-endian float64 values
+HEADER = struct.Struct("<IQII")
+
+
+class StreamError(Exception):
+    pass
+
+
+def pack(stream_id, start, rows):
+    rows = np.ascontiguousarray(rows, dtype="<f8")
+    return HEADER.pack(stream_id, start, *rows.shape) + rows.tobytes()
+
+
+def unpack(message):
+    stream_id, start, n_rows, n_columns = HEADER.unpack_from(message)
+    rows = np.frombuffer(message, dtype="<f8", offset=HEADER.size)
+    return stream_id, start, rows.reshape(n_rows, n_columns)
+
+
+class Stream:
+    # Rows of one measurement, read from the shared memory the measurement writes to
+    def __init__(self, id_, setup, information):
+        self.id = id_
+        self.setup = setup
+        self.name = information["name"]
+        self.shape = tuple(information["shape"])
+        self.measurement = information.get("id")
+
+        # Segments of worker processes share the resource tracker of the server
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        self.buffer = np.ndarray(self.shape, dtype=np.float64, buffer=self.shm.buf)
+        self.rows = 0
+        self.finished = False
+
+    def update(self, block=4096):
+        # Rows are written in order and the probe frequency last, a row is complete
+        # once it has a frequency. Values can stay NaN, e.g. empty bins of fast sweeps.
+        n_rows = self.shape[0]
+        while not self.finished and self.rows < n_rows:
+            chunk = self.buffer[self.rows : self.rows + block, 0]
+            incomplete = np.isnan(chunk)
+            if incomplete.any():
+                self.rows += int(incomplete.argmax())
+                break
+            self.rows += len(chunk)
+        return self.rows
+
+    def finish(self):
+        # Aborted measurements leave rows without frequencies
+        self.update()
+        missing = np.isnan(self.buffer[self.rows :, 0])
+        self.rows += int(missing.argmax()) if missing.any() else len(missing)
+        self.finished = True
+
+    def blocks(self, start, stop):
+        start, stop = max(0, start), min(stop, self.rows)
+        for i in range(start, stop, MAX_ROWS):
+            yield pack(self.id, i, self.buffer[i : min(i + MAX_ROWS, stop)])
+
+    def information(self, action="stream", **kwargs):
+        return {
+            "action": action,
+            "stream": self.id,
+            "measurement": self.measurement,
+            "setup": self.setup,
+            "shape": self.shape,
+            "rows": self.rows,
+            "finished": self.finished,
+            **kwargs,
+        }
+
+    def close(self):
+        self.buffer = None
+        # Blocks still being sent keep the segment open until they are released
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+
+
+class Streamer:
+    # Streams of the measurements running on the setups of the websocket server
+    def __init__(self, experiments, history=HISTORY):
+        self.experiments = experiments
+        self.history = history
+        self.streams = {}
+        self.current = {}
+        self.ids = itertools.count(1)
+
+    def stream(self, setup):
+        measurement = self.experiments[setup].current_measurement
+        information = measurement.basic_information if measurement else None
+        current = self.current.get(setup)
+
+        if current and not current.finished:
+            if not information or information["name"] != current.name:
+                current.finish()
+
+        if information and (not current or information["name"] != current.name):
+            try:
+                current = Stream(next(self.ids), setup, information)
+            # The measurement finished before the stream was opened
+            except FileNotFoundError:
+                return current
+            self.current[setup] = self.streams[current.id] = current
+            self.trim()
+        return current
+
+    def refresh(self):
+        # Opens and updates the streams of all setups, e.g. before queries
+        for setup in self.experiments:
+            stream = self.stream(setup)
+            if stream:
+                stream.update()
+
+    def trim(self):
+        current = list(self.current.values())
+        finished = [x for x in self.streams.values() if x.finished and x not in current]
+        for stream in finished[: max(0, len(finished) - self.history)]:
+            del self.streams[stream.id]
+            stream.close()
+
+    def get(self, id_):
+        stream = self.streams.get(id_)
+        if stream is None:
+            raise StreamError(
+                f"The stream {id_} is not available, the streams are {list(self.streams)}."
+            )
+        return stream
+
+    async def send_rows(self, websocket, stream, start, stop):
+        # Waiting for the send applies backpressure per client
+        for message in stream.blocks(start, stop):
+            await websocket.send(message)
+        return max(start, stop)
+
+    async def send_range(self, websocket, id_, start=0, stop=None):
+        stream = self.get(id_)
+        stream.update()
+        stop = stream.rows if stop is None else stop
+        await websocket.send(json.dumps(stream.information("stream_range")))
+        await self.send_rows(websocket, stream, start, stop)
+
+    async def follow(self, websocket, setup, rate=RATE):
+        # Every client has its own cursor, rows a slow client could not receive in
+        # time are coalesced into the next block instead of piling up
+        interval = 1 / min(rate, MAX_RATE)
+        stream, cursor, ended = None, 0, True
+        first = True
+        while True:
+            current = self.stream(setup())
+            if current is not stream and current is not None:
+                if stream and stream.finished and not ended:
+                    await self.end(websocket, stream, cursor)
+                # Clients joining a running measurement fetch the earlier rows by range
+                stream, ended = current, False
+                cursor = current.update() if first else 0
+                await websocket.send(json.dumps(current.information(cursor=cursor)))
+            first = False
+
+            if stream and not ended:
+                cursor = await self.send_rows(
+                    websocket, stream, cursor, stream.update()
+                )
+                if stream.finished:
+                    await self.end(websocket, stream, cursor)
+                    ended = True
+            await asyncio.sleep(interval)
+
+    async def end(self, websocket, stream, cursor):
+        await self.send_rows(websocket, stream, cursor, stream.rows)
+        await websocket.send(json.dumps(stream.information("stream_end")))
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+        self.streams.clear()
+        self.current.clear()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Luis Bonah
+
+import os
+import math
+import json
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+
+## Logarithmic bins from 1 µs to 100 s
+BINS_PER_DECADE = 4
+MIN_EXPONENT, MAX_EXPONENT = -6, 2
+N_BINS = (MAX_EXPONENT - MIN_EXPONENT) * BINS_PER_DECADE + 2
+
+
+def bin_edges():
+    n_edges = (MAX_EXPONENT - MIN_EXPONENT) * BINS_PER_DECADE + 1
+    return [10 ** (MIN_EXPONENT + i / BINS_PER_DECADE) for i in range(n_edges)]
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        # First and last bin collect under- and overflows
+        self.counts = [0] * N_BINS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        if duration > 0:
+            index = math.floor((math.log10(duration) - MIN_EXPONENT) * BINS_PER_DECADE)
+            index = min(max(index + 1, 0), N_BINS - 1)
+        else:
+            index = 0
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0,
+            "max": self.max,
+            "counts": list(self.counts),
+        }
+
+
+class Timings(dict):
+    # Histograms of the durations of the individual phases of a measurement
+
+    def __init__(self, tracer=None):
+        super().__init__()
+        self.tracer = tracer
+
+    def add(self, phase, start, end):
+        histogram = self.get(phase)
+        if histogram is None:
+            histogram = self[phase] = Histogram()
+        histogram.add(end - start)
+
+        if self.tracer:
+            self.tracer.add(phase, "phase", start, end)
+
+    def summary(self):
+        return {
+            "edges": bin_edges(),
+            "phases": {phase: histogram.summary() for phase, histogram in self.items()},
+        }
+
+
+class Tracer:
+    # Ring buffer of timestamped events, exported in the Chrome Trace Event format
+
+    def __init__(self, capacity=2**20):
+        self.capacity = capacity
+        self.events = [None] * capacity
+        self.clear()
+
+    def clear(self):
+        self.counter = itertools.count()
+        self.origin = time.perf_counter()
+
+    def add(self, name, category, start, end):
+        # next() on itertools.count is atomic, so events from several threads do not collide
+        index = next(self.counter)
+        self.events[index % self.capacity] = (
+            name,
+            category,
+            start,
+            end,
+            threading.get_ident(),
+        )
+
+    @contextmanager
+    def span(self, name, category):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter())
+
+    def dump(self, filename):
+        n_events = next(self.counter)
+        if n_events > self.capacity:
+            index = n_events % self.capacity
+            events = self.events[index:] + self.events[:index]
+        else:
+            events = self.events[:n_events]
+
+        pid = os.getpid()
+        trace_events = [
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+            }
+            for name, category, start, end, tid in events
+        ]
+
+        with open(filename, "w+", encoding="utf-8") as file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+        self.clear()
+
+
+class TracedDevice:
+    # Records every method call of the wrapped device in the tracer
+
+    def __init__(self, device, tracer, name):
+        object.__setattr__(self, "device", device)
+        object.__setattr__(self, "tracer", tracer)
+        object.__setattr__(self, "name", name)
+
+    def __getattr__(self, attribute):
+        value = getattr(self.device, attribute)
+        if not callable(value):
+            return value
+
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                self.tracer.add(
+                    f"{self.name}.{attribute}", "device", start, time.perf_counter()
+                )
+
+        return traced
+
+    def __setattr__(self, attribute, value):
+        setattr(self.device, attribute, value)
+
+
+class RuntimeModel:
+    # Costs of the individual phases learned from completed measurements
+
+    SMOOTHING = 0.3
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        try:
+            with open(filename, "r", encoding="utf-8") as file:
+                self.costs = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.costs = {}
+
+    def cost(self, phase, key, default):
+        entry = self.costs.get(phase, {}).get(key)
+        return entry["value"] if entry else default
+
+    def learn(self, phase, key, value):
+        entries = self.costs.setdefault(phase, {})
+        entry = entries.setdefault(key, {"value": value, "n": 0})
+        entry["n"] += 1
+        # Plain average for the first runs, exponential average afterwards
+        weight = max(self.SMOOTHING, 1 / entry["n"])
+        entry["value"] += weight * (value - entry["value"])
+
+    def predict(self, measurement):
+        keys = measurement.runtime_keys()
+        counts, defaults, analytic = measurement.runtime_components()
+
+        if counts:
+            loop = sum(
+                counts[phase] * self.cost(phase, keys[phase], defaults[phase])
+                for phase in counts
+            )
+        else:
+            loop = analytic * self.cost("loop", keys["loop"], 1)
+
+        n_total = measurement.runtime_rows()
+        setup = self.cost("setup", keys["setup"], 0)
+        save = n_total * self.cost("save", keys["save"], 0)
+        return {
+            "setup": setup,
+            "loop": loop,
+            "save": save,
+            "total": setup + loop + save,
+        }
+
+    def update(self, measurement, summary, aborted=False):
+        if not summary:
+            return
+
+        keys = measurement.runtime_keys()
+        counts, defaults, analytic = measurement.runtime_components()
+        phases = summary["phases"]
+
+        with self.lock:
+            for phase, values in phases.items():
+                if phase not in keys or not values["count"]:
+                    continue
+
+                if phase == "save":
+                    self.learn(
+                        phase, keys[phase], values["total"] / measurement.runtime_rows()
+                    )
+                elif phase == "setup":
+                    self.learn(phase, keys[phase], values["total"])
+                elif phase == "loop":
+                    # Aborted measurements do not cover the whole loop
+                    if not counts and not aborted and analytic:
+                        self.learn(phase, keys[phase], values["total"] / analytic)
+                else:
+                    self.learn(phase, keys[phase], values["total"] / values["count"])
+
+            self.save()
+
+    def save(self):
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w+", encoding="utf-8") as file:
+            json.dump(self.costs, file, indent=2)
+        os.replace(tmp_filename, self.filename)